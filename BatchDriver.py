@@ -0,0 +1,99 @@
+# ------------------------------------------------------------------------------
+# Name: Batch Driver
+# Desc: Runs a per-dam function from the Step scripts over many dam GDBs in a pool of worker processes.
+#     Each worker collects its dam's AddMessage/AddWarning/AddError output and any exception,
+#     and the main process reports them as one summary at the end of the batch.
+#     The per-dam function must live in a module that can be imported without running its tool code.
+# ------------------------------------------------------------------------------
+import os, sys, traceback, multiprocessing
+from collections import namedtuple
+
+DamResult = namedtuple("DamResult", ["gdb", "status", "value", "messages"])
+
+#Number of worker processes from a tool parameter. Blank means 1, 0 or less means one per CPU.
+def workerCount(text):
+    if text == None or str(text).strip() == '':
+        return 1
+    count = int(text)
+    if count <= 0:
+        count = multiprocessing.cpu_count()
+    return count
+
+#Call func(*args) with arcpy messages redirected into a list, or left alone if capture is off.
+#Returns (status, value, messages); an exception is caught and its traceback added as an error.
+def callCaptured(func, args, capture=True):
+    import arcpy
+    messages = []
+    saved = (arcpy.AddMessage, arcpy.AddWarning, arcpy.AddError)
+    if capture:
+        arcpy.AddMessage = lambda text: messages.append(("message", str(text)))
+        arcpy.AddWarning = lambda text: messages.append(("warning", str(text)))
+        arcpy.AddError = lambda text: messages.append(("error", str(text)))
+    try:
+        value = func(*args)
+        status = "ok"
+    except Exception:
+        value = None
+        status = "failed"
+        messages.append(("error", traceback.format_exc()))
+    finally:
+        arcpy.AddMessage, arcpy.AddWarning, arcpy.AddError = saved
+    return status, value, messages
+
+#Worker process setup: arcpy settings and extensions, once per process
+def initWorker():
+    import arcpy
+    arcpy.env.overwriteOutput = True
+    arcpy.CheckOutExtension("3D")
+    arcpy.CheckOutExtension("Spatial")
+
+#Worker side: call module.funcName(gdb, *args) with arcpy messages redirected into a list.
+def runTask(task):
+    moduleName, funcName, gdb, args = task
+    initWorker()
+    status, value, messages = callCaptured(lambda: getattr(__import__(moduleName), funcName)(gdb, *args), ())
+    return DamResult(gdb, status, value, messages)
+
+#ArcMap runs scripts in-process, so child processes need the standalone interpreter
+def useStandaloneInterpreter():
+    pythonw = os.path.join(sys.exec_prefix, "pythonw.exe")
+    if sys.platform == "win32" and os.path.exists(pythonw):
+        multiprocessing.set_executable(pythonw)
+
+#Run funcName from moduleName for every GDB using a pool of worker processes. Returns a DamResult per GDB.
+#onResult is called with each DamResult in this process as its dam finishes, e.g. to publish it.
+def runBatch(moduleName, funcName, gdbs, args, workers, onResult=None):
+    import arcpy
+    useStandaloneInterpreter()
+
+    tasks = [(moduleName, funcName, gdb, tuple(args)) for gdb in gdbs]
+    results = []
+    pool = multiprocessing.Pool(min(workers, max(len(tasks), 1)))
+    try:
+        for result in pool.imap_unordered(runTask, tasks):
+            results.append(result)
+            arcpy.AddMessage("Finished %s (%s) %d of %d" %(damName(result.gdb), result.status, len(results), len(tasks)))
+            if onResult != None:
+                onResult(result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def damName(gdb):
+    return os.path.basename(gdb).split('.')[0]
+
+#One summary of the warnings and errors collected from every dam.
+def reportSummary(results):
+    import arcpy
+    lines = []
+    failed = 0
+    for result in sorted(results, key=lambda r: r.gdb):
+        if result.status != "ok":
+            failed += 1
+        for level, text in result.messages:
+            if level != "message":
+                lines.append("%s [%s] %s" %(damName(result.gdb), level, text.strip()))
+    arcpy.AddMessage("%d dams run, %d failed." %(len(results), failed))
+    if len(lines)>0:
+        arcpy.AddWarning("\n".join(lines))
@@ -0,0 +1,223 @@
+# ------------------------------------------------------------------------------
+# Name: Benchmark
+# Desc: Times the pipeline stages on synthetic counties (SyntheticCounty.py) without arcpy or ArcHydro.
+#     The arcpy calls of each step are replaced by their NumPy stand-ins on in-memory data:
+#       build     - lines snapped, split at junctions and given HydroID/NextDownID/nodes (Step1 buildTopology)
+#       topology  - stream table loaded into the StreamIndex (Step2 getDSHydroID)
+#       trace     - NextDownID trace, flow splits, upstream lines and the 2/5/10 mile cut (Step2 createMainFlowPath)
+#       points    - main stem and tributary WSE points (Step3 addWSEPoints/add_US_WSEPoints)
+#       flood     - stream WSE burned into the DEM window and flooded (Step3 getFloodPolygon, NumPy engine)
+#       flowdir   - with --d8, depression filling and D8 directions of the county DEM, then d8trace for every dam (FlowRouting.py)
+#     Each sweep varies one of spacing, buffer or dam count. Results can be saved as JSON and
+#     compared with a saved baseline, returning 1 if any case is slower than the tolerance allows.
+#     Example: python Benchmark.py --size 1500 --dams 30 --spacing 50,100,200 --buffer 500,1000,2000
+# ------------------------------------------------------------------------------
+from __future__ import division, print_function
+import sys, json, time, argparse
+from collections import namedtuple
+import numpy
+from StreamNetwork import StreamIndex, buildStreamTopology
+from SpatialIndex import PointGrid
+from WSEProfile import METERS_PER_MILE, chainage, stationsAlong, pointsAlong, waveHeight
+from CountyIndex import DIST_METERS, downstreamMiles
+from FloodEngine import floodFromStreamWSE, burnCells
+from FloodEngine import sampleNearest as sampleGrid
+from FlowRouting import fillDepressions, d8FlowDirection, traceCodes, arrayCodes
+from SyntheticCounty import buildCounty
+
+clock = getattr(time, "perf_counter", time.time)
+
+FlowPath = namedtuple("FlowPath", ["xs", "ys", "length", "usList", "splits"])
+WSEPoints = namedtuple("WSEPoints", ["xs", "ys", "wse"])
+
+#Best wall time of repeat calls and the result of the last call
+def timed(repeat, func, *args):
+    best = None
+    for i in range(repeat):
+        start = clock()
+        result = func(*args)
+        elapsed = clock() - start
+        best = elapsed if best == None else min(best, elapsed)
+    return best, result
+
+#Stream topology of the county's lines, as Step1 builds splitStreams
+def buildNetwork(county):
+    return buildStreamTopology([list(zip(line.xs.tolist(), line.ys.tolist())) for line in county.lines])
+
+#Stream table into the in-memory index
+def buildTopology(county):
+    index = StreamIndex()
+    for line in county.lines:
+        index.add(line.hydroID, line.nextDownID, line.fromNode, line.toNode, (line.xs[0], line.ys[0]))
+    return index
+
+#Main flow path of a dam cut to its downstream distance, with the upstream lines and flow splits
+def tracePath(county, index, dam):
+    start = index.lineStartingAt(dam.x, dam.y)
+    if start == None:
+        return None
+    dsList, fromList = index.trace(start[0])
+    splits = index.flowSplits(dsList)
+    usList = index.upstreamLines(dsList, fromList)
+    parts = [county.byID[hydroID] for hydroID in dsList]
+    xs = numpy.concatenate([parts[0].xs] + [line.xs[1:] for line in parts[1:]])
+    ys = numpy.concatenate([parts[0].ys] + [line.ys[1:] for line in parts[1:]])
+    vertexChainage = chainage(xs, ys)
+    length = min(vertexChainage[-1], DIST_METERS[downstreamMiles(dam.area)])
+    keep = int(numpy.searchsorted(vertexChainage, length, "right"))
+    endX, endY = pointsAlong(xs, ys, None, numpy.array([length]))
+    xs = numpy.concatenate((xs[:keep], endX))
+    ys = numpy.concatenate((ys[:keep], endY))
+    return FlowPath(xs, ys, length, usList, splits)
+
+#DEM value of the cell under each point (NaN off the DEM)
+def sampleNearest(county, xs, ys):
+    return sampleGrid(county.dem, county.xmin, county.ymax, county.cellSize, xs, ys)
+
+#Main stem points with WaveElev from the DEM, then tributary points stepping down from the nearest main stem WSE
+def wsePoints(county, dam, path, spacing):
+    stations = stationsAlong(path.length, spacing)
+    mainX, mainY = pointsAlong(path.xs, path.ys, None, stations)
+    mainWSE = sampleNearest(county, mainX, mainY) + waveHeight(dam.height, stations/METERS_PER_MILE)
+    allX, allY, allWSE = [mainX], [mainY], [mainWSE]
+
+    found = numpy.isfinite(mainWSE)
+    wseGrid = PointGrid(mainX[found], mainY[found], 100.0)
+    foundWSE = mainWSE[found]
+    for hydroID in path.usList:
+        line = county.byID[hydroID]
+        length = int(chainage(line.xs, line.ys)[-1])
+        usDist = stationsAlong(length, 100)[1:]
+        closest = wseGrid.nearest(line.xs[-1], line.ys[-1], 8000)
+        if closest == None:
+            continue
+        ptX, ptY = pointsAlong(line.xs, line.ys, None, length - usDist)
+        allX.append(ptX)
+        allY.append(ptY)
+        allWSE.append(foundWSE[closest[0]] - (dam.height/40.0)*(usDist/METERS_PER_MILE))
+    return WSEPoints(numpy.concatenate(allX), numpy.concatenate(allY), numpy.concatenate(allWSE))
+
+#Burn the points into a DEM window around the flow path and flood it. Returns the flooded cell count.
+def floodWindow(county, path, points, buffer):
+    r0, r1, c0, c1 = county.window(path.xs.min() - buffer, path.ys.min() - buffer, path.xs.max() + buffer, path.ys.max() + buffer)
+    dem = county.dem[r0:r1, c0:c1]
+    rows, cols, values = burnCells(dem.shape, county.xmin + c0*county.cellSize, county.ymax - r0*county.cellSize, county.cellSize,
+                                   points.xs, points.ys, points.wse)
+    streamWSE = numpy.full(dem.shape, numpy.nan, numpy.float32)
+    streamWSE[rows, cols] = values[0]
+    depth, wse, extent = floodFromStreamWSE(dem, streamWSE)
+    return int(extent.sum())
+
+#Trace, points and flood for a list of dams. Returns seconds per stage and totals.
+def runDams(county, index, dams, spacing, buffer):
+    seconds = {"trace": 0.0, "points": 0.0, "flood": 0.0}
+    pointCount = cellCount = 0
+    for dam in dams:
+        elapsed, path = timed(1, tracePath, county, index, dam)
+        seconds["trace"] += elapsed
+        if path == None or len(path.xs) < 2:
+            continue
+        elapsed, points = timed(1, wsePoints, county, dam, path, spacing)
+        seconds["points"] += elapsed
+        pointCount += len(points.xs)
+        elapsed, cells = timed(1, floodWindow, county, path, points, buffer)
+        seconds["flood"] += elapsed
+        cellCount += cells
+    return seconds, pointCount, cellCount
+
+#Filled DEM and D8 codes of the whole county
+def buildFlowDirections(county):
+    return d8FlowDirection(fillDepressions(county.dem), county.cellSize)
+
+#D8 flow path of every dam for its downstream distance. Returns the total length traced.
+def traceD8(county, codes, dams):
+    codeAt = arrayCodes(codes)
+    total = 0.0
+    for dam in dams:
+        total += traceCodes(codeAt, dam.x, dam.y, county.xmin, county.ymax, county.cellSize, DIST_METERS[downstreamMiles(dam.area)])[2]
+    return total
+
+def parseList(text, cast):
+    return [cast(value) for value in text.split(",") if value.strip() != ""]
+
+#Run every sweep and return a list of result rows
+def runSweeps(county, spacings, buffers, damCounts, repeat, d8=False):
+    results = []
+    elapsed, network = timed(repeat, buildNetwork, county)
+    results.append({"sweep": "topology", "case": "%d lines" %(len(county.lines)), "stage": "build", "seconds": elapsed, "dams": 0})
+    elapsed, index = timed(repeat, buildTopology, county)
+    results.append({"sweep": "topology", "case": "%d lines" %(len(county.lines)), "stage": "topology", "seconds": elapsed, "dams": 0})
+    if d8:
+        elapsed, codes = timed(1, buildFlowDirections, county)
+        results.append({"sweep": "d8", "case": "%d cells" %(codes.size), "stage": "flowdir", "seconds": elapsed, "dams": 0})
+        for count in damCounts:
+            elapsed, length = timed(repeat, traceD8, county, codes, county.dams[:count])
+            results.append({"sweep": "d8", "case": "%d dams" %(count), "stage": "d8trace", "seconds": elapsed, "dams": count})
+
+    baseSpacing, baseBuffer, baseDams = spacings[0], buffers[0], county.dams[:damCounts[0]]
+    cases = [("spacing", "%g m" %(spacing), spacing, baseBuffer, baseDams) for spacing in spacings]
+    cases += [("buffer", "%g m" %(buffer), baseSpacing, buffer, baseDams) for buffer in buffers]
+    cases += [("dams", "%d dams" %(count), baseSpacing, baseBuffer, county.dams[:count]) for count in damCounts]
+    for sweep, case, spacing, buffer, dams in cases:
+        best = None
+        for i in range(repeat):
+            seconds, pointCount, cellCount = runDams(county, index, dams, spacing, buffer)
+            if best == None or sum(seconds.values()) < sum(best[0].values()):
+                best = (seconds, pointCount, cellCount)
+        for stage in ("trace", "points", "flood"):
+            results.append({"sweep": sweep, "case": case, "stage": stage, "seconds": best[0][stage], "dams": len(dams),
+                            "points": best[1], "cells": best[2]})
+    return results
+
+def report(results):
+    print("%-9s %-12s %-9s %10s %12s" %("sweep", "case", "stage", "seconds", "ms per dam"))
+    for row in results:
+        perDam = 1000.0*row["seconds"]/row["dams"] if row["dams"] else 0.0
+        print("%-9s %-12s %-9s %10.4f %12.2f" %(row["sweep"], row["case"], row["stage"], row["seconds"], perDam))
+
+#Rows slower than tolerance x the baseline. Very short stages are skipped as timer noise.
+def regressions(results, baseline, tolerance, minSeconds=0.01):
+    previous = dict(((row["sweep"], row["case"], row["stage"]), row["seconds"]) for row in baseline)
+    slower = []
+    for row in results:
+        before = previous.get((row["sweep"], row["case"], row["stage"]))
+        if before != None and row["seconds"] > minSeconds and row["seconds"] > tolerance*before:
+            slower.append((row, before))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the dam breach pipeline stages on a synthetic county.")
+    parser.add_argument("--size", type=int, default=1500, help="DEM rows and columns")
+    parser.add_argument("--cell", type=float, default=10.0, help="DEM cell size in meters")
+    parser.add_argument("--depth", type=int, default=6, help="stream network branching levels")
+    parser.add_argument("--dams", default="10,30", help="dam counts to sweep")
+    parser.add_argument("--spacing", default="50,100,200", help="point spacings to sweep (m)")
+    parser.add_argument("--buffer", default="500,1000,2000", help="DEM window buffers around the flow path to sweep (m)")
+    parser.add_argument("--repeat", type=int, default=1, help="keep the best of this many runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--d8", action="store_true", help="also time D8 flow directions and traces")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline", help="compare with results saved by --json")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="slowdown allowed against the baseline")
+    args = parser.parse_args(argv)
+
+    damCounts = parseList(args.dams, int)
+    start = clock()
+    county = buildCounty(args.size, args.size, args.cell, args.depth, max(damCounts), args.seed)
+    print("County %dx%d cells, %d stream lines, %d dams, built in %.2f s" %(args.size, args.size, len(county.lines), len(county.dams), clock() - start))
+    results = runSweeps(county, parseList(args.spacing, float), parseList(args.buffer, float), damCounts, args.repeat, args.d8)
+    report(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for row, before in slower:
+            print("SLOWER %s %s %s: %.4f s, baseline %.4f s" %(row["sweep"], row["case"], row["stage"], row["seconds"], before))
+        return 1 if slower else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# ------------------------------------------------------------------------------
+# Name: County Index
+# Desc: County proximity index built once from the County feature class. Replaces the per-dam
+#     SelectLayerByLocation WITHIN_A_DISTANCE query: county extents are packed into an STR tree and
+#     exact distances are only checked for the candidates, returning the 2, 5 and 10 mile counties at once.
+#     Also holds the Surface_area -> downstream distance rule shared by all three steps.
+# ------------------------------------------------------------------------------
+from SpatialIndex import STRtree
+
+METERS_PER_MILE = 1609.344
+DIST_CLASSES = (2, 5, 10)
+DIST_METERS = {2: 3218.688, 5: 8046.72, 10: 16093.44}
+
+#Use surface area to pick the distance downstream in miles
+def downstreamMiles(damSA):
+    if damSA == None or damSA == '' or (damSA >= 25 and damSA < 100):
+        return 5
+    elif damSA < 25:
+        return 2
+    else:
+        return 10
+
+#Distance text for geoprocessing tools, e.g. "5 Miles"
+def distText(miles):
+    return "%d Miles" %(miles)
+
+#Geometries only need an extent (XMin, YMin, XMax, YMax) and distanceTo, as arcpy geometries do.
+class CountyIndex(object):
+    def __init__(self, names, geometries):
+        self.names = list(names)
+        self.geometries = list(geometries)
+        self.tree = STRtree([(g.extent.XMin, g.extent.YMin, g.extent.XMax, g.extent.YMax) for g in self.geometries])
+
+    def __len__(self):
+        return len(self.names)
+
+    #Geometry of a county by name, None if it is not in the index
+    def geometryOf(self, name):
+        if name not in self.names:
+            return None
+        return self.geometries[self.names.index(name)]
+
+    #Counties within 2, 5 and 10 miles of a geometry: {2: [names], 5: [names], 10: [names]}
+    def countiesNear(self, geometry):
+        reach = DIST_METERS[max(DIST_CLASSES)]
+        extent = geometry.extent
+        near = dict((miles, []) for miles in DIST_CLASSES)
+        for i in self.tree.query((extent.XMin - reach, extent.YMin - reach, extent.XMax + reach, extent.YMax + reach)):
+            distance = self.geometries[i].distanceTo(geometry)
+            for miles in DIST_CLASSES:
+                if distance <= DIST_METERS[miles]:
+                    near[miles].append(self.names[i])
+        return near
+
+#Read the County feature class once
+def loadCountyIndex(countyFC, nameField="CNTYNAME"):
+    import arcpy
+    names, geometries = [], []
+    with arcpy.da.SearchCursor(countyFC, [nameField, "SHAPE@"]) as rows:
+        for row in rows:
+            if row[1] != None:
+                names.append(row[0])
+                geometries.append(row[1])
+    return CountyIndex(names, geometries)
@@ -0,0 +1,152 @@
+# ------------------------------------------------------------------------------
+# Name: DEM Cache
+# Desc: One-time regional DEM cache. The county DEMs are mosaicked once (county seams are resolved here)
+#     and stored as square float32 .npy tiles with an index.json describing the grid.
+#     A dam's DEM is then a windowed read by bounding box instead of a Clip and MosaicToNewRaster per dam.
+#     Only the DEM GDBs of the county and its neighbours go into the cache, and it is rebuilt when their contents change.
+#     Step3 reads the flood and ground sampling DEM cells of each clipDEM back from the tiles (gridReader), so dams on
+#     the same river share the tiles through the OS file cache instead of each reading its own clipDEM raster.
+#     Reading the cache only needs NumPy; building it and writing rasters use arcpy.
+# ------------------------------------------------------------------------------
+from __future__ import division
+import os, json, math
+import numpy
+from Manifest import contentStamp
+
+INDEX_FILE = "index.json"
+NODATA = -9999.0
+
+class DemCache(object):
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        with open(os.path.join(cacheDir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.xmin = self.index["xmin"]
+        self.ymax = self.index["ymax"]
+        self.cellSize = self.index["cellSize"]
+        self.nrows = self.index["nrows"]
+        self.ncols = self.index["ncols"]
+        self.tileSize = self.index["tileSize"]
+        self.tiles = set(tuple(tile) for tile in self.index["tiles"])
+
+    def tilePath(self, tileRow, tileCol):
+        return os.path.join(self.cacheDir, "tile_%d_%d.npy" %(tileRow, tileCol))
+
+    #Row/column window covering a bounding box, clamped to the cache
+    def window(self, xmin, ymin, xmax, ymax):
+        c0 = max(0, int(math.floor((xmin - self.xmin)/self.cellSize)))
+        c1 = min(self.ncols, int(math.ceil((xmax - self.xmin)/self.cellSize)))
+        r0 = max(0, int(math.floor((self.ymax - ymax)/self.cellSize)))
+        r1 = min(self.nrows, int(math.ceil((self.ymax - ymin)/self.cellSize)))
+        return r0, r1, c0, c1
+
+    #DEM cells inside a bounding box as a float32 array (NaN for NoData) and the lower left corner of the array
+    def readWindow(self, xmin, ymin, xmax, ymax):
+        r0, r1, c0, c1 = self.window(xmin, ymin, xmax, ymax)
+        lowerLeft = (self.xmin + c0*self.cellSize, self.ymax - r1*self.cellSize)
+        return self.readCells(r0, max(r0, r1), c0, max(c0, c1)), lowerLeft
+
+    #Cache rows r0:r1 and columns c0:c1 as a float32 array, NaN for NoData and cells outside the cache
+    def readCells(self, r0, r1, c0, c1):
+        out = numpy.full((r1 - r0, c1 - c0), numpy.nan, numpy.float32)
+        rr0, rr1, cc0, cc1 = max(r0, 0), min(r1, self.nrows), max(c0, 0), min(c1, self.ncols)
+        size = self.tileSize
+        for tileRow in range(rr0//size, (rr1 - 1)//size + 1 if rr1 > rr0 else 0):
+            for tileCol in range(cc0//size, (cc1 - 1)//size + 1 if cc1 > cc0 else 0):
+                if (tileRow, tileCol) not in self.tiles:
+                    continue
+                tile = numpy.load(self.tilePath(tileRow, tileCol), mmap_mode="r")
+                tr0, tc0 = tileRow*size, tileCol*size
+                rs, re = max(rr0, tr0), min(rr1, tr0 + tile.shape[0])
+                cs, ce = max(cc0, tc0), min(cc1, tc0 + tile.shape[1])
+                out[rs - r0:re - r0, cs - c0:ce - c0] = tile[rs - tr0:re - tr0, cs - tc0:ce - tc0]
+        return out
+
+    #Windowed reader, as FloodEngine.rasterReader, of a grid cut from the cache such as a clipDEM saved by saveWindow.
+    #Returns None when the grid is not on the cache cells.
+    def gridReader(self, grid):
+        colOffset = (grid.xmin - self.xmin)/self.cellSize
+        rowOffset = (self.ymax - grid.ymax)/self.cellSize
+        if abs(grid.cellSize - self.cellSize) > 1e-6*self.cellSize or abs(colOffset - round(colOffset)) > 1e-3 or abs(rowOffset - round(rowOffset)) > 1e-3:
+            return None
+        rowOffset, colOffset = int(round(rowOffset)), int(round(colOffset))
+        def read(r0, r1, c0, c1):
+            return self.readCells(r0 + rowOffset, r1 + rowOffset, c0 + colOffset, c1 + colOffset)
+        return read
+
+#Write one tile. All-NoData tiles are skipped and read back as NaN.
+def writeTile(cacheDir, tileRow, tileCol, block, tiles):
+    block = numpy.asarray(block, numpy.float32)
+    if numpy.isnan(block).all():
+        return
+    numpy.save(os.path.join(cacheDir, "tile_%d_%d.npy" %(tileRow, tileCol)), block)
+    tiles.append([tileRow, tileCol])
+
+#Write the index last so an interrupted build is never used
+def writeIndex(cacheDir, xmin, ymax, cellSize, nrows, ncols, tileSize, tiles, spatialReference, sources):
+    index = {"xmin": xmin, "ymax": ymax, "cellSize": cellSize, "nrows": nrows, "ncols": ncols,
+             "tileSize": tileSize, "tiles": tiles, "spatialReference": spatialReference, "sources": sources}
+    with open(os.path.join(cacheDir, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+
+#Build the cache from a list of DEM GDBs (the first raster in each), unless it is already current with their contents
+def buildDemCache(demGDBs, cacheDir, tileSize=2048):
+    import arcpy
+    sources = contentStamp(demGDBs)
+    indexPath = os.path.join(cacheDir, INDEX_FILE)
+    if os.path.exists(indexPath):
+        with open(indexPath) as f:
+            if json.load(f).get("sources") == sources:
+                return DemCache(cacheDir)
+        os.remove(indexPath)
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+
+    #Mosaic the county DEMs once
+    workspace = arcpy.env.workspace
+    rasters = []
+    for demGDB in demGDBs:
+        arcpy.env.workspace = demGDB
+        rasters.append(os.path.join(demGDB, arcpy.ListRasters("*")[0]))
+    arcpy.env.workspace = workspace
+    scratchGDB = os.path.join(cacheDir, "mosaic.gdb")
+    if not arcpy.Exists(scratchGDB):
+        arcpy.CreateFileGDB_management(cacheDir, "mosaic.gdb")
+    arcpy.MosaicToNewRaster_management(";".join(rasters), scratchGDB, "regionDEM", "#", "32_BIT_FLOAT", "#", 1)
+    regionDEM = arcpy.Raster(os.path.join(scratchGDB, "regionDEM"))
+
+    #Cut the mosaic into tiles
+    cellSize = regionDEM.meanCellWidth
+    xmin, ymax = regionDEM.extent.XMin, regionDEM.extent.YMax
+    nrows, ncols = regionDEM.height, regionDEM.width
+    tiles = []
+    for tileRow in range(0, -(-nrows//tileSize)):
+        for tileCol in range(0, -(-ncols//tileSize)):
+            rows = min(tileSize, nrows - tileRow*tileSize)
+            cols = min(tileSize, ncols - tileCol*tileSize)
+            lowerLeft = arcpy.Point(xmin + tileCol*tileSize*cellSize, ymax - (tileRow*tileSize + rows)*cellSize)
+            block = arcpy.RasterToNumPyArray(regionDEM, lowerLeft, cols, rows, numpy.nan)
+            writeTile(cacheDir, tileRow, tileCol, block, tiles)
+    writeIndex(cacheDir, xmin, ymax, cellSize, nrows, ncols, tileSize, tiles, regionDEM.spatialReference.exportToString(), sources)
+    del regionDEM
+    arcpy.Delete_management(scratchGDB)
+    return DemCache(cacheDir)
+
+#Save the cached DEM cells covering a feature class extent as a raster (replaces Clip_management with "NONE").
+#Returns the shape of the window; an empty window (outside the cache) is not saved.
+def saveWindow(cache, clipFC, outRaster):
+    import arcpy
+    extent = arcpy.Describe(clipFC).extent
+    array, lowerLeft = cache.readWindow(extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+    if array.size == 0:
+        return array.shape
+    spatialReference = arcpy.SpatialReference()
+    spatialReference.loadFromString(cache.index["spatialReference"])
+    outputCoordinateSystem = arcpy.env.outputCoordinateSystem
+    arcpy.env.outputCoordinateSystem = spatialReference
+    try:
+        raster = arcpy.NumPyArrayToRaster(numpy.where(numpy.isnan(array), NODATA, array), arcpy.Point(*lowerLeft), cache.cellSize, cache.cellSize, NODATA)
+        raster.save(outRaster)
+    finally:
+        arcpy.env.outputCoordinateSystem = outputCoordinateSystem
+    return array.shape
@@ -0,0 +1,547 @@
+# ------------------------------------------------------------------------------
+# Name: Flood Engine
+# Desc: NumPy replacement for ArcHydroTools.FloodFromStreamWSEPy.
+#     Each stream cell's WSE is extended to the surrounding cells by nearest source allocation,
+#     the DEM is subtracted and only flooded cells connected to the stream are kept.
+#     Works on plain or memory-mapped arrays and does not need arcpy, so it can be run on synthetic DEMs.
+#     scipy.ndimage is used for the allocation and labelling when it is installed.
+#     Domains larger than the memory budget run in tiles with halos (floodTiled): inputs are read one
+#     window at a time, intermediates are memory-mapped to disk and connectivity is stitched across tiles.
+# ------------------------------------------------------------------------------
+from __future__ import division
+import os, math, tempfile
+from collections import namedtuple
+import numpy
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+NODATA = -9999.0
+BYTES_PER_CELL = 64     #working set of one window cell: inputs, allocation indices, outputs and masks
+DEPTH_THRESHOLDS = (0.5, 1.0, 2.0)      #depths (DEM units) whose downstream reach FloodStats reports
+STATS_MILES = 0.1                       #downstream distance bins of FloodStats
+
+#Output array, memory-mapped to a .npy file in outDir when one is given.
+def newArray(shape, dtype, fill, outDir=None, name=None):
+    if outDir:
+        array = numpy.lib.format.open_memmap(os.path.join(outDir, name + ".npy"), "w+", dtype, shape)
+        array[:] = fill
+        return array
+    return numpy.full(shape, fill, dtype)
+
+#Row/column of the nearest source cell for every cell (-1 where there are no sources).
+def nearestSource(sourceMask):
+    sourceMask = numpy.asarray(sourceMask, bool)
+    if not sourceMask.any():
+        empty = numpy.full(sourceMask.shape, -1, numpy.int32)
+        return empty, empty.copy()
+    if ndimage is not None:
+        rows, cols = ndimage.distance_transform_edt(~sourceMask, return_distances=False, return_indices=True)
+        return rows.astype(numpy.int32), cols.astype(numpy.int32)
+    return jumpFlood(sourceMask)
+
+#Jump flooding allocation (with extra short passes at the end) for when scipy is not available.
+def jumpFlood(sourceMask):
+    nr, nc = sourceMask.shape
+    srcR = numpy.where(sourceMask, numpy.arange(nr, dtype=numpy.int32)[:, None], -1).astype(numpy.int32)
+    srcC = numpy.where(sourceMask, numpy.arange(nc, dtype=numpy.int32)[None, :], -1).astype(numpy.int32)
+    bestD = numpy.where(sourceMask, 0, numpy.iinfo(numpy.int64).max).astype(numpy.int64)
+    rowIdx = numpy.arange(nr, dtype=numpy.int64)[:, None]
+    colIdx = numpy.arange(nc, dtype=numpy.int64)[None, :]
+
+    step = 1
+    while step*2 < max(nr, nc):
+        step *= 2
+    steps = []
+    while step >= 1:
+        steps.append(step)
+        step //= 2
+    steps.extend([2, 1])
+
+    for step in steps:
+        for dr in (-step, 0, step):
+            for dc in (-step, 0, step):
+                if (dr == 0 and dc == 0) or abs(dr) >= nr or abs(dc) >= nc:
+                    continue
+                tr = slice(max(0, -dr), nr - max(0, dr))
+                sr = slice(max(0, dr), nr - max(0, -dr))
+                tc = slice(max(0, -dc), nc - max(0, dc))
+                sc = slice(max(0, dc), nc - max(0, -dc))
+                candR = srcR[sr, sc]
+                candC = srcC[sr, sc]
+                dist = (rowIdx[tr] - candR)**2 + (colIdx[:, tc] - candC)**2
+                better = (candR >= 0) & (dist < bestD[tr, tc])
+                srcR[tr, tc] = numpy.where(better, candR, srcR[tr, tc])
+                srcC[tr, tc] = numpy.where(better, candC, srcC[tr, tc])
+                bestD[tr, tc] = numpy.where(better, dist, bestD[tr, tc])
+    return srcR, srcC
+
+#Cells of mask connected (8 neighbours) to any seed cell.
+def connectedTo(mask, seeds):
+    mask = numpy.asarray(mask, bool)
+    seeds = numpy.asarray(seeds, bool) & mask
+    if not seeds.any():
+        return numpy.zeros(mask.shape, bool)
+    if ndimage is not None:
+        labels, count = ndimage.label(mask, structure=numpy.ones((3, 3), bool))
+        keep = numpy.zeros(count + 1, bool)
+        keep[numpy.unique(labels[seeds])] = True
+        keep[0] = False
+        return keep[labels]
+    return sweepConnected(mask, seeds)
+
+#Row-run propagation, sweeping down and up the grid until nothing changes.
+def sweepConnected(mask, seeds):
+    nr, nc = mask.shape
+    reached = seeds.copy()
+    changed = True
+    while changed:
+        changed = False
+        for order in (range(nr), range(nr - 1, -1, -1)):
+            previous = None
+            for r in order:
+                rowMask = mask[r]
+                hit = reached[r].copy()
+                if previous is not None:
+                    spread = previous.copy()
+                    spread[1:] |= previous[:-1]
+                    spread[:-1] |= previous[1:]
+                    hit |= spread & rowMask
+                if hit.any():
+                    #Label runs of the row and keep every run that was hit
+                    starts = rowMask & ~numpy.concatenate(([False], rowMask[:-1]))
+                    runID = numpy.cumsum(starts)*rowMask
+                    keep = numpy.zeros(int(starts.sum()) + 1, bool)
+                    keep[runID[hit & rowMask]] = True
+                    keep[0] = False
+                    rowReached = keep[runID]
+                    if (rowReached & ~reached[r]).any():
+                        reached[r] |= rowReached
+                        changed = True
+                previous = reached[r]
+    return reached
+
+#Flood depth and WSE grids from a DEM and a stream WSE grid (NaN off the stream).
+#Returns (depth, wse, extent); depth and wse are NaN outside the flood extent.
+#With a memory budget (MB) that the grid does not fit in, the tiled engine is used.
+def floodFromStreamWSE(dem, streamWSE, outDir=None, budgetMB=None):
+    if budgetMB and not fitsBudget(numpy.shape(dem), budgetMB):
+        return floodTiled(arrayReader(dem), arrayReader(streamWSE), numpy.shape(dem), outDir or tempfile.mkdtemp(), budgetMB)
+    dem = numpy.asarray(dem)
+    streamWSE = numpy.asarray(streamWSE)
+    source = numpy.isfinite(streamWSE)
+    rows, cols = nearestSource(source)
+    valid = rows >= 0
+
+    wse = newArray(dem.shape, numpy.float32, numpy.nan, outDir, "wse")
+    wse[valid] = streamWSE[rows[valid], cols[valid]]
+    del rows, cols, valid
+    return floodFromWSE(dem, wse, source, outDir)
+
+#Subtract the DEM from an extended WSE grid and keep only wet cells that connect to a stream cell
+def floodFromWSE(dem, wse, source, outDir=None, suffix=""):
+    depth = newArray(dem.shape, numpy.float32, numpy.nan, outDir, "depth" + suffix)
+    numpy.subtract(wse, dem, out=depth, casting="unsafe")
+    with numpy.errstate(invalid="ignore"):
+        wet = (depth > 0) & numpy.isfinite(dem)
+    extent = newArray(dem.shape, numpy.uint8, 0, outDir, "extent" + suffix)
+    extent[:] = connectedTo(wet, source & wet)
+    depth[extent == 0] = numpy.nan
+    wse[extent == 0] = numpy.nan
+    return depth, wse, extent
+
+#(depth, wse, extent) for several WSE profiles on the same stream cells, one scenario at a time.
+#rows and cols are the stream cells and values holds one row of cell WSEs per scenario.
+#The nearest stream allocation is computed once, unless the grid is over budget and each scenario runs tiled.
+#A FloodStats given as stats is fed each scenario's depth as it is flooded; reset it before taking the next one.
+def floodScenarios(dem, rows, cols, values, outDir=None, budgetMB=None, stats=None):
+    shape = numpy.shape(dem)
+    values = numpy.asarray(values, numpy.float32)
+    if budgetMB and not fitsBudget(shape, budgetMB):
+        outDir = outDir or tempfile.mkdtemp()
+        for i in range(len(values)):
+            scenarioDir = os.path.join(outDir, "scenario%d" %(i))
+            if not os.path.exists(scenarioDir):
+                os.makedirs(scenarioDir)
+            yield floodTiled(arrayReader(dem), cellReader(rows, cols, values[i]), shape, scenarioDir, budgetMB, stats)
+        return
+
+    dem = numpy.asarray(dem)
+    source = numpy.zeros(shape, bool)
+    source[rows, cols] = True
+    cellID = numpy.full(shape, -1, numpy.int32)
+    cellID[rows, cols] = numpy.arange(len(rows))
+    nearR, nearC = nearestSource(source)
+    valid = nearR >= 0
+    nearest = cellID[nearR[valid], nearC[valid]]
+    del nearR, nearC, cellID
+    for i in range(len(values)):
+        wse = newArray(shape, numpy.float32, numpy.nan, outDir, "wse%d" %(i))
+        wse[valid] = values[i][nearest]
+        depth, wse, extent = floodFromWSE(dem, wse, source, outDir, str(i))
+        if stats != None:
+            stats.add(depth)
+        yield depth, wse, extent
+
+#Row, column and on-grid flag of the cell under each point
+def cellIndex(shape, xmin, ymax, cellSize, xs, ys):
+    rows = numpy.floor((ymax - numpy.asarray(ys, float))/cellSize).astype(numpy.int64)
+    cols = numpy.floor((numpy.asarray(xs, float) - xmin)/cellSize).astype(numpy.int64)
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    return rows, cols, inside
+
+#Value of the cell under each point, NaN off the grid
+def sampleNearest(array, xmin, ymax, cellSize, xs, ys):
+    rows, cols, inside = cellIndex(numpy.shape(array), xmin, ymax, cellSize, xs, ys)
+    values = numpy.full(len(rows), numpy.nan)
+    values[inside] = array[rows[inside], cols[inside]]
+    return values
+
+#Bilinear value between the four cell centres around each point. NoData neighbours are left out and the
+#weights of the others renormalized; points over a NoData cell or off the grid are NaN, as with sampleNearest.
+def sampleBilinear(array, xmin, ymax, cellSize, xs, ys):
+    xs, ys = numpy.asarray(xs, float), numpy.asarray(ys, float)
+    values = sampleNearest(array, xmin, ymax, cellSize, xs, ys)
+    fr = (ymax - ys)/cellSize - 0.5
+    fc = (xs - xmin)/cellSize - 0.5
+    r0, c0 = numpy.floor(fr).astype(numpy.int64), numpy.floor(fc).astype(numpy.int64)
+    tr, tc = fr - r0, fc - c0
+    total, weights = numpy.zeros(len(xs)), numpy.zeros(len(xs))
+    for dr, dc, weight in ((0, 0, (1 - tr)*(1 - tc)), (0, 1, (1 - tr)*tc), (1, 0, tr*(1 - tc)), (1, 1, tr*tc)):
+        rows, cols = r0 + dr, c0 + dc
+        inside = (rows >= 0) & (rows < array.shape[0]) & (cols >= 0) & (cols < array.shape[1])
+        corner = numpy.full(len(xs), numpy.nan)
+        corner[inside] = array[rows[inside], cols[inside]]
+        valid = numpy.isfinite(corner)
+        total[valid] += weight[valid]*corner[valid]
+        weights[valid] += weight[valid]
+    found = numpy.isfinite(values) & (weights > 0)
+    values[found] = total[found]/weights[found]
+    return values
+
+#Ground under points from a windowed DEM reader on grid, reading only the window around the points.
+#method is Nearest (the cell under the point, as ExtractValuesToPoints) or Bilinear. NaN for NoData.
+def sampleGround(readDem, grid, xs, ys, method="Nearest"):
+    values = numpy.full(len(xs), numpy.nan)
+    rows, cols, inside = cellIndex((grid.nrows, grid.ncols), grid.xmin, grid.ymax, grid.cellSize, xs, ys)
+    if not inside.any():
+        return values
+    r0, r1 = max(rows[inside].min() - 1, 0), min(rows[inside].max() + 2, grid.nrows)
+    c0, c1 = max(cols[inside].min() - 1, 0), min(cols[inside].max() + 2, grid.ncols)
+    sample = sampleBilinear if method == "Bilinear" else sampleNearest
+    return sample(readDem(r0, r1, c0, c1), grid.xmin + c0*grid.cellSize, grid.ymax - r0*grid.cellSize, grid.cellSize, xs, ys)
+
+#Stream cells under points and their values (one row per scenario). Points off the grid or with
+#a NaN value in any scenario are dropped, and the first point in a cell sets its values.
+def burnCells(shape, xmin, ymax, cellSize, xs, ys, values):
+    values = numpy.atleast_2d(numpy.asarray(values, numpy.float32))
+    rows, cols, inside = cellIndex(shape, xmin, ymax, cellSize, xs, ys)
+    keep = inside & numpy.isfinite(values).all(axis=0)
+    flat, first = numpy.unique(rows[keep]*shape[1] + cols[keep], return_index=True)
+    return flat//shape[1], flat % shape[1], values[:, keep][:, first]
+
+#Window reader over sparse stream cells, NaN off the stream
+def cellReader(rows, cols, values):
+    def read(r0, r1, c0, c1):
+        block = numpy.full((r1 - r0, c1 - c0), numpy.nan, numpy.float32)
+        inside = (rows >= r0) & (rows < r1) & (cols >= c0) & (cols < c1)
+        block[rows[inside] - r0, cols[inside] - c0] = values[inside]
+        return block
+    return read
+
+def fitsBudget(shape, budgetMB):
+    return shape[0]*shape[1]*BYTES_PER_CELL <= budgetMB*1048576.0
+
+#Window reader over an array: read(r0, r1, c0, c1) -> float32 block
+def arrayReader(array):
+    return lambda r0, r1, c0, c1: numpy.asarray(array[r0:r1, c0:c1], numpy.float32)
+
+#Tile size, halo and coarse grid factor (cells) for a grid and memory budget.
+#A tile and its halo fit the budget, and the tile size is a multiple of the coarse factor.
+def tileLayout(shape, budgetMB):
+    side = max(int(math.sqrt(budgetMB*1048576.0/BYTES_PER_CELL)), 96)
+    halo = max(16, side//8)
+    factor = 1
+    while (-(-shape[0]//factor))*(-(-shape[1]//factor))*BYTES_PER_CELL > budgetMB*1048576.0/4:
+        factor *= 2
+    tileSize = max(side - 2*halo, factor)
+    tileSize -= tileSize % factor
+    return tileSize, halo, factor
+
+def tileWindows(shape, tileSize):
+    for r0 in range(0, shape[0], tileSize):
+        for c0 in range(0, shape[1], tileSize):
+            yield r0, min(r0 + tileSize, shape[0]), c0, min(c0 + tileSize, shape[1])
+
+#Nearest stream cell for every block of factor x factor cells, found on a coarse grid of the whole domain.
+#Each block holding stream cells is represented by one of them. Returns the row, column and WSE per block.
+def coarseAllocation(readLine, shape, tileSize, factor):
+    coarseShape = (-(-shape[0]//factor), -(-shape[1]//factor))
+    repR = numpy.full(coarseShape, -1, numpy.int64)
+    repC = numpy.full(coarseShape, -1, numpy.int64)
+    repW = numpy.full(coarseShape, numpy.nan, numpy.float32)
+    for r0, r1, c0, c1 in tileWindows(shape, tileSize):
+        line = readLine(r0, r1, c0, c1)
+        rows, cols = numpy.nonzero(numpy.isfinite(line))
+        repW[(rows + r0)//factor, (cols + c0)//factor] = line[rows, cols]
+        repR[(rows + r0)//factor, (cols + c0)//factor] = rows + r0
+        repC[(rows + r0)//factor, (cols + c0)//factor] = cols + c0
+    blockR, blockC = nearestSource(repR >= 0)
+    found = blockR >= 0
+    nearR = numpy.where(found, repR[blockR, blockC], -1)
+    nearC = numpy.where(found, repC[blockR, blockC], -1)
+    nearW = numpy.where(found, repW[blockR, blockC], numpy.nan).astype(numpy.float32)
+    return nearR, nearC, nearW
+
+#WSE of the nearest stream cell for one tile. The halo window gives the exact nearest cell within the halo,
+#cells whose nearest stream is farther away take the closest of the coarse grid's candidates around them.
+def tileWSE(readLine, shape, window, halo, factor, coarse):
+    r0, r1, c0, c1 = window
+    wr0, wr1 = max(0, r0 - halo), min(shape[0], r1 + halo)
+    wc0, wc1 = max(0, c0 - halo), min(shape[1], c1 + halo)
+    line = readLine(wr0, wr1, wc0, wc1)
+    rows, cols = nearestSource(numpy.isfinite(line))
+    rows = rows[r0 - wr0:r1 - wr0, c0 - wc0:c1 - wc0]
+    cols = cols[r0 - wr0:r1 - wr0, c0 - wc0:c1 - wc0]
+    valid = rows >= 0
+    tileR = numpy.arange(r0, r1, dtype=numpy.int64)[:, None]
+    tileC = numpy.arange(c0, c1, dtype=numpy.int64)[None, :]
+    distance = numpy.where(valid, (tileR - rows - wr0)**2 + (tileC - cols - wc0)**2, numpy.iinfo(numpy.int64).max)
+    wse = numpy.where(valid, line[numpy.maximum(rows, 0), numpy.maximum(cols, 0)], numpy.nan).astype(numpy.float32)
+
+    #Candidates of the cell's block and the 8 blocks around it
+    nearR, nearC, nearW = coarse
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            blockR = numpy.clip(tileR//factor + dr, 0, nearR.shape[0] - 1)
+            blockC = numpy.clip(tileC//factor + dc, 0, nearR.shape[1] - 1)
+            coarseR, coarseC = nearR[blockR, blockC], nearC[blockR, blockC]
+            coarseD = (tileR - coarseR)**2 + (tileC - coarseC)**2
+            closer = (coarseR >= 0) & (coarseD < distance)
+            wse[closer] = nearW[blockR, blockC][closer]
+            distance = numpy.where(closer, coarseD, distance)
+    return wse, numpy.isfinite(line[r0 - wr0:r1 - wr0, c0 - wc0:c1 - wc0])
+
+#Tiled engine. readDem and readLine return float32 windows (NaN for NoData) of the DEM and stream WSE grids.
+#wse, depth and extent are memory-mapped in outDir. Same outputs as floodFromStreamWSE, except that cells
+#whose nearest stream cell is beyond the halo take it from the coarse grid, within factor cells of the exact one.
+#A FloodStats given as stats is fed each depth tile as it is finished.
+def floodTiled(readDem, readLine, shape, outDir, budgetMB, stats=None):
+    tileSize, halo, factor = tileLayout(shape, budgetMB)
+    coarse = coarseAllocation(readLine, shape, tileSize, factor)
+    wse = newArray(shape, numpy.float32, numpy.nan, outDir, "wse")
+    depth = newArray(shape, numpy.float32, numpy.nan, outDir, "depth")
+    extent = newArray(shape, numpy.uint8, 0, outDir, "extent")       #1 wet, 2 wet and connected to the stream
+    windows = list(tileWindows(shape, tileSize))
+    for r0, r1, c0, c1 in windows:
+        tile, source = tileWSE(readLine, shape, (r0, r1, c0, c1), halo, factor, coarse)
+        dem = readDem(r0, r1, c0, c1)
+        wse[r0:r1, c0:c1] = tile
+        depth[r0:r1, c0:c1] = tile - dem
+        with numpy.errstate(invalid="ignore"):
+            wet = (tile - dem > 0) & numpy.isfinite(dem)
+        extent[r0:r1, c0:c1] = numpy.where(wet & source, 2, wet)
+    del coarse
+
+    #Spread connection across tile edges, sweeping forward and back until no tile changes
+    changed = True
+    while changed:
+        changed = False
+        for order in (windows, windows[::-1]):
+            for r0, r1, c0, c1 in order:
+                wr0, wr1, wc0, wc1 = max(0, r0 - 1), min(shape[0], r1 + 1), max(0, c0 - 1), min(shape[1], c1 + 1)
+                block = numpy.array(extent[wr0:wr1, wc0:wc1])
+                reached = connectedTo(block > 0, block == 2)[r0 - wr0:r1 - wr0, c0 - wc0:c1 - wc0]
+                inner = block[r0 - wr0:r1 - wr0, c0 - wc0:c1 - wc0]
+                if (reached & (inner == 1)).any():
+                    extent[r0:r1, c0:c1] = numpy.where(reached, 2, inner)
+                    changed = True
+
+    for r0, r1, c0, c1 in windows:
+        flooded = extent[r0:r1, c0:c1] == 2
+        extent[r0:r1, c0:c1] = flooded
+        depth[r0:r1, c0:c1][~flooded] = numpy.nan
+        wse[r0:r1, c0:c1][~flooded] = numpy.nan
+        if stats != None:
+            stats.add(depth[r0:r1, c0:c1], r0, c0)
+    return depth, wse, extent
+
+#Streaming statistics of a depth grid, fed one block at a time as the grid is produced: flooded cells, area,
+#maximum and mean depth, volume, and the maximum depth in each STATS_MILES bin of downstream distance.
+#A cell's distance is the Dist_DS (miles) of the nearest main stem point, looked up on a grid coarser by factor.
+#The reach of each threshold is the distance where the depth last drops below it.
+class FloodStats(object):
+    def __init__(self, grid, xs, ys, miles, factor=None, thresholds=DEPTH_THRESHOLDS):
+        shape = (grid.nrows, grid.ncols)
+        self.cellSize = grid.cellSize
+        self.factor = factor or max(4, int(math.ceil(max(shape)/2000.0)))
+        self.thresholds = thresholds
+        coarseShape = (-(-shape[0]//self.factor), -(-shape[1]//self.factor))
+        rows, cols, values = burnCells(coarseShape, grid.xmin, grid.ymax, grid.cellSize*self.factor, xs, ys, miles)
+        source = numpy.zeros(coarseShape, bool)
+        source[rows, cols] = True
+        mileGrid = numpy.full(coarseShape, numpy.nan, numpy.float32)
+        mileGrid[rows, cols] = values[0]
+        nearR, nearC = nearestSource(source)
+        self.miles = numpy.where(nearR >= 0, mileGrid[nearR, nearC], numpy.nan).astype(numpy.float32)
+        self.reset()
+
+    #Start over on the same distance grid, for the next scenario
+    def reset(self):
+        self.cells = 0
+        self.depthSum = 0.0
+        self.maxDepth = 0.0
+        self.binMax = numpy.zeros(0)
+
+    #Add the depth block whose top left cell is (r0, c0). NaN and dry cells are skipped.
+    def add(self, block, r0=0, c0=0):
+        block = numpy.asarray(block)
+        with numpy.errstate(invalid="ignore"):
+            rows, cols = numpy.nonzero(block > 0)
+        if len(rows) == 0:
+            return
+        depth = block[rows, cols].astype(numpy.float64)
+        self.cells += len(depth)
+        self.depthSum += depth.sum()
+        self.maxDepth = max(self.maxDepth, depth.max())
+        miles = self.miles[(rows + r0)//self.factor, (cols + c0)//self.factor]
+        found = numpy.isfinite(miles)
+        bins = (miles[found]/STATS_MILES).astype(numpy.int64)
+        if len(bins) == 0:
+            return
+        if bins.max() >= len(self.binMax):
+            self.binMax = numpy.concatenate((self.binMax, numpy.zeros(bins.max() + 1 - len(self.binMax))))
+        numpy.maximum.at(self.binMax, bins, depth[found])
+
+    #Summary row: FloodCells, Area and Volume (DEM units), MaxDepth, MeanDepth and Reach_<threshold> in miles
+    def summary(self):
+        cellArea = self.cellSize*self.cellSize
+        row = {"FloodCells": int(self.cells), "Area": float(self.cells*cellArea), "MaxDepth": float(self.maxDepth),
+               "MeanDepth": float(self.depthSum/self.cells) if self.cells else 0.0, "Volume": float(self.depthSum*cellArea)}
+        for threshold in self.thresholds:
+            deeper = numpy.nonzero(self.binMax >= threshold)[0]
+            row[reachField(threshold)] = float((deeper[-1] + 1)*STATS_MILES) if len(deeper) else 0.0
+        return row
+
+def reachField(threshold):
+    return "Reach_" + ("%g" %(threshold)).replace(".", "_")
+
+RasterGrid = namedtuple("RasterGrid", ["xmin", "ymax", "cellSize", "nrows", "ncols", "spatialReference"])
+
+#Origin, cell size and size of an ArcGIS raster
+def rasterGrid(raster):
+    import arcpy
+    raster = arcpy.Raster(raster)
+    return RasterGrid(raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth, raster.height, raster.width, raster.spatialReference)
+
+def lowerLeftOf(grid, r1, c0):
+    import arcpy
+    return arcpy.Point(grid.xmin + c0*grid.cellSize, grid.ymax - r1*grid.cellSize)
+
+#Windowed reader of an ArcGIS raster on a grid, NaN for NoData
+def rasterReader(raster, grid):
+    import arcpy
+    def read(r0, r1, c0, c1):
+        return arcpy.RasterToNumPyArray(raster, lowerLeftOf(grid, r1, c0), c1 - c0, r1 - r0, numpy.nan).astype(numpy.float32)
+    return read
+
+#Grid and float32 array of a raster. Over the budget, the array is read in tiles into a memory map in scratchDir.
+#read replaces the raster reader, for cells of the raster kept elsewhere (DemCache.gridReader).
+def readRaster(raster, budgetMB=None, scratchDir=None, name="dem", read=None):
+    grid = rasterGrid(raster)
+    shape = (grid.nrows, grid.ncols)
+    read = read or rasterReader(raster, grid)
+    if not budgetMB or fitsBudget(shape, budgetMB):
+        return grid, read(0, grid.nrows, 0, grid.ncols)
+    array = newArray(shape, numpy.float32, numpy.nan, scratchDir or tempfile.mkdtemp(), name)
+    for r0, r1, c0, c1 in tileWindows(shape, tileLayout(shape, budgetMB)[0]):
+        array[r0:r1, c0:c1] = read(r0, r1, c0, c1)
+    return grid, array
+
+def scratchGDB(scratchDir):
+    import arcpy
+    gdb = os.path.join(scratchDir, "floodTiles.gdb")
+    if not arcpy.Exists(gdb):
+        arcpy.CreateFileGDB_management(scratchDir, "floodTiles.gdb")
+    return gdb
+
+#Save an array on a grid as a raster. Over the budget it is written in tiles to a scratch GDB and mosaicked.
+#array can also be a reader read(r0, r1, c0, c1) (cellReader), so only one tile is built at a time.
+def saveGrid(array, grid, path, budgetMB=None, scratchDir=None, pixelType="32_BIT_FLOAT"):
+    import arcpy
+    read = array if callable(array) else lambda r0, r1, c0, c1: numpy.array(array[r0:r1, c0:c1])
+    nodata = 0 if pixelType == "8_BIT_UNSIGNED" else NODATA
+    shape = (grid.nrows, grid.ncols)
+    windows = [(0, grid.nrows, 0, grid.ncols)]
+    if budgetMB and not fitsBudget(shape, budgetMB):
+        windows = list(tileWindows(shape, tileLayout(shape, budgetMB)[0]))
+    tiles = []
+    outputCoordinateSystem = arcpy.env.outputCoordinateSystem
+    arcpy.env.outputCoordinateSystem = grid.spatialReference
+    try:
+        for r0, r1, c0, c1 in windows:
+            block = read(r0, r1, c0, c1)
+            if nodata == NODATA:
+                block = numpy.where(numpy.isnan(block), NODATA, block)
+            outRaster = arcpy.NumPyArrayToRaster(block, lowerLeftOf(grid, r1, c0), grid.cellSize, grid.cellSize, nodata)
+            if len(windows) == 1:
+                outRaster.save(path)
+                return
+            tiles.append(os.path.join(scratchGDB(scratchDir), "tile_%d_%d" %(r0, c0)))
+            outRaster.save(tiles[-1])
+    finally:
+        arcpy.env.outputCoordinateSystem = outputCoordinateSystem
+    arcpy.MosaicToNewRaster_management(";".join(tiles), os.path.dirname(path), os.path.basename(path), grid.spatialReference, pixelType, grid.cellSize, 1)
+    for tile in tiles:
+        arcpy.Delete_management(tile)
+
+#Polygon feature class of a flood extent array
+def savePolygon(extent, grid, path, budgetMB=None, scratchDir=None):
+    import arcpy
+    extentRaster = os.path.join(scratchGDB(scratchDir or tempfile.mkdtemp()), "floodExtent")
+    saveGrid(extent, grid, extentRaster, budgetMB, scratchDir, "8_BIT_UNSIGNED")
+    arcpy.RasterToPolygon_conversion(extentRaster, path, "NO_SIMPLIFY", "VALUE")
+    arcpy.Delete_management(extentRaster)
+
+#Add an ArcGIS depth raster to FloodStats, reading it in windows that fit the budget
+def rasterStats(stats, raster, budgetMB=None):
+    grid = rasterGrid(raster)
+    shape = (grid.nrows, grid.ncols)
+    read = rasterReader(raster, grid)
+    windows = [(0, grid.nrows, 0, grid.ncols)]
+    if budgetMB and not fitsBudget(shape, budgetMB):
+        windows = tileWindows(shape, tileLayout(shape, budgetMB)[0])
+    for r0, r1, c0, c1 in windows:
+        stats.add(read(r0, r1, c0, c1), r0, c0)
+
+#Run the engine on ArcGIS rasters. Saves wselayers, fdlayers and the FPPolyLayers polygon in outGDB.
+#DEMs larger than budgetMB are read, flooded and written in tiles, with the arrays kept in scratchDir.
+#A FloodStats given as stats is fed the depth grid as it is flooded, tile by tile when tiled.
+def floodFromRasters(lineRaster, dem, outGDB, budgetMB=None, scratchDir=None, stats=None):
+    grid = rasterGrid(dem)
+    return floodAndSave(grid, rasterReader(dem, grid), rasterReader(lineRaster, grid), outGDB, budgetMB, scratchDir, stats)
+
+#floodFromRasters with the stream WSE as cells of the DEM grid (burnCells), so no line raster is written.
+#readDem replaces the DEM raster reader as in readRaster.
+def floodFromCells(rows, cols, values, dem, outGDB, budgetMB=None, scratchDir=None, stats=None, readDem=None):
+    grid = rasterGrid(dem)
+    return floodAndSave(grid, readDem or rasterReader(dem, grid), cellReader(rows, cols, values), outGDB, budgetMB, scratchDir, stats)
+
+def floodAndSave(grid, readDem, readLine, outGDB, budgetMB=None, scratchDir=None, stats=None):
+    shape = (grid.nrows, grid.ncols)
+    scratchDir = scratchDir or tempfile.mkdtemp()
+    if budgetMB and not fitsBudget(shape, budgetMB):
+        depth, wse, extent = floodTiled(readDem, readLine, shape, scratchDir, budgetMB, stats)
+    else:
+        demArray = readDem(0, grid.nrows, 0, grid.ncols)
+        lineArray = readLine(0, grid.nrows, 0, grid.ncols)
+        depth, wse, extent = floodFromStreamWSE(demArray, lineArray)
+        del demArray, lineArray
+        if stats != None:
+            stats.add(depth)
+
+    saveGrid(wse, grid, os.path.join(outGDB, "wselayers"), budgetMB, scratchDir)
+    saveGrid(depth, grid, os.path.join(outGDB, "fdlayers"), budgetMB, scratchDir)
+    savePolygon(extent, grid, os.path.join(outGDB, "FPPolyLayers"), budgetMB, scratchDir)
+    return int(extent.sum())
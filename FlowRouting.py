@@ -0,0 +1,167 @@
+# ------------------------------------------------------------------------------
+# Name: Flow Routing
+# Desc: DEM-derived D8 flow paths, an alternative to tracing the NHD stream topology.
+#     Flow direction is computed once for the regional DEM cache (Fill and FlowDirection from Spatial Analyst)
+#     and stored as uint8 tiles next to it, with ESRI direction codes. A dam's flow path is then a walk
+#     down the direction grid from the dam point, reading only the tiles it passes through.
+#     fillDepressions and d8FlowDirection are NumPy versions for small grids and runs without arcpy.
+# ------------------------------------------------------------------------------
+from __future__ import division
+import os, json, heapq
+from math import floor, hypot, sqrt
+import numpy
+from DemCache import DemCache, INDEX_FILE, NODATA, writeIndex
+
+FLOWDIR_FOLDER = "flowdir"
+
+#ESRI D8 codes and their (row, column) steps
+D8_STEPS = {1: (0, 1), 2: (1, 1), 4: (1, 0), 8: (1, -1), 16: (0, -1), 32: (-1, -1), 64: (-1, 0), 128: (-1, 1)}
+
+#Priority-flood depression filling. Every filled cell is raised epsilon above the cell it drains to,
+#so flats drain and d8FlowDirection finds a downhill neighbour everywhere. NaN is NoData.
+def fillDepressions(dem, epsilon=1e-4):
+    filled = numpy.array(dem, numpy.float64)
+    nr, nc = filled.shape
+    nodata = numpy.isnan(filled)
+    closed = nodata.copy()
+    #Seed the grid edge and cells next to NoData, which drain out of the grid
+    seeds = numpy.zeros(filled.shape, bool)
+    seeds[0, :] = seeds[-1, :] = seeds[:, 0] = seeds[:, -1] = True
+    for dr, dc in D8_STEPS.values():
+        shifted = numpy.zeros(filled.shape, bool)
+        shifted[max(0, -dr):nr - max(0, dr), max(0, -dc):nc - max(0, dc)] = nodata[max(0, dr):nr - max(0, -dr), max(0, dc):nc - max(0, -dc)]
+        seeds |= shifted
+    seeds &= ~nodata
+    heap = [(filled[r, c], r, c) for r, c in zip(*numpy.nonzero(seeds))]
+    heapq.heapify(heap)
+    closed |= seeds
+    steps = list(D8_STEPS.values())
+    while heap:
+        z, r, c = heapq.heappop(heap)
+        for dr, dc in steps:
+            rr, cc = r + dr, c + dc
+            if 0 <= rr < nr and 0 <= cc < nc and not closed[rr, cc]:
+                closed[rr, cc] = True
+                if filled[rr, cc] <= z:
+                    filled[rr, cc] = z + epsilon
+                heapq.heappush(heap, (filled[rr, cc], rr, cc))
+    return filled
+
+#Steepest descent D8 codes of a (filled) DEM. Cells without a lower neighbour get 0.
+def d8FlowDirection(dem, cellSize=1.0):
+    dem = numpy.asarray(dem, numpy.float64)
+    nr, nc = dem.shape
+    padded = numpy.pad(dem, 1, "constant", constant_values=numpy.nan)
+    best = numpy.zeros(dem.shape)
+    codes = numpy.zeros(dem.shape, numpy.uint8)
+    for code, (dr, dc) in sorted(D8_STEPS.items()):
+        neighbour = padded[1 + dr:1 + dr + nr, 1 + dc:1 + dc + nc]
+        with numpy.errstate(invalid="ignore"):
+            slope = (dem - neighbour)/(cellSize*sqrt(dr*dr + dc*dc))
+            steeper = slope > best
+        best = numpy.where(steeper, slope, best)
+        codes[steeper] = code
+    return codes
+
+#Walk D8 codes from a point until maxDistance is covered, the grid ends or a cell has no direction.
+#codeAt(row, col) returns the code of a cell (0 off the grid). Returns the path XY, starting at the point, and its length.
+def traceCodes(codeAt, x, y, xmin, ymax, cellSize, maxDistance):
+    row = int(floor((ymax - y)/cellSize))
+    col = int(floor((x - xmin)/cellSize))
+    xs, ys = [x], [y]
+    distance = 0.0
+    seen = set()
+    while distance < maxDistance and (row, col) not in seen:
+        step = D8_STEPS.get(codeAt(row, col))
+        if step == None:
+            break
+        seen.add((row, col))
+        row += step[0]
+        col += step[1]
+        cx, cy = xmin + (col + 0.5)*cellSize, ymax - (row + 0.5)*cellSize
+        distance += hypot(cx - xs[-1], cy - ys[-1])
+        xs.append(cx)
+        ys.append(cy)
+    return xs, ys, distance
+
+#Code lookup into an in-memory direction grid
+def arrayCodes(codes):
+    nr, nc = codes.shape
+    return lambda row, col: int(codes[row, col]) if 0 <= row < nr and 0 <= col < nc else 0
+
+#Tiled flow direction grid on the DEM cache grid
+class FlowDirCache(DemCache):
+    def __init__(self, cacheDir):
+        DemCache.__init__(self, cacheDir)
+        self.loaded = {}
+
+    def codeAt(self, row, col):
+        if row < 0 or col < 0 or row >= self.nrows or col >= self.ncols:
+            return 0
+        key = (row//self.tileSize, col//self.tileSize)
+        if key not in self.tiles:
+            return 0
+        tile = self.loaded.get(key)
+        if tile is None:
+            tile = self.loaded[key] = numpy.load(self.tilePath(*key), mmap_mode="r")
+        return int(tile[row - key[0]*self.tileSize, col - key[1]*self.tileSize])
+
+    #Flow path XY from a point and its length, at least maxDistance long unless the grid ends first
+    def trace(self, x, y, maxDistance):
+        return traceCodes(self.codeAt, x, y, self.xmin, self.ymax, self.cellSize, maxDistance)
+
+def flowDirFolder(demCacheDir):
+    return os.path.join(demCacheDir, FLOWDIR_FOLDER)
+
+#Build the flow direction tiles for a DEM cache, unless they are current with the cache's sources
+def buildFlowDirCache(demCache):
+    import arcpy
+    from arcpy.sa import Fill, FlowDirection
+    cacheDir = flowDirFolder(demCache.cacheDir)
+    indexPath = os.path.join(cacheDir, INDEX_FILE)
+    if os.path.exists(indexPath):
+        with open(indexPath) as f:
+            if json.load(f).get("sources") == demCache.index["sources"]:
+                return FlowDirCache(cacheDir)
+        os.remove(indexPath)
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+
+    #Put the regional DEM back together from the cache tiles
+    scratchGDB = os.path.join(cacheDir, "flowdir.gdb")
+    if not arcpy.Exists(scratchGDB):
+        arcpy.CreateFileGDB_management(cacheDir, "flowdir.gdb")
+    spatialReference = arcpy.SpatialReference()
+    spatialReference.loadFromString(demCache.index["spatialReference"])
+    cellSize, size = demCache.cellSize, demCache.tileSize
+    demTiles = []
+    outputCoordinateSystem = arcpy.env.outputCoordinateSystem
+    arcpy.env.outputCoordinateSystem = spatialReference
+    try:
+        for tileRow, tileCol in sorted(demCache.tiles):
+            block = numpy.load(demCache.tilePath(tileRow, tileCol))
+            lowerLeft = arcpy.Point(demCache.xmin + tileCol*size*cellSize, demCache.ymax - (tileRow*size + block.shape[0])*cellSize)
+            demTiles.append(os.path.join(scratchGDB, "dem_%d_%d" %(tileRow, tileCol)))
+            arcpy.NumPyArrayToRaster(numpy.where(numpy.isnan(block), NODATA, block), lowerLeft, cellSize, cellSize, NODATA).save(demTiles[-1])
+    finally:
+        arcpy.env.outputCoordinateSystem = outputCoordinateSystem
+    arcpy.MosaicToNewRaster_management(";".join(demTiles), scratchGDB, "regionDEM", spatialReference, "32_BIT_FLOAT", cellSize, 1)
+    flowDir = FlowDirection(Fill(os.path.join(scratchGDB, "regionDEM")), "NORMAL")
+    flowDir.save(os.path.join(scratchGDB, "flowDir"))
+
+    #Cut the directions into tiles on the DEM cache grid
+    tiles = []
+    for tileRow in range(0, -(-demCache.nrows//size)):
+        for tileCol in range(0, -(-demCache.ncols//size)):
+            rows = min(size, demCache.nrows - tileRow*size)
+            cols = min(size, demCache.ncols - tileCol*size)
+            lowerLeft = arcpy.Point(demCache.xmin + tileCol*size*cellSize, demCache.ymax - (tileRow*size + rows)*cellSize)
+            block = arcpy.RasterToNumPyArray(flowDir, lowerLeft, cols, rows, 0).astype(numpy.uint8)
+            if block.any():
+                numpy.save(os.path.join(cacheDir, "tile_%d_%d.npy" %(tileRow, tileCol)), block)
+                tiles.append([tileRow, tileCol])
+    writeIndex(cacheDir, demCache.xmin, demCache.ymax, cellSize, demCache.nrows, demCache.ncols, size, tiles,
+               demCache.index["spatialReference"], demCache.index["sources"])
+    del flowDir
+    arcpy.Delete_management(scratchGDB)
+    return FlowDirCache(cacheDir)
@@ -0,0 +1,100 @@
+# ------------------------------------------------------------------------------
+# Name: Manifest
+# Desc: Per-dam manifest of input fingerprints, stored next to the dam GDB as <DamID>.manifest.json.
+#     Each step records a fingerprint of its inputs when a dam finishes. A rerun skips dams whose
+#     fingerprint has not changed. A stage's record is cleared before the stage starts, so a dam that
+#     was interrupted is redone and an interrupted batch resumes where it stopped.
+#     Stage fingerprints include the fingerprint of the stage before, so a redone setup also redoes
+#     the flow path and flood polygon for that dam. The topology entry holds the geometry fingerprint of
+#     splitStreams when its nodes were last assigned.
+# ------------------------------------------------------------------------------
+import os, json, hashlib
+
+STAGES = ("setup", "topology", "flowpath", "flood")
+
+def manifestPath(gdb):
+    return os.path.splitext(gdb)[0] + ".manifest.json"
+
+def loadManifest(gdb):
+    try:
+        with open(manifestPath(gdb)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def saveManifest(gdb, manifest):
+    path = manifestPath(gdb)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + ".tmp", path)
+
+#MD5 of any JSON-serializable values
+def fingerprint(*values):
+    return hashlib.md5(json.dumps(values, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+#Fingerprint recorded for a stage, or None
+def stagePrint(gdb, stage):
+    entry = loadManifest(gdb).get(stage)
+    return entry["print"] if entry else None
+
+#Result stored with a stage if its recorded fingerprint matches, otherwise None
+def currentStage(gdb, stage, stamp):
+    entry = loadManifest(gdb).get(stage)
+    if entry and entry["print"] == stamp:
+        return entry
+    return None
+
+#Forget a stage and the stages after it before it is (re)run
+def clearStage(gdb, stage):
+    manifest = loadManifest(gdb)
+    for later in STAGES[STAGES.index(stage):]:
+        manifest.pop(later, None)
+    saveManifest(gdb, manifest)
+
+def markDone(gdb, stage, stamp, result=None):
+    manifest = loadManifest(gdb)
+    manifest[stage] = {"print": stamp, "result": result}
+    saveManifest(gdb, manifest)
+
+#Modification stamp of source files or GDB folders
+def pathStamp(paths):
+    return [[path, int(os.path.getmtime(path)) if os.path.exists(path) else 0] for path in sorted(paths)]
+
+#Content stamp of source GDB folders: the name, size and modification time of every file in them, so a
+#rewritten raster changes the stamp even when the folder's own modification time does not
+def contentStamp(paths):
+    stamps = []
+    for path in sorted(paths):
+        files = []
+        for folder, dirs, names in os.walk(path):
+            for name in names:
+                info = os.stat(os.path.join(folder, name))
+                files.append([os.path.relpath(os.path.join(folder, name), path), info.st_size, int(info.st_mtime)])
+        stamps.append([path, fingerprint(sorted(files)) if files else None])
+    return stamps
+
+#Fingerprint of the rows of a table, read in ObjectID order
+def tableFingerprint(table, fields):
+    import arcpy
+    digest = hashlib.md5()
+    with arcpy.da.SearchCursor(table, fields, sql_clause=(None, "ORDER BY OBJECTID")) as rows:
+        for row in rows:
+            digest.update(repr([bytes(v) if isinstance(v, bytearray) else v for v in row]).encode("utf-8"))
+    return digest.hexdigest()
+
+#Dam attributes and location that the steps depend on
+def damFingerprint(damFC):
+    return tableFingerprint(damFC, ["DamID", "Dam_height", "Surface_area", "SHAPE@XY"])
+
+#Extent, grid and, for a raster stored as a file, modification time of a raster. Cell values are not read;
+#a changed DEM source reaches the later stages through the setup stamp they chain to.
+def rasterFingerprint(raster):
+    import arcpy
+    if not arcpy.Exists(raster):
+        return None
+    desc = arcpy.Describe(raster)
+    extent = desc.extent
+    return fingerprint(extent.XMin, extent.YMin, extent.XMax, extent.YMax, desc.meanCellWidth, desc.width, desc.height,
+                       pathStamp([desc.catalogPath]))
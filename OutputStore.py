@@ -0,0 +1,120 @@
+# ------------------------------------------------------------------------------
+# Name: Output Store
+# Desc: Consolidated output for Step3. Instead of a _Raw and _Final feature class per dam, every dam's flood
+#     extent is appended as one dissolved feature to FloodExtents, keyed by FloodName (DamID or DamID_Scenario),
+#     DamID, Scenario and RunID, with attribute indexes on the keys. Depth grids are copied as LZW-compressed,
+#     tiled GeoTIFFs into a <OutputGDB>_Depths folder and registered in the FloodDepths mosaic dataset.
+#     Rerunning a dam in the same run replaces its rows, other runs are kept.
+#     Only the main process writes to the store; parallel workers stage their outputs in the dam GDB.
+#     The FloodStats table holds one row of flood statistics (FloodEngine.FloodStats) per flood polygon,
+#     in either output mode, replaced when the dam is flooded again.
+# ------------------------------------------------------------------------------
+import os, time
+from FloodEngine import DEPTH_THRESHOLDS, reachField
+
+EXTENTS = "FloodExtents"
+DEPTHS = "FloodDepths"
+STATS = "FloodStats"
+KEY_FIELDS = [("FloodName", 100), ("DamID", 50), ("Scenario", 50), ("RunID", 50)]
+STATS_FIELDS = [("FloodCells", "LONG"), ("Area", "DOUBLE"), ("MaxDepth", "DOUBLE"), ("MeanDepth", "DOUBLE"), ("Volume", "DOUBLE")] + \
+               [(reachField(threshold), "DOUBLE") for threshold in DEPTH_THRESHOLDS]
+
+#Run ID from the start time of a run
+def runStamp():
+    return time.strftime("%Y%m%d_%H%M%S")
+
+#Quoted SQL string literal, embedded quotes doubled so a name like O'Neal_Dam does not end the string
+def sqlString(value):
+    return "'%s'" %(value.replace("'", "''"))
+
+def keyWhere(name, runID=None):
+    where = "FloodName = %s" %(sqlString(name))
+    if runID != None:
+        where += " AND RunID = %s" %(sqlString(runID))
+    return where
+
+#Whether a flood extent is in the store of an output GDB, from any run
+def isStored(outGDB, name):
+    import arcpy
+    extents = os.path.join(outGDB, EXTENTS)
+    if not arcpy.Exists(extents):
+        return False
+    with arcpy.da.SearchCursor(extents, ["OID@"], keyWhere(name)) as rows:
+        for row in rows:
+            return True
+    return False
+
+class OutputStore(object):
+    def __init__(self, outGDB, runID, spatialReference):
+        import arcpy
+        self.outGDB = outGDB
+        self.runID = runID
+        self.extents = os.path.join(outGDB, EXTENTS)
+        self.depths = os.path.join(outGDB, DEPTHS)
+        self.rasterFolder = os.path.splitext(outGDB)[0] + "_Depths"
+        if not os.path.exists(self.rasterFolder):
+            os.makedirs(self.rasterFolder)
+        if not arcpy.Exists(self.extents):
+            arcpy.CreateFeatureclass_management(outGDB, EXTENTS, "POLYGON", "", "", "", spatialReference)
+            for field, length in KEY_FIELDS:
+                arcpy.AddField_management(self.extents, field, "TEXT", "", "", length)
+            for field, length in KEY_FIELDS:
+                arcpy.AddIndex_management(self.extents, field, field + "_idx")
+        if not arcpy.Exists(self.depths):
+            arcpy.CreateMosaicDataset_management(outGDB, DEPTHS, spatialReference, 1, "32_BIT_FLOAT")
+            for field, length in KEY_FIELDS:
+                arcpy.AddField_management(self.depths, field, "TEXT", "", "", length)
+
+    #Append a dam's flood polygons as one dissolved feature
+    def addExtent(self, name, damID, scenario, polygons):
+        import arcpy
+        with arcpy.da.UpdateCursor(self.extents, ["OID@"], keyWhere(name, self.runID)) as rows:
+            for row in rows:
+                rows.deleteRow()
+        dissolved = r"in_memory\floodExtent"
+        arcpy.Dissolve_management(polygons, dissolved)
+        with arcpy.da.SearchCursor(dissolved, ["SHAPE@"]) as sCursor:
+            with arcpy.da.InsertCursor(self.extents, ["SHAPE@"] + [field for field, length in KEY_FIELDS]) as iCursor:
+                for row in sCursor:
+                    iCursor.insertRow([row[0], name, damID, scenario, self.runID])
+        del sCursor, iCursor
+        arcpy.Delete_management(dissolved)
+
+    #Copy a depth grid into the raster folder as a compressed, tiled GeoTIFF and add it to the mosaic dataset
+    def addDepth(self, name, damID, scenario, raster):
+        import arcpy
+        tif = os.path.join(self.rasterFolder, "%s_%s.tif" %(name, self.runID))
+        arcpy.RemoveRastersFromMosaicDataset_management(self.depths, keyWhere(name, self.runID))
+        compression, tileSize = arcpy.env.compression, arcpy.env.tileSize
+        arcpy.env.compression = "LZW"
+        arcpy.env.tileSize = "256 256"
+        try:
+            arcpy.CopyRaster_management(raster, tif)
+        finally:
+            arcpy.env.compression, arcpy.env.tileSize = compression, tileSize
+        arcpy.AddRastersToMosaicDataset_management(self.depths, "Raster Dataset", tif, "UPDATE_CELL_SIZES", "UPDATE_BOUNDARY", "NO_OVERVIEWS",
+                                                   "#", "#", "#", "#", "#", "NO_SUBFOLDERS", "OVERWRITE_DUPLICATES")
+        with arcpy.da.UpdateCursor(self.depths, ["Name"] + [field for field, length in KEY_FIELDS], "Name = %s" %(sqlString(os.path.splitext(os.path.basename(tif))[0]))) as rows:
+            for row in rows:
+                rows.updateRow([row[0], name, damID, scenario, self.runID])
+
+#Replace the FloodStats rows of the given flood polygons. Each row is a dict with FloodName, DamID, Scenario and the STATS_FIELDS.
+def writeFloodStats(outGDB, rows):
+    import arcpy
+    table = os.path.join(outGDB, STATS)
+    if not arcpy.Exists(table):
+        arcpy.CreateTable_management(outGDB, STATS)
+        for field, length in KEY_FIELDS[:3]:
+            arcpy.AddField_management(table, field, "TEXT", "", "", length)
+        for field, fieldType in STATS_FIELDS:
+            arcpy.AddField_management(table, field, fieldType)
+        arcpy.AddIndex_management(table, "DamID", "DamID_idx")
+    fields = [field for field, length in KEY_FIELDS[:3]] + [field for field, fieldType in STATS_FIELDS]
+    for row in rows:
+        with arcpy.da.UpdateCursor(table, ["OID@"], keyWhere(row["FloodName"])) as cursor:
+            for old in cursor:
+                cursor.deleteRow()
+    with arcpy.da.InsertCursor(table, fields) as cursor:
+        for row in rows:
+            cursor.insertRow([row.get(field) for field in fields])
+    del cursor
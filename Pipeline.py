@@ -0,0 +1,220 @@
+# ------------------------------------------------------------------------------
+# Name: Dam Pipeline
+# Desc: Runs Setup, Create Flow Path and Create Flood Polygon end to end for the dams of a county.
+#     A worker opens arcpy, the extensions and the shared handles (DEM cache, regional stream store,
+#     county index) once and then takes dams from a work queue until it is empty, so each dam GDB is
+#     set up, traced and flooded in one pass instead of being reopened by three toolbox scripts.
+#     With one worker the tool process is the worker. With more, each worker is a long-lived process with
+#     its own stream store GDB in Scratch, and the flood polygons are staged in the dam GDBs and published
+#     (or appended to the output store) by this process as dams finish. A worker process that dies while
+#     running a dam (a crash in arcpy, out of memory) fails that dam and the others carry on.
+#     Parameters are the Setup parameters followed by the flow path and flood polygon settings, see Parameters.txt.
+# ------------------------------------------------------------------------------
+
+#The shared handles of a worker and the three steps for one dam
+class PipelineWorker(object):
+    def __init__(self, settings, storeGDB=None, setup=None):
+        self.settings = settings
+        self.setup = setup or CountySetup(settings.gdb, settings.county, settings.demFolder, settings.hydFolder, settings.cacheFolder, storeGDB)
+
+    #Setup, flow path and flood polygon of one dam. Returns (flooded, flagged), flagged if the flow path needs review.
+    def runDam(self, damRow, nearCounties):
+        settings = self.settings
+        damID = damRow[0]
+        gdb = self.setup.damWorkspace(damID)
+        self.setup.setupDam(damRow, nearCounties, settings.force)
+        if not arcpy.Exists(os.path.join(gdb, "splitStreams")):
+            arcpy.AddWarning("%s has no splitStreams, flow path and flood polygon skipped" %(damID))
+            return False, False
+
+        flagged = flowPathStep.runDam(gdb, settings.force, settings.flowEngine, settings.cacheFolder)
+        if not arcpy.Exists(os.path.join(gdb, "flowPath")):
+            arcpy.AddWarning("%s has no flowPath, flood polygon skipped" %(damID))
+            return False, flagged
+
+        if len(settings.scenarios)>0:
+            flooded = floodStep.runScenarios(gdb, settings.outWorkspace, settings.spacing, settings.scenarios, settings.budgetMB,
+                                             settings.force, settings.stage, settings.keepRaw, settings.tolerance, settings.maxSpacing, settings.method,
+                                             settings.cacheFolder or None)
+        else:
+            flooded = floodStep.runDam(gdb, settings.outWorkspace, settings.spacing, settings.floodEngine, settings.budgetMB,
+                                       settings.force, settings.stage, settings.keepRaw, settings.tolerance, settings.maxSpacing, settings.method,
+                                       settings.cacheFolder or None)
+        return flooded, flagged
+
+#Run dams from the tasks queue until the None sentinel. (workerID, DamID) goes on the started queue before
+#each dam and its DamResult on the results queue after it.
+def runQueue(worker, workerID, tasks, started, results):
+    for damRow, nearCounties in iter(tasks.get, None):
+        started.put((workerID, damRow[0]))
+        status, value, messages = callCaptured(worker.runDam, (damRow, nearCounties))
+        results.put(DamResult(worker.setup.damWorkspace(damRow[0]), status, value, messages))
+
+#Worker process. If the handles cannot be opened, every dam it takes fails with that error.
+def workerMain(settings, storeGDB, workerID, tasks, started, results):
+    initWorker()
+    status, worker, messages = callCaptured(PipelineWorker, (settings, storeGDB))
+    if status == "ok":
+        runQueue(worker, workerID, tasks, started, results)
+        return
+    for damRow, nearCounties in iter(tasks.get, None):
+        results.put(DamResult(os.path.join(os.path.dirname(settings.gdb), damRow[0] + ".gdb"), "failed", None, messages))
+
+#Everything on a multiprocessing queue right now
+def drainQueue(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Queue.Empty:
+            return items
+
+#Publishes staged flood polygons and the flood statistics of each dam from the main process.
+#The output store is opened with the first dam's DEM.
+class Publisher(object):
+    def __init__(self, outWorkspace, outputMode, runID):
+        self.outWorkspace = outWorkspace
+        self.outputMode = outputMode
+        self.runID = runID
+        self.store = None
+
+    def publish(self, gdb, staged=True):
+        if staged:
+            if self.outputMode == "Store" and self.store == None:
+                self.store = OutputStore(self.outWorkspace, self.runID, arcpy.Describe(os.path.join(gdb, "clipDEM")).spatialReference)
+            floodStep.publishFloodPolygon(gdb, os.path.basename(gdb).split('.')[0], self.outWorkspace, self.store)
+        floodStep.publishFloodStats(gdb, self.outWorkspace)
+
+#Add a dam's result and publish its flood polygon if it was flooded
+def finishDam(result, results, total, publisher, staged=True):
+    results.append(result)
+    arcpy.AddMessage("Finished %s (%s) %d of %d" %(damName(result.gdb), result.status, len(results), total))
+    if result.status == "ok" and result.value[0]:
+        publisher.publish(result.gdb, staged)
+
+#Feed the dams to the workers and collect a DamResult per dam, publishing staged polygons as dams finish.
+#While waiting for results the workers are checked every POLL_SECONDS; the dam a dead worker was running
+#is failed, and if no worker is left the dams still queued are failed too.
+#A single worker runs in this process with the handles of setup, one dam at a time.
+def runPipeline(settings, dams, workers, publisher, setup):
+    results = []
+    if workers>1:
+        useStandaloneInterpreter()
+        tasks, started, done = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Queue()
+        scratchFolder = os.path.join(os.path.dirname(settings.gdb), "Scratch")
+        if not os.path.exists(scratchFolder):
+            os.makedirs(scratchFolder)
+        processes = [multiprocessing.Process(target=workerMain, args=(settings, os.path.join(scratchFolder, "worker%d.gdb" %(i)), i, tasks, started, done))
+                     for i in range(min(workers, len(dams)))]
+        for process in processes:
+            process.start()
+        for dam in dams:
+            tasks.put(dam)
+        for process in processes:
+            tasks.put(None)
+        pending = set([damRow[0] for damRow, nearCounties in dams])
+        holding = {}        #workerID: DamID of the dam it last started
+        try:
+            while len(pending) > 0:
+                try:
+                    finished = [done.get(timeout=POLL_SECONDS)]
+                except Queue.Empty:
+                    finished = []
+                for workerID, damID in drainQueue(started):
+                    holding[workerID] = damID
+                dead = [i for i, process in enumerate(processes) if not process.is_alive()]
+                if len(dead) > 0:
+                    finished.extend(drainQueue(done))       #results a worker put just before it exited
+                for result in finished:
+                    pending.discard(damName(result.gdb))
+                    finishDam(result, results, len(dams), publisher)
+
+                for i in dead:
+                    damID = holding.pop(i, None)
+                    if damID in pending:
+                        pending.discard(damID)
+                        message = "The worker process running %s exited with code %s" %(damID, processes[i].exitcode)
+                        finishDam(DamResult(setup.damWorkspace(damID), "failed", None, [("error", message)]), results, len(dams), publisher)
+                if len(dead) == len(processes):
+                    for damID in sorted(pending):
+                        message = "%s was not run, no worker process is left" %(damID)
+                        finishDam(DamResult(setup.damWorkspace(damID), "failed", None, [("error", message)]), results, len(dams), publisher)
+                    pending = set()
+        finally:
+            for process in processes:
+                process.join()
+    else:
+        worker = PipelineWorker(settings, setup=setup)
+        for damRow, nearCounties in dams:
+            status, value, messages = callCaptured(worker.runDam, (damRow, nearCounties), False)
+            finishDam(DamResult(setup.damWorkspace(damRow[0]), status, value, messages), results, len(dams), publisher, settings.stage)
+    return results
+
+#---------------------------------------------------------------------------------
+import arcpy, os, sys, time, multiprocessing
+from collections import namedtuple
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+from BatchDriver import DamResult, callCaptured, initWorker, useStandaloneInterpreter, workerCount, damName, reportSummary
+from Step1_SetupGDB import CountySetup
+import Step2_CreateFlowPath as flowPathStep
+import Step3_CreateFloodPolygon as floodStep
+from FlowRouting import buildFlowDirCache
+from OutputStore import OutputStore, runStamp
+from WSEProfile import parseScenarios
+from RunLog import reportRunLog
+arcpy.env.overwriteOutput = True
+
+POLL_SECONDS = 10       #how often the main process checks that its workers are alive while waiting for results
+
+Settings = namedtuple("Settings", ["gdb", "county", "demFolder", "hydFolder", "cacheFolder", "force", "flowEngine",
+                                   "outWorkspace", "spacing", "floodEngine", "budgetMB", "scenarios", "stage", "keepRaw",
+                                   "tolerance", "maxSpacing", "method"])
+
+if __name__ == '__main__':
+    gdb = arcpy.GetParameterAsText(0)           #set county.gdb location, e.g. C:\Project\Oconee.gdb
+    county = arcpy.GetParameterAsText(1)        #set county using dropdown
+    demFolder = arcpy.GetParameterAsText(2)     #folder containing DEM geodatabases (not the gdb itself)
+    hydFolder = arcpy.GetParameterAsText(3)     #folder containing hydrology geodatabases (not the gdb itself)
+    limitBy = arcpy.GetParameterAsText(4)       #list the dams to be include by DamID
+    cacheFolder = arcpy.GetParameterAsText(5)   #optional folder for the regional DEM cache
+    force = arcpy.GetParameterAsText(6).lower() == "true"   #rerun dams even if their inputs are unchanged
+    flowEngine = arcpy.GetParameterAsText(7) or "Vector"    #flow path engine, Vector, D8 or Auto
+    outWorkspace = arcpy.GetParameterAsText(8)              #GDB where resulting flood polygons will be saved
+    spacing = int(arcpy.GetParameterAsText(9))              #set point spacing, smaller spacing gives more detail
+    floodEngine = arcpy.GetParameterAsText(10) or "ArcHydro"    #flood engine, ArcHydro or NumPy
+    budgetMB = float(arcpy.GetParameterAsText(11) or 2048)      #memory budget of the NumPy engine per dam, in MB
+    scenarios = parseScenarios(arcpy.GetParameterAsText(12))    #optional wave model scenarios, flooded with the NumPy engine
+    outputMode = arcpy.GetParameterAsText(13) or "Separate"     #Separate feature classes per dam, or one output Store
+    workers = workerCount(arcpy.GetParameterAsText(14))         #number of worker processes
+    tolerance = arcpy.GetParameterAsText(15)                    #optional vertical tolerance for adaptive point sampling
+    tolerance = float(tolerance) if tolerance != "" else None
+    maxSpacing = float(arcpy.GetParameterAsText(16) or 10*spacing)  #largest gap between adaptive points
+    method = arcpy.GetParameterAsText(17) or "Nearest"          #ground sampling at the WSE points, Nearest or Bilinear
+    batchStart = time.time()
+    if flowEngine not in ("Vector", "D8", "Auto"):
+        arcpy.AddError("Unknown flow path engine " + flowEngine + ", use Vector, D8 or Auto.")
+        sys.exit(1)
+    if flowEngine != "Vector" and not cacheFolder:
+        arcpy.AddError("The " + flowEngine + " engine needs a folder for the DEM cache (Parameter[5]).")
+        sys.exit(1)
+
+    #The main process reads the dam list and builds the DEM and flow direction caches the workers share
+    setup = CountySetup(gdb, county, demFolder, hydFolder, cacheFolder)
+    dams = setup.damRows(limitBy)
+    arcpy.AddMessage([damRow[0] for damRow, nearCounties in dams])
+    if flowEngine != "Vector":
+        buildFlowDirCache(setup.demCache)
+
+    stage = workers>1 or outputMode == "Store"
+    settings = Settings(gdb, county, demFolder, hydFolder, cacheFolder, force, flowEngine, outWorkspace, spacing, floodEngine,
+                        budgetMB, scenarios, stage, outputMode != "Store", tolerance, maxSpacing, method)
+    results = runPipeline(settings, dams, workers, Publisher(outWorkspace, outputMode, runStamp()), setup)
+    reportSummary(results)
+    reportRunLog([result.gdb for result in results], batchStart)
+
+    fpList = [damName(result.gdb) for result in results if result.status == "ok" and result.value[1]]
+    if len(fpList)>0:
+        arcpy.AddWarning("The following flowPaths are shorter than 5 miles or contain multiple lines: " + ", ".join(fpList))
@@ -0,0 +1,133 @@
+# ------------------------------------------------------------------------------
+# Name: Run Log
+# Desc: Per-dam, per-stage instrumentation. Each stage of a step runs inside RunLog.stage(), which records
+#     wall time, memory, any counts the step adds (raster size, points, lines) and the real exception.
+#     Records are appended as JSON lines to <DamID>.runlog.jsonl next to the dam GDB, so parallel workers
+#     never share a file. reportRunLog reads the records of a batch back and prints one summary table.
+# ------------------------------------------------------------------------------
+from __future__ import division
+import os, sys, json, time, traceback
+from contextlib import contextmanager
+
+clock = getattr(time, "perf_counter", time.time)
+
+def logPath(gdb):
+    return os.path.splitext(gdb)[0] + ".runlog.jsonl"
+
+#Current and peak memory of this process in MB. Peak is for the life of the process, not the stage.
+def memoryMB():
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize/1048576.0, counters.PeakWorkingSetSize/1048576.0
+        return None, None
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak/1048576.0 if sys.platform == "darwin" else peak/1024.0      #bytes on macOS, KB on Linux
+    current = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/1048576.0
+    except (IOError, OSError, ValueError):
+        pass
+    return current, peak
+
+class RunLog(object):
+    def __init__(self, gdb, tool):
+        self.path = logPath(gdb)
+        self.damID = os.path.basename(gdb).split('.')[0]
+        self.tool = tool
+
+    #Time a stage. The block can add counts to the yielded dict. Exceptions are logged and raised again.
+    @contextmanager
+    def stage(self, name):
+        info = {}
+        start = clock()
+        try:
+            yield info
+        except Exception:
+            self.write(name, clock() - start, "failed", info, traceback.format_exc())
+            raise
+        self.write(name, clock() - start, "ok", info, None)
+
+    def write(self, name, seconds, status, info, error):
+        current, peak = memoryMB()
+        record = {"dam": self.damID, "tool": self.tool, "stage": name, "status": status, "seconds": round(seconds, 3),
+                  "memMB": current and round(current, 1), "peakMB": peak and round(peak, 1), "time": time.time(), "error": error}
+        for key, value in info.items():
+            record.setdefault(key, value)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+#Rows and columns of a raster
+def rasterSize(raster):
+    import arcpy
+    desc = arcpy.Describe(raster)
+    return [desc.height, desc.width]
+
+def featureCount(fc):
+    import arcpy
+    return int(arcpy.GetCount_management(fc).getOutput(0))
+
+#Records of the given dam GDBs written since a time.time() value
+def readRunLog(gdbs, since=0):
+    records = []
+    for gdb in gdbs:
+        try:
+            with open(logPath(gdb)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue        #line cut short by a killed run
+                    if record.get("time", 0) >= since:
+                        records.append(record)
+        except (IOError, OSError):
+            pass
+    return records
+
+#Summary table lines: each stage's runs, failures, total/mean/max time and peak memory, then the slowest dams
+def summarize(records, slowest=5):
+    stages, dams = {}, {}
+    for record in records:
+        row = stages.setdefault(record["stage"], {"runs": 0, "failed": 0, "total": 0.0, "max": 0.0, "maxDam": "", "peakMB": 0.0})
+        row["runs"] += 1
+        row["failed"] += record["status"] != "ok"
+        row["total"] += record["seconds"]
+        if record["seconds"] >= row["max"]:
+            row["max"], row["maxDam"] = record["seconds"], record["dam"]
+        row["peakMB"] = max(row["peakMB"], record.get("peakMB") or 0.0)
+        dams[record["dam"]] = dams.get(record["dam"], 0.0) + record["seconds"]
+
+    lines = ["%-10s %5s %6s %10s %9s %9s %-12s %8s" %("stage", "runs", "failed", "total s", "mean s", "max s", "max dam", "peak MB")]
+    for name in sorted(stages, key=lambda name: -stages[name]["total"]):
+        row = stages[name]
+        lines.append("%-10s %5d %6d %10.1f %9.1f %9.1f %-12s %8.0f" %(name, row["runs"], row["failed"], row["total"],
+                     row["total"]/row["runs"], row["max"], row["maxDam"], row["peakMB"]))
+    if dams:
+        lines.append("Slowest dams: " + ", ".join(["%s %.1f s" %(dam, dams[dam]) for dam in sorted(dams, key=lambda dam: -dams[dam])[:slowest]]))
+    for record in records:
+        if record["status"] != "ok":
+            error = (record.get("error") or "").strip().splitlines()
+            lines.append("%s %s failed: %s" %(record["dam"], record["stage"], error[-1] if error else ""))
+    return lines
+
+#Print the summary of a batch
+def reportRunLog(gdbs, since):
+    import arcpy
+    records = readRunLog(gdbs, since)
+    if records:
+        arcpy.AddMessage("\n".join(summarize(records)))
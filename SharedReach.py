@@ -0,0 +1,203 @@
+# ------------------------------------------------------------------------------
+# Name: Shared Reach
+# Desc: Watershed-level cache of the flow path reaches shared by several dams. Dams on the same river follow the
+#     same downstream flow path for most of its length, and each dam's Step3 samples the DEM along it again.
+#     The flow paths of all dams are cut where the set of dams following them changes; the runs followed by two
+#     or more dams are the shared reaches, identified by their snapped vertices. Each shared reach is read once
+#     from the Setup DEM cache and saved as <ReachID>.npz in the reaches folder of the cache: the DEM window around
+#     it, its vertices and chainage, and its ground profile every cell. reaches.json lists the reaches each dam
+#     follows and their chainage along its flow path. A dam then takes the ground on its shared reaches from the
+#     cache and samples only the rest of its flow path; its wave heights, and so its WSE, come from its own chainage.
+#     Does not import arcpy at module level; reading the flow paths uses it.
+# ------------------------------------------------------------------------------
+from __future__ import division
+import os, json
+from collections import namedtuple
+import numpy
+from StreamNetwork import SNAP_TOLERANCE, snapKey, readLines
+from WSEProfile import chainage, stationsAlong, pointsAlong
+from FloodEngine import cellIndex, sampleNearest, sampleBilinear
+from Manifest import fingerprint
+
+REACH_FOLDER = "reaches"    #folder of the reach cache in the DEM cache folder
+INDEX_FILE = "reaches.json"
+WINDOW_MARGIN = 2           #cells around a reach, enough for bilinear sampling at its edges
+
+#Chainage of the start and end of a shared reach along a dam's flow path
+ReachUse = namedtuple("ReachUse", ["reachID", "start", "end"])
+
+#Cut the flow paths of several dams where the set of dams following them changes. paths maps DamID to a list
+#of (x, y) in flow direction. Returns {ReachID: (points, DamIDs)} of the runs followed by two or more dams and
+#{DamID: [ReachUse]}. A run ends where the dams following it change, so every dam cuts it at the same vertices.
+def sharedReaches(paths, tolerance=SNAP_TOLERANCE):
+    keys = dict((damID, [snapKey(x, y, tolerance) for x, y in points]) for damID, points in paths.items())
+    following = {}
+    for damID, pathKeys in keys.items():
+        for edge in zip(pathKeys[:-1], pathKeys[1:]):
+            following.setdefault(edge, set()).add(damID)
+
+    reaches, uses = {}, {}
+    for damID, points in paths.items():
+        pathKeys = keys[damID]
+        edgeDams = [following[edge] for edge in zip(pathKeys[:-1], pathKeys[1:])]
+        xs, ys = numpy.array(points, float).T if len(points) > 0 else (numpy.zeros(0), numpy.zeros(0))
+        chain = chainage(xs, ys)
+        uses[damID] = []
+        start = 0
+        for i, dams in enumerate(edgeDams):
+            if i + 1 < len(edgeDams) and edgeDams[i + 1] == dams:
+                continue
+            if len(dams) > 1:
+                reachID = fingerprint(pathKeys[start:i + 2])[:16]
+                reaches.setdefault(reachID, (points[start:i + 2], sorted(dams)))
+                uses[damID].append(ReachUse(reachID, float(chain[start]), float(chain[i + 1])))
+            start = i + 1
+    return reaches, uses
+
+def reachFolder(cacheFolder):
+    return os.path.join(cacheFolder, REACH_FOLDER)
+
+def reachPath(folder, reachID):
+    return os.path.join(folder, reachID + ".npz")
+
+#Stamp of the DEM cache the reaches were read from
+def cacheStamp(demCache):
+    return fingerprint(demCache.index["sources"])
+
+#Read the DEM window around each shared reach from the DEM cache once and save it with the reach vertices, chainage
+#and ground profile every cell (Nearest, as Step3's lineProfile). Reaches already cached from the same DEM cache
+#are kept; reaches off the cache are left out. Returns the IDs of the reaches in the cache.
+def cacheReaches(reaches, folder, demCache):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    stamp = cacheStamp(demCache)
+    cellSize = demCache.cellSize
+    cached = set()
+    for reachID, (points, dams) in reaches.items():
+        path = reachPath(folder, reachID)
+        if os.path.exists(path):
+            with numpy.load(path) as reach:
+                if str(reach["stamp"]) == stamp:
+                    cached.add(reachID)
+                    continue
+        xs, ys = numpy.array(points, float).T
+        rows, cols, inside = cellIndex((demCache.nrows, demCache.ncols), demCache.xmin, demCache.ymax, cellSize, xs, ys)
+        if not inside.all():
+            continue
+        r0, c0 = rows.min() - WINDOW_MARGIN, cols.min() - WINDOW_MARGIN
+        window = demCache.readCells(r0, rows.max() + WINDOW_MARGIN + 1, c0, cols.max() + WINDOW_MARGIN + 1)
+        origin = numpy.array([demCache.xmin + c0*cellSize, demCache.ymax - r0*cellSize, cellSize])
+        chain = chainage(xs, ys)
+        stations = stationsAlong(chain[-1], cellSize)
+        ptX, ptY = pointsAlong(xs, ys, None, stations)
+        profile = sampleNearest(window, origin[0], origin[1], cellSize, ptX, ptY)
+        tmp = os.path.join(folder, reachID + ".tmp.npz")
+        numpy.savez(tmp, xs=xs, ys=ys, chainage=chain, window=window, origin=origin, stations=stations, profile=profile,
+                    stamp=numpy.array(stamp), dams=numpy.array(dams))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+        cached.add(reachID)
+    return cached
+
+def loadIndex(folder):
+    try:
+        with open(os.path.join(folder, INDEX_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+#reaches.json: for each dam the fingerprint of the flow path the reaches were found on, the DEM cache stamp and
+#its ReachUses. Dams of earlier runs not in uses are kept.
+def writeIndex(folder, uses, stamps, demStamp):
+    index = loadIndex(folder)
+    for damID, damUses in uses.items():
+        index[damID] = {"print": stamps[damID], "cache": demStamp, "reaches": [list(use) for use in damUses]}
+    path = os.path.join(folder, INDEX_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + ".tmp", path)
+
+#The shared reaches of one dam, read from the reach cache when first used
+class DamReaches(object):
+    def __init__(self, folder, uses):
+        self.folder = folder
+        self.uses = uses
+        self.reaches = {}
+
+    def reach(self, reachID):
+        if reachID not in self.reaches:
+            with numpy.load(reachPath(self.folder, reachID)) as reach:
+                self.reaches[reachID] = dict((name, reach[name]) for name in ("window", "origin", "stations", "profile"))
+        return self.reaches[reachID]
+
+    #Ground under points at chainages (stations) along the dam's flow path. Points on a shared reach are
+    #sampled from its cached window (Nearest or Bilinear), the rest with sampleOwn(xs, ys).
+    def ground(self, stations, xs, ys, sampleOwn, method="Nearest"):
+        sample = sampleBilinear if method == "Bilinear" else sampleNearest
+        values = numpy.full(len(stations), numpy.nan)
+        own = numpy.ones(len(stations), bool)
+        for use in self.uses:
+            on = own & (stations >= use.start) & (stations <= use.end)
+            if on.any():
+                reach = self.reach(use.reachID)
+                xmin, ymax, cellSize = reach["origin"].tolist()
+                values[on] = sample(reach["window"], xmin, ymax, cellSize, xs[on], ys[on])
+                own &= ~on
+        if own.any():
+            values[own] = sampleOwn(xs[own], ys[own])
+        return values
+
+    #Ground profile of the dam's flow path every step meters as (stations, ground). On its shared reaches the cached
+    #profiles are used, shifted to the dam's chainage; the rest is sampled with sampleOwn(stations).
+    def profile(self, length, step, sampleOwn):
+        own = stationsAlong(length, step)
+        keep = numpy.ones(len(own), bool)
+        stations, ground = [], []
+        for use in self.uses:
+            keep &= (own < use.start) | (own > use.end)
+            reach = self.reach(use.reachID)
+            shifted = use.start + reach["stations"]
+            on = shifted <= min(use.end, length)
+            stations.append(shifted[on])
+            ground.append(reach["profile"][on])
+        stations.append(own[keep])
+        ground.append(sampleOwn(own[keep]) if keep.any() else numpy.zeros(0))
+        stations, ground = numpy.concatenate(stations), numpy.concatenate(ground)
+        order = numpy.argsort(stations, kind="mergesort")
+        return stations[order], ground[order]
+
+#Shared reaches of a dam from the reach folder, or None when it has none, or its flow path or the DEM cache
+#changed since they were cached
+def damReaches(folder, damID, stamp, demStamp):
+    entry = loadIndex(folder).get(damID)
+    if not entry or entry["print"] != stamp or entry["cache"] != demStamp or len(entry["reaches"]) == 0:
+        return None
+    return DamReaches(folder, [ReachUse(*use) for use in entry["reaches"]])
+
+#Fingerprint of a dam's flow path geometry, as recorded in reaches.json
+def flowPathPrint(gdb):
+    from Manifest import tableFingerprint
+    return tableFingerprint(os.path.join(gdb, "flowPath"), ["SHAPE@WKB"])
+
+#Find the reaches shared by the flow paths of dam GDBs and cache them from the DEM cache in folder.
+#Dams whose flow path is not a single line are left out. Returns (shared reaches, dams on them).
+def buildSharedReaches(gdbs, demCache, folder, tolerance=SNAP_TOLERANCE):
+    import arcpy
+    paths, stamps = {}, {}
+    for gdb in gdbs:
+        flowPath = os.path.join(gdb, "flowPath")
+        if not arcpy.Exists(flowPath):
+            continue
+        lines = readLines(flowPath)
+        if len(lines) == 1 and len(lines[0]) >= 2:
+            damID = os.path.basename(gdb).split('.')[0]
+            paths[damID] = lines[0]
+            stamps[damID] = flowPathPrint(gdb)
+    reaches, uses = sharedReaches(paths, tolerance)
+    cached = cacheReaches(reaches, folder, demCache)
+    uses = dict((damID, [use for use in damUses if use.reachID in cached]) for damID, damUses in uses.items())
+    writeIndex(folder, uses, stamps, cacheStamp(demCache))
+    return len(cached), len([damID for damID in uses if len(uses[damID]) > 0])
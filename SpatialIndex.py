@@ -0,0 +1,110 @@
+# ------------------------------------------------------------------------------
+# Name: Spatial Index
+# Desc: Small in-memory spatial indexes used in place of full feature class scans.
+#     PointGrid buckets points into square cells for nearest neighbour queries.
+#     STRtree packs bounding boxes into an R-tree for extent queries.
+# ------------------------------------------------------------------------------
+from math import ceil, floor, hypot, sqrt
+
+#Uniform grid over a set of points. Queries search rings of cells outward from the query point.
+class PointGrid(object):
+    def __init__(self, xs, ys, cellSize):
+        self.cellSize = float(cellSize)
+        self.xs = list(xs)
+        self.ys = list(ys)
+        self.cells = {}
+        for i in range(len(self.xs)):
+            self.cells.setdefault(self.cellKey(self.xs[i], self.ys[i]), []).append(i)
+        if self.cells:
+            self.minKey = (min(k[0] for k in self.cells), min(k[1] for k in self.cells))
+            self.maxKey = (max(k[0] for k in self.cells), max(k[1] for k in self.cells))
+
+    def __len__(self):
+        return len(self.xs)
+
+    def cellKey(self, x, y):
+        return (int(floor(x/self.cellSize)), int(floor(y/self.cellSize)))
+
+    #Cells at Chebyshev distance ring from the centre cell
+    def ringCells(self, cx, cy, ring):
+        if ring == 0:
+            yield (cx, cy)
+            return
+        for i in range(-ring, ring + 1):
+            yield (cx + i, cy - ring)
+            yield (cx + i, cy + ring)
+        for j in range(-ring + 1, ring):
+            yield (cx - ring, cy + j)
+            yield (cx + ring, cy + j)
+
+    #Index and distance of the closest point, or None if there is no point closer than maxDist.
+    def nearest(self, x, y, maxDist=None):
+        if not self.cells:
+            return None
+        cx, cy = self.cellKey(x, y)
+        lastRing = max(abs(cx - self.minKey[0]), abs(cx - self.maxKey[0]), abs(cy - self.minKey[1]), abs(cy - self.maxKey[1]))
+        if maxDist is not None:
+            lastRing = min(lastRing, int(maxDist/self.cellSize) + 1)
+        best, bestDist = None, float("inf")
+        ring = 0
+        while ring <= lastRing:
+            for key in self.ringCells(cx, cy, ring):
+                for i in self.cells.get(key, ()):
+                    distance = hypot(x - self.xs[i], y - self.ys[i])
+                    if distance < bestDist:
+                        best, bestDist = i, distance
+            #Points in later rings are at least ring * cellSize away
+            if best is not None and bestDist <= ring*self.cellSize:
+                break
+            ring += 1
+        if best is None or (maxDist is not None and bestDist >= maxDist):
+            return None
+        return best, bestDist
+
+#Sort-Tile-Recursive packed R-tree over bounding boxes (xmin, ymin, xmax, ymax).
+class STRtree(object):
+    def __init__(self, boxes, nodeSize=16):
+        self.boxes = [tuple(box) for box in boxes]
+        self.nodeSize = nodeSize
+        self.root = None
+        if self.boxes:
+            level = [(box, i, None) for i, box in enumerate(self.boxes)]
+            while len(level) > 1:
+                level = self.packLevel(level)
+            self.root = level[0]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    #Group entries into parent nodes: vertical slices by x centre, then runs by y centre within each slice
+    def packLevel(self, entries):
+        count = len(entries)
+        nodeCount = -(-count//self.nodeSize)
+        sliceCount = max(1, int(ceil(sqrt(nodeCount))))
+        sliceSize = sliceCount*self.nodeSize
+        entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+        parents = []
+        for s in range(0, count, sliceSize):
+            column = sorted(entries[s:s + sliceSize], key=lambda e: e[0][1] + e[0][3])
+            for n in range(0, len(column), self.nodeSize):
+                children = column[n:n + self.nodeSize]
+                box = (min(c[0][0] for c in children), min(c[0][1] for c in children),
+                       max(c[0][2] for c in children), max(c[0][3] for c in children))
+                parents.append((box, None, children))
+        return parents
+
+    #Indexes of the boxes that intersect box
+    def query(self, box):
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            nodeBox, item, children = stack.pop()
+            if nodeBox[0] > box[2] or nodeBox[2] < box[0] or nodeBox[1] > box[3] or nodeBox[3] < box[1]:
+                continue
+            if children is None:
+                found.append(item)
+            else:
+                stack.extend(children)
+        return sorted(found)
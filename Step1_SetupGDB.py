@@ -6,46 +6,64 @@
 #   Copy the GenericCounty folder and rename to match the county name. Also rename the geodatabase in the same manner.
 # Process: Uses the AllDams feature class to identify dams in the specified county. Creates a GDB for each dam with the
 #   necessary layers, including hydrology features and a DEM that covers the required distance downstream.
+#   Dam GDBs only receive the template tables; streams and DEMs are written already clipped to the dam buffer.
+#   Stream lines of the county and its neighbours are merged once per run into regionStreams (StreamNetwork.StreamStore).
+#   splitStreams and its HydroID, NextDownID and node fields are built without ArcHydro (StreamNetwork.buildStreamTopology),
+#   each split line keeping the clipStreams attributes of the line it was cut from.
+#   With a DEM cache folder, the DEMs of the county and its neighbours are mosaicked and tiled once (DemCache.py)
+#   and each clipDEM is a windowed read.
+#   Each dam GDB gets a manifest of input fingerprints (Manifest.py); dams with unchanged inputs are skipped on a rerun.
+#   Stage times, memory and errors go to <DamID>.runlog.jsonl (RunLog.py), summarized at the end of the run.
+#   The shared handles live in CountySetup, so Pipeline.py can set up dams without running this tool.
 # ------------------------------------------------------------------------------
 
-#Get streams within county (all line features)
-def copyStreamLines(gdb, hydroGDB):
-    arcpy.env.workspace = hydroGDB
-    fcs = []
-    for fds in arcpy.ListDatasets('','feature') + ['']:
-        for fc in arcpy.ListFeatureClasses('','',fds):
-            desc = arcpy.Describe(fc)
-            type = desc.shapeType
-            if type == "Polyline":
-                fcs.append(os.path.join(hydroGDB, fds, fc))
-    arcpy.env.workspace = gdb
-    fcCount=len(fcs)
-    if fcCount>0:
-        if arcpy.Exists("countyStreams")==False:
-            arcpy.CreateFeatureclass_management(gdb, "countyStreams", "Polyline", fcs[0], "", "SAME_AS_TEMPLATE", "damLyr")
-        for i in range(fcCount):
-            arcpy.Append_management(fcs[i], "countyStreams", "NO_TEST")
-
-def getLayers(damWorkspace, damID, distText, demFolder, hydFolder):
-    matchcount = int(arcpy.GetCount_management('countyLyr')[0])
-    arcpy.Buffer_analysis(currentDam, "buffer"+damID, distText)
-
-    #Bring in DEM(s) and countyStream(s)
+#Create the dam GDB with only the template tables; spatial layers are added already clipped to the dam buffer
+def createDamGDB(gdb, damWorkspace):
+    if arcpy.Exists(damWorkspace):
+        arcpy.Delete_management(damWorkspace)
+    arcpy.CreateFileGDB_management(os.path.dirname(damWorkspace), os.path.basename(damWorkspace))
+    for template in templateList:
+        if arcpy.Exists(os.path.join(gdb, template)):
+            arcpy.Copy_management(os.path.join(gdb, template), os.path.join(damWorkspace, template))
+
+#Stages are timed in the dam's run log (RunLog.py)
+def getLayers(setup, damWorkspace, damID, bufferDist, nearCounties, runLog):
+    with runLog.stage("clip") as info:
+        clipLayers(setup, damWorkspace, damID, bufferDist, nearCounties)
+        info["counties"] = len(nearCounties)
+        info["demSize"] = rasterSize(os.path.join(damWorkspace, "clipDEM")) if arcpy.Exists(os.path.join(damWorkspace, "clipDEM")) else None
+        info["lines"] = featureCount("clipStreams")
+    with runLog.stage("topology") as info:
+        info["segments"] = buildTopology(damWorkspace)
+
+#Buffer the dam and clip the DEM and streams to the buffer
+def clipLayers(setup, damWorkspace, damID, bufferDist, nearCounties):
+    county, demFolder, hydFolder = setup.county, setup.demFolder, setup.hydFolder
+    streamStore, demCache = setup.streamStore, setup.demCache
+    matchcount = len(nearCounties)
+    arcpy.Buffer_analysis("dam"+damID, "buffer"+damID, bufferDist)
+    clipFC = os.path.join(damWorkspace, "buffer"+damID)
+
+    #Counties within the distance, their streams are added to the regional store
+    neededCounties = [county]
     if matchcount>1:
-        countyLyr = arcpy.MakeFeatureLayer_management("countyLyr", "neededCounties")
+        neededCounties = nearCounties
+    for countyName in neededCounties:
+        streamStore.addHydroGDB(os.path.join(hydFolder, countyName+"HYD.gdb"))    #loaded once per run
+
+    #Bring in DEM(s), a windowed read when the regional DEM cache is used
+    if demCache != None:
+        if 0 in saveWindow(demCache, clipFC, os.path.join(damWorkspace, "clipDEM")):
+            arcpy.AddWarning("%s is outside the DEM cache" %(damID))
+    elif matchcount>1:
         demCount=1
         demList=[]
-        with arcpy.da.SearchCursor("neededCounties", ["CNTYNAME"]) as rows:
-            for row in rows:
-                demGDB = os.path.join(demFolder, row[0]+".gdb")
-                if arcpy.Exists(demGDB):
-                    clipDEM(damWorkspace, demGDB, os.path.join(damWorkspace, "buffer"+damID), demCount)  #clip DEM(s)
-                    demList.append("clipDEM"+str(demCount))
-                    demCount+=1
-                hydroGDB = os.path.join(hydFolder, row[0]+"HYD.gdb")
-                if row[0]!= county and arcpy.Exists(hydroGDB):
-                    copyStreamLines(damWorkspace, hydroGDB)         #append streams
-        del row, rows
+        for countyName in neededCounties:
+            demGDB = os.path.join(demFolder, countyName+".gdb")
+            if arcpy.Exists(demGDB):
+                clipDEM(damWorkspace, demGDB, clipFC, demCount)  #clip DEM(s)
+                demList.append("clipDEM"+str(demCount))
+                demCount+=1
         if demCount>1:
             arcpy.MosaicToNewRaster_management(";".join(demList), damWorkspace, "clipDEM", "#", "32_BIT_FLOAT", "#", 1)
         elif demCount == 1:
@@ -53,21 +71,24 @@ def getLayers(damWorkspace, damID, distText, demFolder, hydFolder):
     else:
         demGDB = os.path.join(demFolder, county+".gdb")
         if arcpy.Exists(demGDB):
-            clipDEM(damWorkspace, demGDB, os.path.join(damWorkspace, "buffer"+damID), 0)
-
-    #Clip streams
-    arcpy.Clip_analysis("countyStreams", "buffer"+damID, "clipStreams")
-    arcpy.Intersect_analysis("clipStreams", "intersect", "ALL", "", "POINT")
-    arcpy.UnsplitLine_management("clipStreams", "unSplitStreams", "", "")
-    arcpy.SplitLineAtPoint_management("unSplitStreams", "intersect", "splitStreams", "0.1")
-    arcpy.DeleteIdentical_management("splitStreams", "Shape")
-    arcpy.MakeFeatureLayer_management ("splitStreams", "splitStreamsLyr")
-                                        
-    #Setup ArcHydro geometry on streams
-    ArcHydroTools.AssignHydroID("splitStreamsLyr", "OVERWRITE_YES")
-    ArcHydroTools.GenerateFNodeTNode("splitStreamsLyr")
+            clipDEM(damWorkspace, demGDB, clipFC, 0)
+
+    #Clip streams, reading only the regional store lines that intersect the buffer
+    streamStore.clipTo(clipFC, "clipStreams")
+
+#Split the clipped streams at intersections and set up the ArcHydro geometry. Returns the number of lines.
+def buildTopology(damWorkspace):
+    clipStreams = os.path.join(damWorkspace, "clipStreams")
+    splitStreams = os.path.join(damWorkspace, "splitStreams")
+    fields = sourceFields(clipStreams)
+    lines, values = readLineRows(clipStreams, fields)
+    topology = buildStreamTopology(lines)
+    writeTopology(topology, splitStreams, arcpy.Describe(clipStreams).spatialReference, clipStreams, fields, values)
     arcpy.env.workspace = damWorkspace
-    ArcHydroTools.FindNextDownstreamLine("splitStreams")
+
+    #Step2 rebuilds the nodes only if splitStreams is edited after this
+    markDone(damWorkspace, "topology", tableFingerprint(splitStreams, ["SHAPE@WKB"]))
+    return len(topology)
     
 #Clip DEM(s)
 def clipDEM(damWorkspace, demGDB, clipFC, demCount):
@@ -87,74 +108,126 @@ def delLayers(gdb, delList):
             arcpy.Delete_management(os.path.join(gdb, lyr))
 
 #-----------------------------------------------------------
-import arcpy, os, ArcHydroTools
+import arcpy, os, time
 from arcpy import env
 from arcpy.sa import *
+from StreamNetwork import StreamStore, buildStreamTopology, readLineRows, sourceFields, writeTopology
+from DemCache import buildDemCache, saveWindow
+from CountyIndex import DIST_CLASSES, downstreamMiles, distText, loadCountyIndex
+from Manifest import fingerprint, contentStamp, currentStage, clearStage, markDone, tableFingerprint
+from RunLog import RunLog, rasterSize, featureCount, reportRunLog
 arcpy.env.overwriteOutput = True
 arcpy.CheckOutExtension("3D")
 arcpy.CheckOutExtension("Spatial")
+templateList = ["WaveHtPts"]    #ArcHydro tables needed in each dam GDB
+
+#Shared handles of a county run. The DEM cache, regional stream store and county index are opened once
+#and kept across dams, by this tool or by a Pipeline.py worker. storeGDB holds the stream store, the county GDB by default.
+class CountySetup(object):
+    def __init__(self, gdb, county, demFolder, hydFolder, cacheFolder=None, storeGDB=None):
+        self.gdb = gdb
+        self.county = county
+        self.demFolder = demFolder
+        self.hydFolder = hydFolder
+        self.workingFolder = os.path.dirname(gdb)
+
+        self.countyIndex = loadCountyIndex(os.path.join(gdb, "County"))     #county distances for every dam come from one read
+
+        #Build (or reuse) the regional DEM cache from the DEM GDBs of the county and the counties within 10 miles of it
+        self.demCache = None
+        if cacheFolder:
+            self.demCache = buildDemCache(self.demGDBs(), cacheFolder)
+        arcpy.env.workspace = gdb
+
+        #Get Features By County
+        arcpy.MakeFeatureLayer_management ("AllDams", "damLyr", '"Cnty_Name" = ' + "'%s'" %county)
+        if storeGDB == None:
+            storeGDB = gdb
+        elif not arcpy.Exists(storeGDB):
+            arcpy.CreateFileGDB_management(os.path.dirname(storeGDB), os.path.basename(storeGDB))
+        self.streamStore = StreamStore(storeGDB, "regionStreams", "damLyr")
+        self.streamStore.addHydroGDB(os.path.join(hydFolder, county+"HYD.gdb"))
+
+    #DEM GDBs any dam of the county can need: the county's and those of the counties within the largest distance class
+    def demGDBs(self):
+        names = [self.county]
+        geometry = self.countyIndex.geometryOf(self.county)
+        if geometry != None:
+            names += [name for name in self.countyIndex.countiesNear(geometry)[max(DIST_CLASSES)] if name != self.county]
+        return [os.path.join(self.demFolder, name + ".gdb") for name in names if arcpy.Exists(os.path.join(self.demFolder, name + ".gdb"))]
+
+    def damWorkspace(self, damID):
+        return os.path.join(self.workingFolder, damID + ".gdb")
 
-#Identify County of Interest
-gdb = arcpy.GetParameterAsText(0)           #set county.gdb location, e.g. C:\Project\Oconee.gdb
-county = arcpy.GetParameterAsText(1)        #set county using dropdown
-demFolder = arcpy.GetParameterAsText(2)     #folder containing DEM geodatabases (not the gdb itself)
-hydFolder = arcpy.GetParameterAsText(3)     #folder containing hydrology geodatabases (not the gdb itself)
-limitBy = arcpy.GetParameterAsText(4)       #list the dams to be include by DamID
-
-arcpy.env.workspace = gdb
-workingFolder = os.path.dirname(arcpy.env.workspace)
-baseFolder = os.path.dirname(workingFolder)
-
-#Get Features By County
-arcpy.MakeFeatureLayer_management ("AllDams", "damLyr")
-arcpy.SelectLayerByAttribute_management ("damLyr", "NEW_SELECTION",  '"Cnty_Name" = ' + "'%s'" %county)
-arcpy.CopyFeatures_management("damLyr", "countyDams")
-
-hydroGDB = os.path.join(hydFolder, county+"HYD.gdb")
-copyStreamLines(gdb, hydroGDB)
-
-#Set up GDB for each dam
-damList, areaList = [], []
-
-with arcpy.da.SearchCursor("countyDams", ["DamID", "Dam_height", "Surface_area"]) as rows:
-    for row in rows:
-        #if len(limitBy) == 0 and row[1] != None and row[2] != None:
-        if len(limitBy) == 0:
-            damList.append(row[0])
-            SAValue=row[2]
-            areaList.append(SAValue)
+    #Copy the county's dams to countyDams and list them as ([DamID, height, SA, X, Y], counties near by distance class).
+    #limitBy is the list of DamIDs to include, blank for all.
+    def damRows(self, limitBy=""):
+        arcpy.env.workspace = self.gdb
+        arcpy.CopyFeatures_management("damLyr", "countyDams")
+        dams = []
+        with arcpy.da.SearchCursor("countyDams", ["DamID", "Dam_height", "Surface_area", "SHAPE@"]) as rows:
+            for row in rows:
+                #if len(limitBy) == 0 and row[1] != None and row[2] != None:
+                if len(limitBy) == 0 or (row[0] in limitBy and row[0] != ''):
+                    dams.append(([row[0], row[1], row[2], row[3].firstPoint.X, row[3].firstPoint.Y], self.countyIndex.countiesNear(row[3])))
+        del rows
+        return dams
+
+    #Set up one dam GDB. Dams whose row, distance class and source GDBs are unchanged since their last setup are skipped.
+    #Returns False for a skipped dam.
+    def setupDam(self, damRow, nearCounties, force=False):
+        damID = damRow[0]
+        damWorkspace = self.damWorkspace(damID)
+
+        #Use surface area to pick distance downstream values
+        damMiles = downstreamMiles(damRow[2])
+        nearCounties = nearCounties[damMiles]
+        sourceGDBs = [os.path.join(self.hydFolder, name+"HYD.gdb") for name in nearCounties + [self.county]]
+        if self.demCache != None:
+            sources = self.demCache.index["sources"]
         else:
-            #if row[0] in limitBy and row[0] != '' and row[1] != None and row[2] != None:
-            if row[0] in limitBy and row[0] != '':
-                damList.append(row[0])
-                SAValue=row[2]
-                areaList.append(SAValue)
-    arcpy.AddMessage(damList)
-del row, rows
-
-for damID in damList:
-    arcpy.AddMessage("Starting dam " + str(damID))
-    damWorkspace = os.path.join(workingFolder, damID + ".gdb")
-    arcpy.Copy_management(gdb, damWorkspace)
-    arcpy.env.workspace = damWorkspace
+            sources = contentStamp([os.path.join(self.demFolder, name+".gdb") for name in nearCounties + [self.county]])
+        stamp = fingerprint(damRow, damMiles, sorted(nearCounties), sources, contentStamp(sourceGDBs))
+        if not force and currentStage(damWorkspace, "setup", stamp) and arcpy.Exists(os.path.join(damWorkspace, "splitStreams")):
+            arcpy.AddMessage("%s inputs unchanged, setup skipped" %(damID))
+            return False
+        clearStage(damWorkspace, "setup")
 
-    #Use surface area to pick distance downstream values
-    damSA = areaList[damList.index(damID)]
-    if damSA==None or damSA=='' or (damSA >= 25 and damSA < 100):
-        distText = "5 Miles"
-    elif damSA < 25:
-        distText = "2 Miles"
-    else:
-        distText = "10 Miles"
-    
-    #Identify dam, check if other counties within x distance.
-    currentDam = "dam" + damID
-    arcpy.SelectLayerByAttribute_management ("damLyr", "NEW_SELECTION",  '"DamID" = ' + "'%s'" %damID)
-    arcpy.CopyFeatures_management("damLyr", currentDam)
-    arcpy.MakeFeatureLayer_management ("County", "countyLyr")
-    arcpy.SelectLayerByLocation_management ("countyLyr", "WITHIN_A_DISTANCE", currentDam, distText)
-
-    getLayers(damWorkspace, damID, distText, demFolder, hydFolder)
-                                
-    delList = ["AllDams", "buffer"+damID, "clipStreams", "County", "countyDams", "countyStreams", "unSplitStreams", "intersect", "clipDEM1", "clipDEM2", "clipDEM3"]
-    delLayers(damWorkspace, delList)
+        arcpy.AddMessage("Starting dam " + str(damID))
+        runLog = RunLog(damWorkspace, "Step1")
+        with runLog.stage("copy"):
+            createDamGDB(self.gdb, damWorkspace)
+            arcpy.env.workspace = damWorkspace
+
+            #Identify dam, other counties within x distance come from the county index.
+            arcpy.SelectLayerByAttribute_management ("damLyr", "NEW_SELECTION",  '"DamID" = ' + "'%s'" %damID)
+            arcpy.CopyFeatures_management("damLyr", "dam" + damID)
+            arcpy.SelectLayerByAttribute_management ("damLyr", "CLEAR_SELECTION")
+
+        getLayers(self, damWorkspace, damID, distText(damMiles), nearCounties, runLog)
+
+        delList = ["buffer"+damID, "clipStreams", "clipDEM1", "clipDEM2", "clipDEM3"]
+        delLayers(damWorkspace, delList)
+        markDone(damWorkspace, "setup", stamp)
+        return True
+
+if __name__ == '__main__':
+    #Identify County of Interest
+    gdb = arcpy.GetParameterAsText(0)           #set county.gdb location, e.g. C:\Project\Oconee.gdb
+    county = arcpy.GetParameterAsText(1)        #set county using dropdown
+    demFolder = arcpy.GetParameterAsText(2)     #folder containing DEM geodatabases (not the gdb itself)
+    hydFolder = arcpy.GetParameterAsText(3)     #folder containing hydrology geodatabases (not the gdb itself)
+    limitBy = arcpy.GetParameterAsText(4)       #list the dams to be include by DamID
+    cacheFolder = arcpy.GetParameterAsText(5)   #optional folder for the regional DEM cache
+    force = arcpy.GetParameterAsText(6).lower() == "true"   #rerun dams even if their inputs are unchanged
+
+    setup = CountySetup(gdb, county, demFolder, hydFolder, cacheFolder)
+
+    #Set up GDB for each dam
+    batchStart = time.time()
+    dams = setup.damRows(limitBy)
+    arcpy.AddMessage([damRow[0] for damRow, nearCounties in dams])
+    for damRow, nearCounties in dams:
+        setup.setupDam(damRow, nearCounties, force)
+
+    reportRunLog([setup.damWorkspace(damRow[0]) for damRow, nearCounties in dams], batchStart)
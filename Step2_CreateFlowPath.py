@@ -1,16 +1,25 @@
 # ------------------------------------------------------------------------------
 # Name: Create Flow Path
 # Desc: Automates the ArcHydro tool: Trace feature by NextDownID attribute.
-#     However, it does not handle flow splits at this time.
+#     Flow splits are reported, but only the NextDownID branch is followed.
+#     The stream table is loaded once into an in-memory index (StreamNetwork.py) for the trace.
 #     Parameter[0] Note - choosing a geodatabase as the workspace will run a single dam. Choosing a folder will run on all dams in the folder. 
+#     Parameter[1] Note - in folder mode, more than one worker runs the dams in parallel processes (BatchDriver.py).
+#     Parameter[3] Note - the D8 engine follows flow directions of the Setup DEM cache (FlowRouting.py) instead of the streams,
+#       Auto uses it only for dams whose downstream line is not found. Both need the DEM cache folder in Parameter[4].
+#     Stage times, memory and errors go to <DamID>.runlog.jsonl (RunLog.py), summarized at the end of the run.
 # ------------------------------------------------------------------------------
 
-#Get Hydro ID of first downstream line from dam point
+#Get Hydro ID of first downstream line from dam point.
+#The nodes and NextDownID are only recomputed when splitStreams was edited since its topology was built.
 def getDSHydroID(workspace, streamsFC):
-    #Update ArcHydro geometry on streams in case edits were made.
-    ArcHydroTools.GenerateFNodeTNode(streamsFC)
+    streams = os.path.join(workspace, "splitStreams")
+    stamp = tableFingerprint(streams, ["SHAPE@WKB"])
+    if not currentStage(workspace, "topology", stamp):
+        updateTopology(streams)
+        markDone(workspace, "topology", stamp)
     arcpy.env.workspace = workspace
-    ArcHydroTools.FindNextDownstreamLine(streamsFC)
+    streamIndex = loadStreamIndex("splitStreams")
 
     damID = os.path.basename(workspace).split('.')[0]
     xy=[]
@@ -18,60 +27,58 @@ def getDSHydroID(workspace, streamsFC):
         for row in damCursor:
             xy = [row[0].getPart().X, row[0].getPart().Y]
     del row, damCursor
-    with arcpy.da.SearchCursor("splitStreams", ["HYDROID", "NextDownID", "FROM_NODE", "Shape@"]) as streamCursor:
-        for row in streamCursor:
-            if row[3].firstPoint.X == xy[0] and row[3].firstPoint.Y == xy[1]:
-                return (row[0], row[1], row[2])
-    del row, streamCursor
+    startIDs = streamIndex.lineStartingAt(xy[0], xy[1])
+    return streamIndex, startIDs
 
 #Query for features in a list
 def queryStreams(streamsFC, streamList, selectType, selectField):
-    q=[]
-    for value in streamList:
-        q.append(selectField+"="+str(value))
-    query = " OR ".join(q)
+    query = selectField + " IN (" + ",".join([str(value) for value in streamList]) + ")"
     arcpy.SelectLayerByAttribute_management(streamsFC, selectType, query)
     
-#Identify next downstream line from original stream. Does not check for flow splits.
-def createMainFlowPath(workspace, streamsFC):       
+#Identify next downstream line from original stream. Flow splits are reported but not followed.
+def createMainFlowPath(workspace, streamsFC, runLog):       
     arcpy.MakeFeatureLayer_management (streamsFC, streamsFC)
+    damID = os.path.basename(workspace).split('.')[0]
     try:
-        startID, NextDownID, startFromNode = getDSHydroID(workspace, streamsFC)
-    except:
-        damID = os.path.basename(workspace).split('.')[0]
-        arcpy.AddWarning("%s downstream line not found. Try snapping or resetting NextDSID." %(damID))
+        with runLog.stage("topology") as info:
+            streamIndex, startIDs = getDSHydroID(workspace, streamsFC)
+            info["segments"] = len(streamIndex)
+            if startIDs == None:
+                raise ValueError("no stream line starts at the dam point")
+            startID, NextDownID, startFromNode = startIDs
+    except Exception as e:
+        arcpy.AddWarning("%s downstream line not found (%s). Try snapping or resetting NextDSID." %(damID, e))
         return False
-    
-    count=0
-    dsList = [startID]
-    fromList =[startFromNode]
-
-    while NextDownID != -1 and count<50:
-        with arcpy.da.SearchCursor(streamsFC, ["HYDROID", "NextDownID", "FROM_NODE"]) as rows:
-            for row in rows:
-                if row[0]== NextDownID:             
-                    dsList.append(row[0])
-                    fromList.append(row[2])
-                    NextDownID=row[1]
-                    count+=1
-        del row, rows
-    if -1 in dsList:
-        listLoc = dsList.index(-1)
-        dsList.remove(dsList[listLoc])
-        fromList.remove(fromList[listLoc])
 
+    with runLog.stage("trace") as info:
+        #Walk NextDownID through the in-memory index
+        dsList, fromList = streamIndex.trace(startID)
+        splitNodes = streamIndex.flowSplits(dsList)
+        if len(splitNodes)>0:
+            arcpy.AddWarning("%s flow splits at nodes %s. Only the NextDownID branch was followed." %(damID, ", ".join([str(node) for node in splitNodes])))
+        usList = traceLines(workspace, streamsFC, streamIndex, dsList, fromList)
+        info["dsLines"] = len(dsList)
+        info["usLines"] = len(usList)
+        info["splits"] = len(splitNodes)
+    return True
+
+#Copy the traced lines to flowPath and the lines flowing into it to flowPath_us
+def traceLines(workspace, streamsFC, streamIndex, dsList, fromList):
     #Create flowPath    
     queryStreams(streamsFC, dsList, "NEW_SELECTION", '\"HYDROID\"')
     arcpy.CopyFeatures_management(streamsFC, "flowPath_seg")
     arcpy.UnsplitLine_management("flowPath_seg", "flowPath", "", "")
 
-    #Create upstream flowpath    
-    queryStreams(streamsFC, fromList, "NEW_SELECTION", '\"TO_NODE\"')
-    arcpy.SelectLayerByLocation_management (streamsFC, "SHARE_A_LINE_SEGMENT_WITH", "flowPath_seg", "#", "REMOVE_FROM_SELECTION")
-    arcpy.CopyFeatures_management(streamsFC, "flowPath_us")
+    #Create upstream flowpath from the lines flowing into the path's FROM_NODEs
+    usList = streamIndex.upstreamLines(dsList, fromList)
+    if len(usList)>0:
+        queryStreams(streamsFC, usList, "NEW_SELECTION", '\"HYDROID\"')
+        arcpy.CopyFeatures_management(streamsFC, "flowPath_us")
+    else:
+        arcpy.CreateFeatureclass_management(workspace, "flowPath_us", "POLYLINE", streamsFC, "", "", streamsFC)
     arcpy.AddField_management("flowPath_us", "FROM_WSE", "DOUBLE")
     arcpy.AddField_management("flowPath_us", "TO_WSE", "DOUBLE")
-    return True
+    return usList
     
 #Check for errors
 def checkFlowPath(workspace, flowPath, fpList):
@@ -83,13 +90,7 @@ def checkFlowPath(workspace, flowPath, fpList):
             damSA = row[0]
     del row, damCursor
 
-    distDS = {2: 3218.688, 5: 8046.72, 10: 16093.44}
-    if damSA >= 25 and damSA < 100 or damSA==None or damSA=='':
-        lenDS = distDS[5]  #5 miles in meters
-    elif damSA < 25:
-        lenDS = distDS[2]  #2 miles in meters
-    else:
-        lenDS = distDS[10]  #10 miles in meters
+    lenDS = DIST_METERS[downstreamMiles(damSA)]     #2, 5 or 10 miles in meters
     
     count = 0
     with arcpy.da.SearchCursor (flowPath, "SHAPE@") as cursor:
@@ -107,34 +108,115 @@ def delLayers(delList):
         if arcpy.Exists(lyr):
             arcpy.Delete_management(lyr)
 
+#Trace the flow path down the cached D8 flow directions from the dam point, far enough for its 2, 5 or 10 miles.
+#Tributaries are not traced, flowPath_us is created empty.
+def createD8FlowPath(workspace, flowDirs, runLog):
+    damID = os.path.basename(workspace).split('.')[0]
+    with runLog.stage("trace") as info:
+        with arcpy.da.SearchCursor("dam"+damID, ["SHAPE@XY", "Surface_area"]) as damCursor:
+            for row in damCursor:
+                damXY, damSA = row
+        del row, damCursor
+        xs, ys, distance = flowDirs.trace(damXY[0], damXY[1], DIST_METERS[downstreamMiles(damSA)])
+        info["engine"] = "D8"
+        info["cells"] = len(xs) - 1
+        if len(xs)<2:
+            arcpy.AddWarning("%s is outside the flow direction grid or on a cell without a flow direction." %(damID))
+            return False
+
+        template = "splitStreams" if arcpy.Exists(os.path.join(workspace, "splitStreams")) else ""
+        spatialReference = arcpy.Describe("dam"+damID).spatialReference
+        for name in ["flowPath", "flowPath_us"]:
+            arcpy.CreateFeatureclass_management(workspace, name, "POLYLINE", template, "", "", spatialReference)
+        with arcpy.da.InsertCursor("flowPath", ["SHAPE@"]) as iCursor:
+            iCursor.insertRow([arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in zip(xs, ys)]), spatialReference)])
+        del iCursor
+        arcpy.AddField_management("flowPath_us", "FROM_WSE", "DOUBLE")
+        arcpy.AddField_management("flowPath_us", "TO_WSE", "DOUBLE")
+    return True
+
+#Create and check the flow path for one dam GDB. Returns True if the flow path needs review.
+#Dams whose setup, dam row and splitStreams are unchanged since their last flow path are skipped.
+#engine is Vector (NextDownID trace), D8 (cached flow directions of the DEM cache) or Auto (D8 when the vector trace fails).
+def runDam(gdb, force=False, engine="Vector", demCacheFolder=None):
+    arcpy.env.workspace = gdb
+    damID = os.path.basename(gdb).split('.')[0]
+    flowDirs = FlowDirCache(flowDirFolder(demCacheFolder)) if engine != "Vector" else None
+    stamp = fingerprint(stagePrint(gdb, "setup"), damFingerprint("dam"+damID), tableFingerprint("splitStreams", ["HYDROID", "SHAPE@WKB"]),
+                        engine, flowDirs.index["sources"] if flowDirs else None)
+    done = currentStage(gdb, "flowpath", stamp)
+    if done and not force and arcpy.Exists(os.path.join(gdb, "flowPath")):
+        arcpy.AddMessage("%s inputs unchanged, flow path kept" %(damID))
+        return done["result"]
+    clearStage(gdb, "flowpath")
+
+    arcpy.AddMessage("Working on " + gdb)
+    runLog = RunLog(gdb, "Step2")
+    flagged = False
+    fpSuccess = False
+    if engine != "D8":
+        fpSuccess = createMainFlowPath(gdb, "splitStreams", runLog)
+        delLayers(["splitStreams", "flowPath_seg", "flowPath_us_seg"])
+    if not fpSuccess and flowDirs != None:
+        fpSuccess = createD8FlowPath(gdb, flowDirs, runLog)
+    if fpSuccess:
+        flagged = len(checkFlowPath(gdb, "flowPath", []))>0
+        markDone(gdb, "flowpath", stamp, flagged)
+    return flagged
+
 #---------------------------------------------------------------------
-import arcpy, os, ArcHydroTools
+import arcpy, os, sys, time
 from arcpy import env
 from arcpy.sa import *
-
-workingFolder = arcpy.GetParameterAsText(0)         #set GDB or folder containing GDB(s)
-arcpy.env.workspace = workingFolder
+from StreamNetwork import loadStreamIndex, updateTopology
+from DemCache import DemCache
+from FlowRouting import FlowDirCache, flowDirFolder, buildFlowDirCache
+from CountyIndex import DIST_METERS, downstreamMiles
+from BatchDriver import workerCount, runBatch, reportSummary
+from Manifest import fingerprint, stagePrint, currentStage, clearStage, markDone, damFingerprint, tableFingerprint
+from RunLog import RunLog, reportRunLog
 arcpy.env.overwriteOutput = True
 
-fpList = []
-if workingFolder.endswith(".gdb") and arcpy.Exists(os.path.join(workingFolder, "splitStreams")):
-    arcpy.AddMessage("Working on " + workingFolder)
-    fpSuccess = createMainFlowPath(workingFolder, "splitStreams")
-    if fpSuccess:
-        fpList = checkFlowPath(workingFolder, "flowPath", fpList)
-    delLayers(["splitStreams", "flowPath_seg", "flowPath_us_seg"])
-else: 
-    for gdb in arcpy.ListWorkspaces():
-        if gdb.endswith(".gdb") and arcpy.Exists(os.path.join(gdb, "splitStreams")):
-            arcpy.AddMessage("Working on " + gdb)
-            arcpy.env.workspace=gdb
-            fpSuccess = createMainFlowPath(gdb, "splitStreams")
-            if fpSuccess:
-                fpList = checkFlowPath(gdb, "flowPath", fpList)
-            delLayers(["splitStreams", "flowPath_seg", "flowPath_us_seg"])
-
-if len(fpList)>0:
-    arcpy.AddWarning("The following flowPaths are shorter than 5 miles or contain multiple lines: " + ", ".join(fpList))
-else:
-    arcpy.AddMessage("Flow path set up complete.")
-   
+if __name__ == '__main__':
+    workingFolder = arcpy.GetParameterAsText(0)         #set GDB or folder containing GDB(s)
+    workers = workerCount(arcpy.GetParameterAsText(1))  #number of worker processes for a folder of GDBs
+    force = arcpy.GetParameterAsText(2).lower() == "true"   #rerun dams even if their inputs are unchanged
+    engine = arcpy.GetParameterAsText(3) or "Vector"        #flow path engine, Vector, D8 or Auto
+    demCacheFolder = arcpy.GetParameterAsText(4)            #DEM cache folder from Setup, needed for D8 and Auto
+    arcpy.env.workspace = workingFolder
+    batchStart = time.time()
+
+    #D8 and Auto trace on the regional DEM cache, stop before any dam is touched when it is not given
+    if engine not in ("Vector", "D8", "Auto"):
+        arcpy.AddError("Unknown flow path engine " + engine + ", use Vector, D8 or Auto.")
+        sys.exit(1)
+    if engine != "Vector" and not (demCacheFolder and os.path.isdir(demCacheFolder)):
+        arcpy.AddError("The " + engine + " engine needs the DEM cache folder made by Setup (Parameter[4]), got '" + demCacheFolder + "'.")
+        sys.exit(1)
+
+    #Flow directions are computed once for the regional DEM cache
+    if engine != "Vector":
+        buildFlowDirCache(DemCache(demCacheFolder))
+        arcpy.env.workspace = workingFolder
+
+    fpList = []
+    gdbs = [workingFolder]
+    if workingFolder.endswith(".gdb") and arcpy.Exists(os.path.join(workingFolder, "splitStreams")):
+        if runDam(workingFolder, force, engine, demCacheFolder):
+            fpList.append(os.path.basename(workingFolder).split('.')[0])
+    else: 
+        gdbs = [gdb for gdb in arcpy.ListWorkspaces() if gdb.endswith(".gdb") and arcpy.Exists(os.path.join(gdb, "splitStreams"))]
+        if workers>1:
+            results = runBatch("Step2_CreateFlowPath", "runDam", gdbs, [force, engine, demCacheFolder], workers)
+            fpList = [os.path.basename(r.gdb).split('.')[0] for r in results if r.status == "ok" and r.value]
+            reportSummary(results)
+        else:
+            for gdb in gdbs:
+                if runDam(gdb, force, engine, demCacheFolder):
+                    fpList.append(os.path.basename(gdb).split('.')[0])
+    reportRunLog(gdbs, batchStart)
+
+    if len(fpList)>0:
+        arcpy.AddWarning("The following flowPaths are shorter than 5 miles or contain multiple lines: " + ", ".join(fpList))
+    else:
+        arcpy.AddMessage("Flow path set up complete.")
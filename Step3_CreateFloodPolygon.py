@@ -3,10 +3,64 @@
 # Desc: Automates the creation of a water surface based on estimated wave height.
 #     Subtracts DEM from water elevation to determine flooded area.
 #     Parameter[0] Note - choosing a geodatabase as the workspace will run a single dam. Choosing a folder will run on all dams in the folder. 
+#     Parameter[4] Note - in folder mode, more than one worker runs the dams in parallel processes (BatchDriver.py).
+#     Parameter[6] Note - with the NumPy engine, DEMs larger than the memory budget are flooded in tiles (FloodEngine.floodTiled).
+#     Parameter[7] Note - a list of wave model scenarios runs every scenario in one pass per dam (runScenarios).
+#     Parameter[8] Note - Store output mode appends every dam to one indexed extent feature class and a depth mosaic (OutputStore.py).
+#     Parameter[10] Note - the _Raw polygon copy is kept by default in Separate mode only.
+#     Parameter[11] Note - a vertical tolerance switches to adaptive point sampling: points are placed where the DEM profile
+#     along the flow path departs from a straight line by more than the tolerance, at most Parameter[12] meters apart.
+#     Parameter[13] Note - ground under the WSE points is sampled from the DEM array, Nearest (default) or Bilinear.
+#     Parameter[14] Note - with the Setup DEM cache folder, the NumPy engine and the ground sampling read the DEM cells from
+#     the cache tiles (DemCache.gridReader). In folder mode the reaches shared by several dams' flow paths are cached
+#     once with their DEM window, chainage and ground profile (SharedReach.py), and each dam adds only its own wave heights.
+#     Flood statistics (area, depths, volume, reach of each depth threshold) are computed from the depth grid as it is
+#     produced, recorded in the dam manifest and written to the FloodStats table of the output GDB.
+#     flowPath is left as Step2 wrote it; the 2, 5 or 10 mile flow path is saved as clipFlowPath.
+#     Stage times, memory and errors go to <DamID>.runlog.jsonl (RunLog.py), summarized at the end of the run.
 # ------------------------------------------------------------------------------
 
+#Grid and windowed reader of a dam's clipDEM. With the DEM cache it was cut from, the cells are read from the cache tiles.
+def demReader(dem, demCache=None):
+    grid = rasterGrid(dem)
+    readDem = demCache.gridReader(grid) if demCache != None else None
+    return grid, readDem or rasterReader(dem, grid)
+
+#DEM profile along a line every cell, read from the DEM window around the line. Returns (stations, ground).
+#On the shared reaches of the flow path (SharedReach.DamReaches) the cached reach profiles are used.
+def lineProfile(readDem, grid, vx, vy, partStarts, length, reaches=None):
+    def sampleOwn(stations):
+        ptX, ptY = pointsAlong(vx, vy, partStarts, stations)
+        return sampleGround(readDem, grid, ptX, ptY)
+    if reaches != None:
+        return reaches.profile(length, grid.cellSize, sampleOwn)
+    stations = stationsAlong(length, grid.cellSize)
+    return stations, sampleOwn(stations)
+
+#Ground under points at stations along the flow path, from the cached shared reaches where it has them
+def groundAt(readDem, grid, stations, xs, ys, method="Nearest", reaches=None):
+    sampleOwn = lambda x, y: sampleGround(readDem, grid, x, y, method)
+    if reaches == None:
+        return sampleOwn(xs, ys)
+    return reaches.ground(stations, xs, ys, sampleOwn, method)
+
+#Stations of the points along a line: every spacing meters, or with a tolerance only where the ground profile
+#departs from a straight line by more than the tolerance, at most maxSpacing apart (adaptiveStations).
+def pointStations(length, spacing, readDem=None, grid=None, vx=None, vy=None, partStarts=None, tolerance=None, maxSpacing=None, reaches=None):
+    if tolerance == None:
+        return stationsAlong(length, spacing)
+    stations, ground = lineProfile(readDem, grid, vx, vy, partStarts, length, reaches)
+    return adaptiveStations(stations, ground, tolerance, maxSpacing or 10*spacing)
+
 #Create points along river lines every x distance, starting at the dam location.
-def addWSEPoints(spacing, damID, flowPath, WSE_FC, WSE2_FC):
+#With a tolerance the points are placed adaptively along the DEM profile (pointStations).
+#WSE2_FC is created with the fields of the WSE_FC template and RASTERVALU. The ground under the points is sampled
+#from the DEM (Nearest or Bilinear) and RASTERVALU, WaveElev and TSValue are written in the insert that creates them.
+#Points over DEM NoData are left out with a warning. demCache is the DEM cache clipDEM was cut from (demReader).
+#reaches are the flow path's shared reaches (SharedReach.damReaches); their ground comes from the reach cache and
+#only the wave heights are the dam's own.
+#WSE2_FC stays in the dam GDB with the points of the last run; WSE_FC is only the template.
+def addWSEPoints(spacing, damID, flowPath, WSE_FC, WSE2_FC, dem, tolerance=None, maxSpacing=None, method="Nearest", demCache=None, reaches=None):
 
     #Get dam height
     with arcpy.da.SearchCursor("dam"+damID, ["DamID", "Dam_height"]) as cursor:
@@ -17,43 +71,39 @@ def addWSEPoints(spacing, damID, flowPath, WSE_FC, WSE2_FC):
                 damHeight = float(row[1])
     del row, cursor
 
-    #Create list of points to be created and add to WaveHtPts feature class
-    for stream in arcpy.da.SearchCursor(flowPath, ["SHAPE@"]): 
-        points = []
-        length = int(stream[0].length)                  #units should be meters
-        for i in xrange(0, length + spacing, spacing):  #add point every x meters
-            point = stream[0].positionAlongLine(i)
-            points.append(point)
-        points.pop()
-        arcpy.Append_management(points, WSE_FC, "NO_TEST")
-
-        #Check where OBJECTID numbering starts for the newest points
-        with arcpy.da.SearchCursor(WSE_FC, ["OBJECTID", "Dist_DS"]) as sCursor:
-            for row in sCursor:
-                if row[1] == None:
-                    firstID = row[0]
-                    break
-        del row, sCursor
-
-        #Calculate wave height given dam height and distance from dam
-        with arcpy.da.UpdateCursor(WSE_FC, ["OBJECTID", "Dist_DS", "WaveHt"]) as cursor:
-            for row in cursor:
-                if row[0]>= firstID:
-                    row[1]= (row[0]-firstID)*(spacing/1609.344) #Dist_DS in miles
-                    row[2]=(0.5*damHeight)-(damHeight/40.0)*(row[1]) #WaveHt = WaveHt at dam - WaveHt Change per mile * Dist_DS in miles
-                    cursor.updateRow(row)
-        del row, cursor
-    del stream
-
-    #Get elevation at points. Calculate fields.
-    ExtractValuesToPoints(WSE_FC, dem, WSE2_FC)
-    arcpy.CalculateField_management(WSE2_FC, "WaveElev", "[RASTERVALU] + [WaveHt]")
-    arcpy.CalculateField_management(WSE2_FC, "TSValue", "[RASTERVALU] + [WaveHt]")
+    grid, readDem = demReader(dem, demCache)
+    if arcpy.Exists(WSE2_FC):
+        arcpy.Delete_management(WSE2_FC)
+    arcpy.CreateFeatureclass_management(arcpy.env.workspace, WSE2_FC, "POINT", WSE_FC, "", "", WSE_FC)
+    arcpy.AddField_management(WSE2_FC, "RASTERVALU", "DOUBLE")
+
+    #Interpolate points every x meters from the flow path vertices, sample the ground under them
+    #and insert them with Dist_DS, WaveHt, RASTERVALU, WaveElev and TSValue populated
+    noData = 0
+    with arcpy.da.SearchCursor(flowPath, ["SHAPE@"]) as streamCursor:
+        with arcpy.da.InsertCursor(WSE2_FC, ["SHAPE@XY", "Dist_DS", "WaveHt", "RASTERVALU", "WaveElev", "TSValue"]) as iCursor:
+            for stream in streamCursor:
+                xs, ys, partStarts = lineVertices(stream[0])
+                stations = pointStations(stream[0].length, spacing, readDem, grid, xs, ys, partStarts, tolerance, maxSpacing, reaches)   #units should be meters
+                ptX, ptY = pointsAlong(xs, ys, partStarts, stations)
+                distDS = stations/METERS_PER_MILE                           #Dist_DS in miles
+                waveHt = waveHeight(damHeight, distDS)
+                ground = groundAt(readDem, grid, stations, ptX, ptY, method, reaches)
+                found = numpy.isfinite(ground)
+                noData += int((~found).sum())
+                waveElev = ground[found] + waveHt[found]
+                for x, y, dist, height, elev, wse in zip(ptX[found].tolist(), ptY[found].tolist(), distDS[found].tolist(), waveHt[found].tolist(),
+                                                         ground[found].tolist(), waveElev.tolist()):
+                    iCursor.insertRow([(x, y), dist, height, elev, wse, wse])
+    del streamCursor, iCursor
+    if noData > 0:
+        arcpy.AddWarning("%s %d flow path points over DEM NoData left out" %(damID, noData))
     
     return damHeight
 
 
-#Add Upstream WSE Points
+#Add Upstream WSE Points every spacing meters. Their wave elevation steps down from the flow path with distance
+#upstream and does not use the ground, so they are never placed adaptively.
 def add_US_WSEPoints(spacing, damID, flowPath, flowPath_us, WSE2_FC):
 
     #Get dam height
@@ -63,121 +113,167 @@ def add_US_WSEPoints(spacing, damID, flowPath, flowPath_us, WSE2_FC):
                 damHeight = float(row[1])
     del row, cursor
 
-    #Create Upstream points
-    with arcpy.da.UpdateCursor(flowPath_us, ["SHAPE@", "FROM_WSE", "TO_WSE"]) as streamCursor:
-        for stream in streamCursor:
-            points = []
-            length = int(stream[0].length)                      #units should be meters
-            for i in xrange(0, length + spacing, spacing):      #add point every x meters
-                point = stream[0].positionAlongLine(length-i)   #start at DS end of stream
-                points.append(point)
-            xy = [points[0].getPart().X, points[0].getPart().Y] #coordinates for DS end of stream
-
-            #Remove first and last point along flowPath_us
-            points.pop()
-            if len(points)>0:            
-                points.pop(0)
-
-            #Find the WSE value of the flowPath point closest to the DS end of flowPath_us.
-            closeDist = 8000  #random large distance value
-            with arcpy.da.SearchCursor(WSE2_FC, ["OBJECTID", "WaveElev", "SHAPE@"]) as cursor:
-                for row in cursor:
-                    WSE_XY = [row[2].getPart().X, row[2].getPart().Y]
-                    distance = hypot(xy[0]-WSE_XY[0], xy[1]-WSE_XY[1])
-                    if distance<closeDist:
-                        closeDist = distance
-                        WSE_Value = row[1]                    
-            del row, cursor
-
-            #Create the points
-            if len(points)>0:
-                arcpy.Append_management(points, WSE2_FC, "NO_TEST") 
-
-                #Check where OBJECTID numbering starts for the newest points
-                with arcpy.da.SearchCursor(WSE2_FC, ["OBJECTID", "WaveElev"]) as sCursor:
-                    for row in sCursor:
-                        if row[1] == None:
-                            firstID = row[0]
-                            break
-                del row, sCursor
+    #Index the main-stem WSE points once for the nearest point lookups
+    mainX, mainY, mainWSE = [], [], []
+    with arcpy.da.SearchCursor(WSE2_FC, ["WaveElev", "SHAPE@XY"]) as cursor:
+        for row in cursor:
+            if row[0] != None:
+                mainWSE.append(row[0])
+                mainX.append(row[1][0])
+                mainY.append(row[1][1])
+    del cursor
+    wseGrid = PointGrid(mainX, mainY, 100.0)
+
+    #Create Upstream points with WaveElev and TSValue populated in the same insert
+    with arcpy.da.InsertCursor(WSE2_FC, ["SHAPE@XY", "WaveElev", "TSVALUE"]) as iCursor:
+        with arcpy.da.UpdateCursor(flowPath_us, ["SHAPE@", "FROM_WSE", "TO_WSE", "OID@"]) as streamCursor:
+            for stream in streamCursor:
+                xs, ys, partStarts = lineVertices(stream[0])
+                length = int(stream[0].length)                          #units should be meters
+                usDist = stationsAlong(length, spacing)[1:]             #skip the first point, at the DS end of the stream
+                ptX, ptY = pointsAlong(xs, ys, partStarts, length - usDist)
+                endX, endY = pointsAlong(xs, ys, partStarts, numpy.array([length], float))
+
+                #Find the WSE value of the flowPath point closest to the DS end of flowPath_us.
+                closest = wseGrid.nearest(endX[0], endY[0], 8000)
+                if closest == None:
+                    arcpy.AddWarning("%s no flowPath WSE point near tributary %s" %(damID, stream[3]))
+                    continue
+                WSE_Value = mainWSE[closest[0]]
 
                 #Calculate Wave Elevation as decreasing the farther you go upstream
-                with arcpy.da.UpdateCursor(WSE2_FC, ["OBJECTID", "WaveElev", "TSVALUE"]) as cursor:
-                    for row in cursor:
-                        if row[0]>= firstID:
-                            #WSE = WSE at flowPath - (WaveHt Change per mile)(Dist_DS in miles)...(The '+ 1' adds distance for the missing first point)
-                            row[1]= WSE_Value - (damHeight/40.0)*Float(row[0]-firstID+1)*(spacing/1609.344)
-                            row[2]= WSE_Value - (damHeight/40.0)*Float(row[0]-firstID+1)*(spacing/1609.344)
-                            cursor.updateRow(row)
-                del row, cursor
-
-            #Fill in TO_WSE/FROM_WSE for flowPath_us
-            stream[2] = WSE_Value
-            #WSE at US end of tributary = WSE - WaveHt Change per mile * Length in miles
-            stream[1] = WSE_Value - (damHeight/40.0)*(stream[0].length/1609.344)
-            streamCursor.updateRow(stream)
-        
-    del stream, streamCursor
+                #WSE = WSE at flowPath - (WaveHt Change per mile)(Dist upstream in miles)
+                waveElev = WSE_Value - (damHeight/40.0)*(usDist/METERS_PER_MILE)
+                for x, y, elev in zip(ptX.tolist(), ptY.tolist(), waveElev.tolist()):
+                    iCursor.insertRow([(x, y), elev, elev])
+
+                #Fill in TO_WSE/FROM_WSE for flowPath_us
+                stream[2] = WSE_Value
+                #WSE at US end of tributary = WSE - WaveHt Change per mile * Length in miles
+                stream[1] = WSE_Value - (damHeight/40.0)*(stream[0].length/METERS_PER_MILE)
+                streamCursor.updateRow(stream)
+    del streamCursor, iCursor
     
 
-#Run Arc Hydro Tools to get flooded area.
-def getFloodPolygon(workspace, flowPath, in_pts, out_pts, dem):
-    arcpy.MakeFeatureLayer_management(out_pts, "WaveHtPts2")
-    ArcHydroTools.AssignHydroID("WaveHtPts2")
+#WSE along the flow path and its tributaries as stream cells of the DEM grid, in place of the TIMESERIES,
+#3D line and Convert3DLineToRaster round trip. The main stem WSE is interpolated between the WaveElev points
+#by Dist_DS, every half cell along the line; tributaries run linearly from FROM_WSE at their upstream end
+#to TO_WSE at the flow path. Returns (rows, cols, values) of the first line crossing each cell.
+def streamWSECells(grid, flowPath, flowPath_us, out_pts):
+    step = grid.cellSize/2.0
+    stations, wse = [], []
+    with arcpy.da.SearchCursor(out_pts, ["Dist_DS", "WaveElev", "RASTERVALU"]) as cursor:
+        for row in cursor:
+            if row[0] != None and row[1] != None and row[2] != None and row[2] > NODATA:
+                stations.append(row[0]*METERS_PER_MILE)
+                wse.append(row[1])
+    del cursor
+    order = numpy.argsort(stations, kind="mergesort")
+    stations = numpy.array(stations, float)[order]
+    wse = numpy.array(wse, float)[order]
 
-    #Populate time series table. Setting a single time will apply the WSE to all points at once.
-    arcpy.env.workspace = workspace
-    with arcpy.da.SearchCursor(out_pts, ['HydroID', 'WaveElev']) as sCursor:
-        with arcpy.da.InsertCursor("TIMESERIES", ['FeatureID', 'TSTime', 'TSValue']) as iCursor:
-            for row in sCursor:
-                iCursor.insertRow([row[0],"11/11/2016 12:00:00 AM", row[1]])
-    del row, sCursor, iCursor
-
-    #Stream WSE from Point WSE (creates a rasterized line)
-    #Define Variables
+    xs, ys, values = [], [], []
+    if len(stations)>0:
+        with arcpy.da.SearchCursor(flowPath, ["SHAPE@"]) as streamCursor:
+            for stream in streamCursor:
+                vx, vy, partStarts = lineVertices(stream[0])
+                dense = stationsAlong(stream[0].length, step)
+                denseX, denseY = pointsAlong(vx, vy, partStarts, dense)
+                xs.append(denseX)
+                ys.append(denseY)
+                values.append(interpRows(dense, stations, wse[None, :])[0])
+        del streamCursor
+    with arcpy.da.SearchCursor(flowPath_us, ["SHAPE@", "FROM_WSE", "TO_WSE"]) as streamCursor:
+        for stream in streamCursor:
+            if stream[1] == None or stream[2] == None:
+                continue
+            vx, vy, partStarts = lineVertices(stream[0])
+            length = stream[0].length
+            dense = stationsAlong(length, step)
+            denseX, denseY = pointsAlong(vx, vy, partStarts, dense)
+            xs.append(denseX)
+            ys.append(denseY)
+            values.append(stream[1] + (stream[2] - stream[1])*dense/max(length, step))
+    del streamCursor
+    if len(xs) == 0:
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.float32)
+    rows, cols, cellValues = burnCells((grid.nrows, grid.ncols), grid.xmin, grid.ymax, grid.cellSize,
+                                       numpy.concatenate(xs), numpy.concatenate(ys), numpy.concatenate(values))
+    return rows, cols, cellValues[0]
+
+#XY and Dist_DS of the main stem WSE points, for the downstream distances of FloodStats
+def mainStemMiles(out_pts):
+    xs, ys, miles = [], [], []
+    with arcpy.da.SearchCursor(out_pts, ["SHAPE@XY", "Dist_DS"]) as cursor:
+        for row in cursor:
+            if row[1] != None:
+                xs.append(row[0][0])
+                ys.append(row[0][1])
+                miles.append(row[1])
+    del cursor
+    return numpy.array(xs, float), numpy.array(ys, float), numpy.array(miles, float)
+
+#FloodStats summary as a FloodStats table row
+def statsRow(name, damID, scenario, stats):
+    row = stats.summary()
+    row.update({"FloodName": name, "DamID": damID, "Scenario": scenario})
+    return row
+
+#Flood from the stream WSE. The NumPy engine (FloodEngine.py) takes the stream cells directly, ArcHydro's
+#FloodFromStreamWSEPy gets them as the LineRaster. Flood failures are logged with their traceback and reported as a warning.
+#stats is fed the depth grid, by the NumPy engine as it is produced or read back from ArcHydro's fdlayers.
+#With demCache the NumPy engine reads the DEM from the cache tiles (demReader).
+def getFloodPolygon(workspace, flowPath, out_pts, dem, engine, scratchFolder, runLog, budgetMB=None, stats=None, demCache=None):
     flowPath_us = os.path.join(workspace, "flowPath_us")
-    Line3D_us = os.path.join(workspace, "Line3D_us")
-    Line3D = os.path.join(workspace, "Line3D")
     LineRaster = os.path.join(workspace, "LineRaster")
-    TIMESERIES = os.path.join(workspace, "TIMESERIES")
-    parentFolder = os.path.dirname(workspace)
-
-    #Create 3D Lines
-    arcpy.AddMessage("...creating 3D lines...")
-    ArcHydroTools.UpdateTSValueonPoints(out_pts, TIMESERIES, 1, "11/11/2016 12:00:00 AM")
-    ArcHydroTools.PointTSValueto3DLine(out_pts, flowPath, dem, Line3D, "None", "No")
-    arcpy.FeatureTo3DByAttribute_3d(flowPath_us, Line3D_us, "FROM_WSE", "TO_WSE")
-    arcpy.Append_management(Line3D_us, Line3D, "NO_TEST") 
-
-    #Convert 3D Lines to Raster
-    arcpy.AddMessage("...converting line to raster...")
     try:
-        ArcHydroTools.Convert3DLineToRaster(dem, Line3D, LineRaster)
-        arcpy.env.workspace = workspace
-        outSetNull = SetNull(LineRaster, LineRaster, "VALUE=0") #Set zeroes to NULL
+        with runLog.stage("burn") as info:
+            arcpy.AddMessage("...burning stream WSE...")
+            grid, readDem = demReader(dem, demCache)
+            rows, cols, values = streamWSECells(grid, flowPath, flowPath_us, out_pts)
+            info["cells"] = len(rows)
+            info["demSize"] = [grid.nrows, grid.ncols]
+            if len(rows) == 0:
+                raise ValueError("no stream WSE on the DEM")
 
         #Flood from stream WSE
-        arcpy.AddMessage("...extrapolating out water surface...")
-        arcpy.Append_management(flowPath_us, flowPath, "NO_TEST") 
-        ArcHydroTools.FloodFromStreamWSEPy(outSetNull, dem, parentFolder, "Layers", flowPath)
+        with runLog.stage("flood") as info:
+            arcpy.AddMessage("...extrapolating out water surface...")
+            info["engine"] = engine
+            if engine == "NumPy":
+                info["tiled"] = budgetMB != None and not fitsBudget((grid.nrows, grid.ncols), budgetMB)
+                info["cells"] = floodFromCells(rows, cols, values, dem, workspace, budgetMB, scratchFolder, stats, readDem)
+            else:
+                saveGrid(cellReader(rows, cols, values), grid, LineRaster, budgetMB, scratchFolder)
+                flowPathAll = os.path.join(workspace, "flowPathAll")      #flow path and tributaries, flowPath itself is left as Step2 wrote it
+                arcpy.CopyFeatures_management(flowPath, flowPathAll)
+                arcpy.Append_management(flowPath_us, flowPathAll, "NO_TEST")
+                ArcHydroTools.FloodFromStreamWSEPy(LineRaster, dem, scratchFolder, "Layers", flowPathAll)
+                if stats != None:
+                    rasterStats(stats, os.path.join(scratchFolder, r"Layers\Layers\fdlayers"), budgetMB)
         return True
-    except:
+    except Exception as e:
+        arcpy.AddWarning("%s flood polygon failed: %s" %(os.path.basename(workspace).split('.')[0], str(e).strip()))
         return False
 
 #Copy flooding polygon so it doesn't get overwritten
-def saveFloodPolygon(workspace, damID, outWorkspace):
-    fpPath = os.path.join(os.path.dirname(workspace), r"Layers\Layers.gdb\Layers\FPPolyLayers")
+def saveFloodPolygon(workspace, damID, outWorkspace, scratchFolder, keepRaw=True):
+    fpPath = os.path.join(scratchFolder, r"Layers\Layers.gdb\Layers\FPPolyLayers")
+    if not arcpy.Exists(fpPath):
+        fpPath = os.path.join(workspace, "FPPolyLayers")       #NumPy engine writes its outputs to the dam GDB
     if arcpy.Exists(fpPath):
-        arcpy.Copy_management(fpPath, os.path.join(outWorkspace, damID + "_Raw"))
+        if keepRaw:
+            arcpy.Copy_management(fpPath, os.path.join(outWorkspace, damID + "_Raw"))
         arcpy.Copy_management(fpPath, os.path.join(outWorkspace, damID + "_Final"))
-    wsePath = os.path.join(os.path.dirname(workspace), r"Layers\Layers\wselayers")
+    wsePath = os.path.join(scratchFolder, r"Layers\Layers\wselayers")
     if arcpy.Exists(wsePath):
         arcpy.CopyRaster_management(wsePath, os.path.join(workspace, "wselayers"))
-    fdPath = os.path.join(os.path.dirname(workspace), r"Layers\Layers\fdlayers")
+    fdPath = os.path.join(scratchFolder, r"Layers\Layers\fdlayers")
     if arcpy.Exists(fdPath):
         arcpy.CopyRaster_management(fdPath, os.path.join(workspace, "fdlayers"))
     
-#Clean up flowPath fc, clip to 5 miles
+#Clip the flow path to 2, 5 or 10 miles as the clipFlowPath fc. flowPath is left as Step2 wrote it,
+#so a redo of the flood polygon starts from the full path.
 def clipFlowPath(workspace, flowPath, splitPt, flowPath1):
     #Use Surface_area to pick downstream distance
     damID = os.path.basename(workspace).split('.')[0]
@@ -186,13 +282,7 @@ def clipFlowPath(workspace, flowPath, splitPt, flowPath1):
             damSA = row[0]
     del row, damCursor
 
-    distDS = {2: 3218.688, 5: 8046.72, 10: 16093.44}
-    if damSA >= 25 and damSA < 100 or damSA==None or damSA=='':
-        lenDS = distDS[5]  #5 miles in meters
-    elif damSA < 25:
-        lenDS = distDS[2]  #2 miles in meters
-    else:
-        lenDS = distDS[10]  #10 miles in meters
+    lenDS = DIST_METERS[downstreamMiles(damSA)]     #2, 5 or 10 miles in meters
     
     for flowLine in arcpy.da.SearchCursor(flowPath, ["OBJECTID", "SHAPE@"]): 
         if flowLine[0]==1 and int(flowLine[1].length)>lenDS:
@@ -203,88 +293,312 @@ def clipFlowPath(workspace, flowPath, splitPt, flowPath1):
     del flowLine
 
     #Limit main flow path to 5 miles
-    if arcpy.Exists(splitPt):
-        arcpy.Delete_management(flowPath)
-        arcpy.MakeFeatureLayer_management(flowPath1, "flowPath1")
-        arcpy.SelectLayerByAttribute_management("flowPath1", "", ' "OBJECTID" = 1 ')
-        arcpy.CopyFeatures_management("flowPath1", flowPath)
-        arcpy.Delete_management("flowPath1")
-    else:
-        arcpy.MakeFeatureLayer_management(flowPath, "flowPath_lyr")
-        arcpy.SelectLayerByAttribute_management("flowPath_lyr", "", ' "OBJECTID" = 1 ')
-        arcpy.CopyFeatures_management("flowPath_lyr", "flowPath1")
-        arcpy.Delete_management("flowPath")
-        arcpy.CopyFeatures_management("flowPath1", "flowPath")
-        arcpy.Delete_management("flowPath1")
+    source = flowPath1 if arcpy.Exists(splitPt) else flowPath
+    arcpy.MakeFeatureLayer_management(source, "flowPath_lyr")
+    arcpy.SelectLayerByAttribute_management("flowPath_lyr", "", ' "OBJECTID" = 1 ')
+    arcpy.CopyFeatures_management("flowPath_lyr", os.path.join(workspace, "clipFlowPath"))
+    arcpy.Delete_management("flowPath_lyr")
 
 #Clear MXD
 def delLayers(delList):
     for lyr in delList:
         if arcpy.Exists(lyr):
             arcpy.Delete_management(lyr)
- 
-#---------------------------------------------------------------------------------
-import arcpy, ArcHydroTools, os, sys
-from arcpy import env
-from math import hypot
-from arcpy.sa import *
-workingFolder = arcpy.GetParameterAsText(0)         #set GDB or folder containing GDB(s)
-outWorkspace = arcpy.GetParameterAsText(1)          #GDB where resulting flood polygon will be saved
-spacing = int(arcpy.GetParameterAsText(2))          #set point spacing, smaller spacing gives more detail
-dem = "clipDEM"
-
-arcpy.env.workspace = workingFolder
-arcpy.env.overwriteOutput = True
 
-#Works on a single dam GDB
-if workingFolder.endswith(".gdb"):
-    damID = os.path.basename(workingFolder).split('.')[0]
+#Whether every named flood polygon is in the output GDB, as a feature class or in the output store
+def published(outWorkspace, names):
+    return all([arcpy.Exists(os.path.join(outWorkspace, name + "_Final")) or isStored(outWorkspace, name) for name in names])
+
+#Run the flood polygon steps for one dam GDB. ArcHydro writes its Layers to a scratch folder for the dam.
+#With stage set the polygons are saved in the dam GDB for the main process to publish (see publishFloodPolygon).
+#Dams whose flow path, dam row, DEM and settings are unchanged since their last flood polygon are skipped.
+#budgetMB bounds the NumPy engine's memory, larger DEMs are flooded in tiles.
+#A tolerance places the WSE points adaptively, at most maxSpacing apart (pointStations); method samples the ground under them.
+#With the Setup DEM cacheFolder, the DEM cells are read from its tiles and the ground on the flow path's shared reaches
+#from its reach cache (SharedReach.py); the cache sources and the reaches used are part of the fingerprint.
+def runDam(gdb, outWorkspace, spacing, engine, budgetMB=None, force=False, stage=False, keepRaw=True, tolerance=None, maxSpacing=None, method="Nearest",
+           cacheFolder=None):
+    arcpy.env.workspace = gdb
+    damID = os.path.basename(gdb).split('.')[0]
+    flowPath = os.path.join(gdb, "flowPath")
+    flowPath1 = os.path.join(gdb, "flowPath1")
+    flowPath_us = os.path.join(gdb, "flowPath_us")
+    splitPt = os.path.join(gdb, "splitPt")
+    dem = os.path.join(gdb, "clipDEM")
+    demCache = DemCache(cacheFolder) if cacheFolder else None
+    reaches = damReaches(reachFolder(cacheFolder), damID, flowPathPrint(gdb), cacheStamp(demCache)) if demCache else None
+    stamp = fingerprint(stagePrint(gdb, "flowpath"), damFingerprint("dam"+damID), rasterFingerprint(dem), spacing, engine, tolerance, maxSpacing, method,
+                        demCache.index["sources"] if demCache else None, reaches.uses if reaches else None)
+    if not force and currentStage(gdb, "flood", stamp) and published(outWorkspace, [damID]):
+        arcpy.AddMessage("%s inputs unchanged, flood polygon kept" %(damID))
+        return False
+    clearStage(gdb, "flood")
+
     arcpy.AddMessage("Starting dam " + str(damID))
-    flowPath = os.path.join(workingFolder, "flowPath")
-    flowPath1 = os.path.join(workingFolder, "flowPath1")
-    flowPath_us = os.path.join(workingFolder, "flowPath_us")
-    splitPt = os.path.join(workingFolder, "splitPt")
-    dem = os.path.join(workingFolder, "clipDEM")
-    damHeight = addWSEPoints(spacing, damID, flowPath, 'WaveHtPts', "WaveHtPts2")
+    runLog = RunLog(gdb, "Step3")
+    scratchFolder = os.path.join(os.path.dirname(gdb), "Scratch", damID)
+    if not os.path.exists(scratchFolder):
+        os.makedirs(scratchFolder)
+    saveWorkspace = gdb if stage else outWorkspace
+
+    success = False
+    with runLog.stage("points") as info:
+        damHeight = addWSEPoints(spacing, damID, flowPath, 'WaveHtPts', "WaveHtPts2", dem, tolerance, maxSpacing, method, demCache, reaches)
+        if damHeight != 0:
+            add_US_WSEPoints(100, damID, flowPath, flowPath_us, "WaveHtPts2")
+            info["points"] = featureCount("WaveHtPts2")
     if damHeight == 0:
         arcpy.AddWarning("%s height = 0" %(damID))
-        pass
     else:
-        add_US_WSEPoints(100, damID, flowPath, flowPath_us, "WaveHtPts2")
-        success = getFloodPolygon(workingFolder, flowPath, "WaveHtPts", "WaveHtPts2", dem)
+        xs, ys, miles = mainStemMiles("WaveHtPts2")
+        stats = FloodStats(rasterGrid(dem), xs, ys, miles)
+        success = getFloodPolygon(gdb, flowPath, "WaveHtPts2", dem, engine, scratchFolder, runLog, budgetMB, stats, demCache)
         if success:
-            saveFloodPolygon(workingFolder, damID, outWorkspace)
-            clipFlowPath(workingFolder, flowPath, splitPt, flowPath1)            
-        else:
-            arcpy.AddWarning("%s Memory Error" %(damID))
-        delLayers(["WaveHtPts2", "Line3D", "Line3D", "Line3D_us", "Line3D_us", "LineRaster", "LineToGrid", "splitPt", "outSetNull", "flowPath1"])
-        fpGDB = os.path.join(os.path.dirname(workingFolder), "Layers\Layers.gdb")
+            with runLog.stage("save"):
+                saveFloodPolygon(gdb, damID, saveWorkspace, scratchFolder, keepRaw)
+                clipFlowPath(gdb, flowPath, splitPt, flowPath1)
+            markDone(gdb, "flood", stamp, [statsRow(damID, damID, "", stats)])
+        delLayers(["LineRaster", "splitPt", "flowPath1", "flowPathAll", "FPPolyLayers"])
+        fpGDB = os.path.join(scratchFolder, r"Layers\Layers.gdb")
         delLayers([fpGDB, os.path.dirname(fpGDB)])
+    shutil.rmtree(scratchFolder, True)
+    return success
 
-#Works on multiple dam GDBs
-else: 
-    for gdb in arcpy.ListWorkspaces():
-        if gdb.endswith(".gdb") and arcpy.Exists(os.path.join(gdb, "splitStreams")):
-            arcpy.env.workspace = gdb
-            damID = os.path.basename(gdb).split('.')[0]
-            arcpy.AddMessage("Starting dam " + str(damID))
-            flowPath = os.path.join(gdb, "flowPath")
-            flowPath1 = os.path.join(gdb, "flowPath1")
-            flowPath_us = os.path.join(gdb, "flowPath_us")
-            splitPt = os.path.join(gdb, "splitPt")
-            dem = os.path.join(gdb, "clipDEM")
-            damHeight = addWSEPoints(spacing, damID, flowPath, 'WaveHtPts', "WaveHtPts2")
-            if damHeight == 0:
-                arcpy.AddWarning("%s height = 0" %(damID))
-                pass
-            else:
-                add_US_WSEPoints(100, damID, flowPath, flowPath_us, "WaveHtPts2")
-                success = getFloodPolygon(gdb, flowPath, "WaveHtPts", "WaveHtPts2", dem)
-                if success:
-                    saveFloodPolygon(gdb, damID, outWorkspace)
-                    clipFlowPath(gdb, flowPath, splitPt, flowPath1)
-                else:
-                    arcpy.AddWarning("%s Memory Error" %(damID))
-                delLayers(["WaveHtPts2", "Line3D", "Line3D", "Line3D_us", "Line3D_us", "LineRaster", "LineToGrid", "splitPt", "outSetNull", "flowPath1"])
-                fpGDB = os.path.join(os.path.dirname(gdb), "Layers\Layers.gdb")
-                delLayers([fpGDB, os.path.dirname(fpGDB)])
+#WSE of every scenario along the flow path and its tributaries, as stream cells of the DEM grid.
+#Ground is sampled at the spaced (or adaptive) points as in addWSEPoints and the profiles are interpolated every half cell,
+#tributaries step down from the nearest flow path point as in add_US_WSEPoints. reaches are the shared reaches as in addWSEPoints.
+#Returns (rows, cols, values) and the XY and miles of the flow path points, or None, None.
+def scenarioStreamCells(grid, demArray, flowPath, flowPath_us, spacing, scenarios, damHeight, damID, tolerance=None, maxSpacing=None, method="Nearest",
+                        reaches=None):
+    step = grid.cellSize/2.0
+    xs, ys, values = [], [], []
+    mainX, mainY, mainWSE, mainMiles = [], [], [], []
+    with arcpy.da.SearchCursor(flowPath, ["SHAPE@"]) as streamCursor:
+        for stream in streamCursor:
+            vx, vy, partStarts = lineVertices(stream[0])
+            stations = pointStations(stream[0].length, spacing, arrayReader(demArray), grid, vx, vy, partStarts, tolerance, maxSpacing, reaches)
+            ptX, ptY = pointsAlong(vx, vy, partStarts, stations)
+            ground = groundAt(arrayReader(demArray), grid, stations, ptX, ptY, method, reaches)
+            found = numpy.isfinite(ground)
+            if not found.any():
+                continue
+            pointWSE = ground[found] + scenarioWaveHeights(scenarios, damHeight, stations[found]/METERS_PER_MILE)
+            dense = stationsAlong(stream[0].length, step)
+            denseX, denseY = pointsAlong(vx, vy, partStarts, dense)
+            xs.append(denseX)
+            ys.append(denseY)
+            values.append(interpRows(dense, stations[found], pointWSE))
+            mainX.extend(ptX[found].tolist())
+            mainY.extend(ptY[found].tolist())
+            mainMiles.extend((stations[found]/METERS_PER_MILE).tolist())
+            mainWSE.append(pointWSE)
+    del streamCursor
+    if len(mainX) == 0:
+        return None, None
+
+    mainWSE = numpy.hstack(mainWSE)
+    wseGrid = PointGrid(mainX, mainY, 100.0)
+    drops = scenarioDrops(scenarios, damHeight)[:, None]
+    with arcpy.da.SearchCursor(flowPath_us, ["SHAPE@", "OID@"]) as streamCursor:
+        for stream in streamCursor:
+            vx, vy, partStarts = lineVertices(stream[0])
+            length = stream[0].length
+            endX, endY = pointsAlong(vx, vy, partStarts, numpy.array([length], float))
+            closest = wseGrid.nearest(endX[0], endY[0], 8000)
+            if closest == None:
+                arcpy.AddWarning("%s no flowPath WSE point near tributary %s" %(damID, stream[1]))
+                continue
+            #WSE falls by the scenario's drop per mile going up the tributary from TO_WSE at its downstream end
+            dense = stationsAlong(length, step)
+            denseX, denseY = pointsAlong(vx, vy, partStarts, dense)
+            xs.append(denseX)
+            ys.append(denseY)
+            values.append(mainWSE[:, closest[0]][:, None] - drops*((length - dense)/METERS_PER_MILE)[None, :])
+    del streamCursor
+    cells = burnCells((grid.nrows, grid.ncols), grid.xmin, grid.ymax, grid.cellSize, numpy.concatenate(xs), numpy.concatenate(ys), numpy.hstack(values))
+    return cells, (numpy.array(mainX), numpy.array(mainY), numpy.array(mainMiles))
+
+#Flood every scenario for one dam GDB with the NumPy engine. The DEM is read once, and the sample points,
+#stream cells and nearest stream allocation are shared by all scenarios; only the WSE profile changes.
+#Each scenario saves <DamID>_<name>_Final (and _Raw) polygons and an fd_<name> depth grid in the dam GDB.
+#With the Setup DEM cacheFolder, the DEM is read from its tiles and the shared reaches from its reach cache as in runDam.
+def runScenarios(gdb, outWorkspace, spacing, scenarios, budgetMB=None, force=False, stage=False, keepRaw=True, tolerance=None, maxSpacing=None, method="Nearest",
+                 cacheFolder=None):
+    arcpy.env.workspace = gdb
+    damID = os.path.basename(gdb).split('.')[0]
+    flowPath = os.path.join(gdb, "flowPath")
+    flowPath1 = os.path.join(gdb, "flowPath1")
+    flowPath_us = os.path.join(gdb, "flowPath_us")
+    splitPt = os.path.join(gdb, "splitPt")
+    dem = os.path.join(gdb, "clipDEM")
+    names = [arcpy.ValidateTableName(damID + "_" + scenario.name, outWorkspace) for scenario in scenarios]
+    demCache = DemCache(cacheFolder) if cacheFolder else None
+    reaches = damReaches(reachFolder(cacheFolder), damID, flowPathPrint(gdb), cacheStamp(demCache)) if demCache else None
+    stamp = fingerprint(stagePrint(gdb, "flowpath"), damFingerprint("dam"+damID), rasterFingerprint(dem), spacing, [list(scenario) for scenario in scenarios],
+                        tolerance, maxSpacing, method, demCache.index["sources"] if demCache else None, reaches.uses if reaches else None)
+    if not force and currentStage(gdb, "flood", stamp) and published(outWorkspace, names):
+        arcpy.AddMessage("%s inputs unchanged, scenario polygons kept" %(damID))
+        return False
+    clearStage(gdb, "flood")
+
+    damHeight = 0
+    with arcpy.da.SearchCursor("dam"+damID, ["Dam_height"]) as cursor:
+        for row in cursor:
+            if row[0] != None and row[0] != '':
+                damHeight = float(row[0])
+    del cursor
+    if damHeight == 0 and any([scenario.height == None for scenario in scenarios]):
+        arcpy.AddWarning("%s height = 0" %(damID))
+        return False
+
+    arcpy.AddMessage("Starting dam %s, %d scenarios" %(damID, len(scenarios)))
+    runLog = RunLog(gdb, "Step3")
+    scratchFolder = os.path.join(os.path.dirname(gdb), "Scratch", damID)
+    if not os.path.exists(scratchFolder):
+        os.makedirs(scratchFolder)
+    saveWorkspace = gdb if stage else outWorkspace
+
+    success = False
+    with runLog.stage("points") as info:
+        grid, demArray = readRaster(dem, budgetMB, scratchFolder, "dem", demReader(dem, demCache)[1])
+        cells, mainStem = scenarioStreamCells(grid, demArray, flowPath, flowPath_us, spacing, scenarios, damHeight, damID, tolerance, maxSpacing, method,
+                                              reaches)
+        info["cells"] = 0 if cells == None else len(cells[0])
+        info["scenarios"] = len(scenarios)
+    if cells == None or len(cells[0]) == 0:
+        arcpy.AddWarning("%s flow path is outside the DEM" %(damID))
+    else:
+        try:
+            floodDir = scratchFolder if budgetMB and not fitsBudget((grid.nrows, grid.ncols), budgetMB) else None
+            stats = FloodStats(grid, *mainStem)
+            floods = floodScenarios(demArray, cells[0], cells[1], cells[2], floodDir, budgetMB, stats)
+            statsRows = []
+            for scenario, name in zip(scenarios, names):
+                with runLog.stage("flood") as info:
+                    info["scenario"] = scenario.name
+                    stats.reset()
+                    depth, wse, extent = next(floods)
+                    info["cells"] = int(extent.sum())
+                    statsRows.append(statsRow(name, damID, scenario.name, stats))
+                with runLog.stage("save"):
+                    saveGrid(depth, grid, os.path.join(gdb, arcpy.ValidateTableName("fd_" + scenario.name, gdb)), budgetMB, scratchFolder)
+                    savePolygon(extent, grid, os.path.join(saveWorkspace, name + "_Final"), budgetMB, scratchFolder)
+                    if keepRaw:
+                        arcpy.Copy_management(os.path.join(saveWorkspace, name + "_Final"), os.path.join(saveWorkspace, name + "_Raw"))
+                del depth, wse, extent
+            floods.close()
+            clipFlowPath(gdb, flowPath, splitPt, flowPath1)
+            markDone(gdb, "flood", stamp, statsRows)
+            success = True
+        except Exception as e:
+            arcpy.AddWarning("%s scenario flood failed: %s" %(damID, str(e).strip()))
+        delLayers(["splitPt", "flowPath1"])
+    del demArray
+    shutil.rmtree(scratchFolder, True)
+    return success
+
+#Write the flood statistics recorded in a dam's manifest to the FloodStats table of the output GDB
+def publishFloodStats(gdb, outWorkspace):
+    done = loadManifest(gdb).get("flood")
+    if done and done.get("result"):
+        writeFloodStats(outWorkspace, done["result"])
+
+#Move the polygons staged in a dam GDB into the output GDB. With a store, _Final polygons are appended
+#to its extent feature class with the matching depth grid (fdlayers, or fd_<name> for a scenario),
+#and _Raw copies are still moved as feature classes.
+def publishFloodPolygon(gdb, damID, outWorkspace, store=None):
+    workspace = arcpy.env.workspace
+    arcpy.env.workspace = gdb
+    for staged in arcpy.ListFeatureClasses(damID + "_*"):
+        if store != None and staged.endswith("_Final"):
+            name = staged[:-len("_Final")]
+            scenario = name[len(damID) + 1:]
+            store.addExtent(name, damID, scenario, os.path.join(gdb, staged))
+            depth = os.path.join(gdb, arcpy.ValidateTableName("fd_" + scenario, gdb) if scenario else "fdlayers")
+            if arcpy.Exists(depth):
+                store.addDepth(name, damID, scenario, depth)
+        else:
+            arcpy.Copy_management(os.path.join(gdb, staged), os.path.join(outWorkspace, staged))
+        arcpy.Delete_management(os.path.join(gdb, staged))
+    arcpy.env.workspace = workspace
+ 
+#---------------------------------------------------------------------------------
+import arcpy, ArcHydroTools, os, sys, time, shutil
+from arcpy import env
+import numpy
+from SpatialIndex import PointGrid
+from WSEProfile import METERS_PER_MILE, lineVertices, stationsAlong, pointsAlong, waveHeight, adaptiveStations
+from WSEProfile import parseScenarios, scenarioWaveHeights, scenarioDrops, interpRows
+from FloodEngine import NODATA, floodFromCells, fitsBudget, floodScenarios, readRaster, rasterGrid, sampleGround, burnCells, cellReader, saveGrid, savePolygon
+from FloodEngine import FloodStats, rasterStats, rasterReader, arrayReader
+from CountyIndex import DIST_METERS, downstreamMiles
+from BatchDriver import workerCount, runBatch, reportSummary
+from Manifest import fingerprint, stagePrint, currentStage, clearStage, markDone, damFingerprint, rasterFingerprint, loadManifest
+from RunLog import RunLog, featureCount, reportRunLog
+from OutputStore import OutputStore, isStored, runStamp, writeFloodStats
+from SharedReach import buildSharedReaches, damReaches, reachFolder, flowPathPrint, cacheStamp
+from DemCache import DemCache, INDEX_FILE
+arcpy.env.overwriteOutput = True
+
+if __name__ == '__main__':
+    workingFolder = arcpy.GetParameterAsText(0)         #set GDB or folder containing GDB(s)
+    outWorkspace = arcpy.GetParameterAsText(1)          #GDB where resulting flood polygon will be saved
+    spacing = int(arcpy.GetParameterAsText(2))          #set point spacing, smaller spacing gives more detail
+    engine = arcpy.GetParameterAsText(3) or "ArcHydro"  #flood engine, ArcHydro or NumPy
+    workers = workerCount(arcpy.GetParameterAsText(4))  #number of worker processes for a folder of GDBs
+    force = arcpy.GetParameterAsText(5).lower() == "true"   #rerun dams even if their inputs are unchanged
+    budgetMB = float(arcpy.GetParameterAsText(6) or 2048)   #memory budget of the NumPy engine per dam, in MB
+    scenarios = parseScenarios(arcpy.GetParameterAsText(7)) #optional wave model scenarios, flooded with the NumPy engine
+    outputMode = arcpy.GetParameterAsText(8) or "Separate"  #Separate feature classes per dam, or one output Store
+    runID = arcpy.GetParameterAsText(9) or runStamp()       #run ID of the store rows, defaults to the start time
+    keepRaw = arcpy.GetParameterAsText(10).lower()          #also keep the _Raw polygon copy
+    keepRaw = keepRaw == "true" if keepRaw != "" else outputMode != "Store"
+    tolerance = arcpy.GetParameterAsText(11)                #optional vertical tolerance for adaptive point sampling
+    tolerance = float(tolerance) if tolerance != "" else None
+    maxSpacing = float(arcpy.GetParameterAsText(12) or 10*spacing)  #largest gap between adaptive points
+    method = arcpy.GetParameterAsText(13) or "Nearest"      #ground sampling at the WSE points, Nearest or Bilinear
+    cacheFolder = arcpy.GetParameterAsText(14)              #optional Setup DEM cache folder, the DEM is read from its tiles
+    arcpy.env.workspace = workingFolder
+    batchStart = time.time()
+
+    if cacheFolder and not os.path.exists(os.path.join(cacheFolder, INDEX_FILE)):
+        arcpy.AddError("'" + cacheFolder + "' is not a DEM cache folder made by Setup (Parameter[14]).")
+        sys.exit(1)
+
+    if len(scenarios)>0:
+        runFunc, args = runScenarios, [outWorkspace, spacing, scenarios, budgetMB, force]
+    else:
+        runFunc, args = runDam, [outWorkspace, spacing, engine, budgetMB, force]
+
+    gdbs = [workingFolder]
+    if not workingFolder.endswith(".gdb"):
+        gdbs = [gdb for gdb in arcpy.ListWorkspaces() if gdb.endswith(".gdb") and arcpy.Exists(os.path.join(gdb, "splitStreams"))]
+
+    #Store mode stages every dam in its GDB and appends it to the store from this process
+    store = None
+    if outputMode == "Store" and len(gdbs)>0:
+        store = OutputStore(outWorkspace, runID, arcpy.Describe(os.path.join(gdbs[0], "clipDEM")).spatialReference)
+
+    #The ground along flow path reaches shared by several dams is read once into the reach cache (SharedReach.py)
+    sampling = [tolerance, maxSpacing, method, cacheFolder or None]
+    if cacheFolder and len(gdbs)>1:
+        reachCount, damCount = buildSharedReaches(gdbs, DemCache(cacheFolder), reachFolder(cacheFolder))
+        arcpy.AddMessage("%d shared reaches cached for the flow paths of %d dams" %(reachCount, damCount))
+
+    #Works on multiple dam GDBs in parallel, publishing each staged polygon as its dam finishes
+    if workers>1 and len(gdbs)>1:
+        def publishResult(result):
+            if result.status == "ok" and result.value:
+                publishFloodPolygon(result.gdb, os.path.basename(result.gdb).split('.')[0], outWorkspace, store)
+                publishFloodStats(result.gdb, outWorkspace)
+        results = runBatch("Step3_CreateFloodPolygon", runFunc.__name__, gdbs, args + [True, keepRaw] + sampling, workers, publishResult)
+        reportSummary(results)
+
+    #Works on a single dam GDB or runs them one at a time
+    else:
+        for gdb in gdbs:
+            if runFunc(gdb, *(args + [store != None, keepRaw] + sampling)):
+                if store != None:
+                    publishFloodPolygon(gdb, os.path.basename(gdb).split('.')[0], outWorkspace, store)
+                publishFloodStats(gdb, outWorkspace)
+    reportRunLog(gdbs, batchStart)
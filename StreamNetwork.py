@@ -0,0 +1,418 @@
+# ------------------------------------------------------------------------------
+# Name: Stream Network
+# Desc: In-memory index of the ArcHydro stream table (HydroID, NextDownID, FROM_NODE, TO_NODE).
+#     The table is read once and every downstream trace, upstream lookup and flow split check
+#     becomes a dictionary walk instead of a cursor pass over splitStreams.
+#     StreamStore merges the stream lines of every hydrology GDB used in a run into one feature class,
+#     with an STR index over the line extents so each dam buffer only reads the lines it intersects.
+#     buildStreamTopology replaces the Intersect, UnsplitLine, SplitLineAtPoint, DeleteIdentical, AssignHydroID,
+#     GenerateFNodeTNode and FindNextDownstreamLine chain: endpoints are snapped by hashing coordinates rounded
+#     to the tolerance, lines are joined at pseudo nodes and split where they meet, the original line ends included,
+#     and the IDs are assigned in one pass.
+#     Each split piece keeps the index of the source line it came from, so the source attributes are carried over.
+#     Does not import arcpy at module level so the index can be used outside of ArcGIS.
+# ------------------------------------------------------------------------------
+import os
+from array import array
+from collections import namedtuple
+from math import floor, hypot
+from SpatialIndex import STRtree
+
+SNAP_TOLERANCE = 0.1        #meters, the SplitLineAtPoint search radius the ArcHydro chain used
+TOPOLOGY_FIELDS = ["HydroID", "NextDownID", "FROM_NODE", "TO_NODE"]
+OID_CHUNK = 1000            #ObjectIDs per where clause when selecting store lines
+
+#source is the index of the input line the piece was cut from
+TopologyLine = namedtuple("TopologyLine", ["hydroID", "nextDownID", "fromNode", "toNode", "points", "source"])
+
+#Attributes are held in parallel arrays, dicts map HydroIDs, nodes and first points to array rows.
+class StreamIndex(object):
+    def __init__(self):
+        self.hydroID = array('l')
+        self.nextDown = array('l')
+        self.fromNode = array('l')
+        self.toNode = array('l')
+        self.position = {}          #HydroID -> row
+        self.fromLines = {}         #FROM_NODE -> rows of lines leaving the node
+        self.toLines = {}           #TO_NODE -> rows of lines entering the node
+        self.startPoints = {}       #(X, Y) of first vertex -> row
+
+    def __len__(self):
+        return len(self.hydroID)
+
+    def add(self, hydroID, nextDownID, fromNode, toNode, startXY=None):
+        row = len(self.hydroID)
+        self.hydroID.append(hydroID)
+        self.nextDown.append(-1 if nextDownID is None else nextDownID)
+        self.fromNode.append(-1 if fromNode is None else fromNode)
+        self.toNode.append(-1 if toNode is None else toNode)
+        self.position.setdefault(hydroID, row)
+        self.fromLines.setdefault(self.fromNode[row], []).append(row)
+        self.toLines.setdefault(self.toNode[row], []).append(row)
+        if startXY is not None:
+            self.startPoints.setdefault(tuple(startXY), row)
+        return row
+
+    #Line starting exactly at a point. Returns (HydroID, NextDownID, FROM_NODE) or None.
+    def lineStartingAt(self, x, y):
+        row = self.startPoints.get((x, y))
+        if row is None:
+            return None
+        return (self.hydroID[row], self.nextDown[row], self.fromNode[row])
+
+    #Follow NextDownID from startID to the end of the network. A HydroID seen twice ends the trace.
+    def trace(self, startID):
+        dsList, fromList = [], []
+        seen = set()
+        hydroID = startID
+        while hydroID != -1 and hydroID in self.position and hydroID not in seen:
+            row = self.position[hydroID]
+            seen.add(hydroID)
+            dsList.append(hydroID)
+            fromList.append(self.fromNode[row])
+            hydroID = self.nextDown[row]
+        return dsList, fromList
+
+    #Lines whose TO_NODE is one of the path's FROM_NODEs, not counting the path itself.
+    def upstreamLines(self, dsList, fromList):
+        onPath = set(dsList)
+        usList = []
+        for node in fromList:
+            for row in self.toLines.get(node, []):
+                hydroID = self.hydroID[row]
+                if hydroID not in onPath:
+                    onPath.add(hydroID)
+                    usList.append(hydroID)
+        return usList
+
+    #TO_NODEs along a path that more than one line leaves from.
+    def flowSplits(self, dsList):
+        splits = []
+        for hydroID in dsList:
+            node = self.toNode[self.position[hydroID]]
+            if node != -1 and len(self.fromLines.get(node, [])) > 1:
+                splits.append(node)
+        return splits
+
+#Load a stream feature class into a StreamIndex with a single cursor pass.
+def loadStreamIndex(streamsFC):
+    import arcpy
+    index = StreamIndex()
+    with arcpy.da.SearchCursor(streamsFC, ["HYDROID", "NextDownID", "FROM_NODE", "TO_NODE", "SHAPE@"]) as rows:
+        for row in rows:
+            first = row[4].firstPoint
+            index.add(row[0], row[1], row[2], row[3], (first.X, first.Y))
+    return index
+
+#Snap key of a point, its coordinates rounded to the tolerance
+def snapKey(x, y, tolerance):
+    return (int(round(x/tolerance)), int(round(y/tolerance)))
+
+#Node IDs of points. Points within the tolerance of a node get its ID; the neighbouring keys are
+#searched too, so points either side of a rounding boundary still snap together.
+class NodeSnapper(object):
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.keys = {}
+        self.points = [None]        #node IDs start at 1
+
+    def node(self, x, y):
+        kx, ky = snapKey(x, y, self.tolerance)
+        for dx in (0, -1, 1):
+            for dy in (0, -1, 1):
+                node = self.keys.get((kx + dx, ky + dy))
+                if node != None and hypot(self.points[node][0] - x, self.points[node][1] - y) <= self.tolerance:
+                    return node
+        node = len(self.points)
+        self.points.append((x, y))
+        self.keys[(kx, ky)] = node
+        return node
+
+def lineLength(points):
+    return sum([hypot(x1 - x0, y1 - y0) for (x0, y0), (x1, y1) in zip(points[:-1], points[1:])])
+
+#Join lines where exactly two line ends meet, one ending and the other starting there (UnsplitLine).
+#Returns the merged lines and for each a list of (chainage, index) of the lines joined into it, in flow order.
+def mergeAtPseudoNodes(lines, tolerance):
+    snapper = NodeSnapper(tolerance)
+    ends = [(snapper.node(*line[0]), snapper.node(*line[-1])) for line in lines]
+    degree, starting = {}, {}
+    for i, (fromNode, toNode) in enumerate(ends):
+        degree[fromNode] = degree.get(fromNode, 0) + 1
+        degree[toNode] = degree.get(toNode, 0) + 1
+        starting.setdefault(fromNode, []).append(i)
+    successor = {}
+    for i, (fromNode, toNode) in enumerate(ends):
+        following = starting.get(toNode, [])
+        if degree[toNode] == 2 and len(following) == 1 and following[0] != i:
+            successor[i] = following[0]
+
+    #Chains start at lines nothing joins onto; lines left over are closed loops
+    joined = set(successor.values())
+    merged, sources, used = [], [], set()
+    for i in [i for i in range(len(lines)) if i not in joined] + list(range(len(lines))):
+        if i in used:
+            continue
+        used.add(i)
+        points = list(lines[i])
+        joins = [(0.0, i)]
+        j = successor.get(i)
+        while j != None and j not in used:
+            used.add(j)
+            joins.append((lineLength(points), j))
+            points.extend(lines[j][1:])
+            j = successor.get(j)
+        merged.append(points)
+        sources.append(joins)
+    return merged, sources
+
+#Chainages where each line meets another line, at crossings and where a line end lies within the tolerance
+#of another line. Segments are bucketed into a grid so only nearby segments are compared.
+def junctionChainages(lines, tolerance):
+    segments = []       #(line, start chainage, x0, y0, x1, y1)
+    for i, points in enumerate(lines):
+        chain = 0.0
+        for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+            segments.append((i, chain, x0, y0, x1, y1))
+            chain += hypot(x1 - x0, y1 - y0)
+    cuts = [[] for points in lines]
+    if len(segments) == 0:
+        return cuts
+    cellSize = max(10*tolerance, sum([hypot(s[4] - s[2], s[5] - s[3]) for s in segments])/len(segments))
+    cells = {}
+    for k, (i, chain, x0, y0, x1, y1) in enumerate(segments):
+        for cx in range(int(floor((min(x0, x1) - tolerance)/cellSize)), int(floor((max(x0, x1) + tolerance)/cellSize)) + 1):
+            for cy in range(int(floor((min(y0, y1) - tolerance)/cellSize)), int(floor((max(y0, y1) + tolerance)/cellSize)) + 1):
+                cells.setdefault((cx, cy), []).append(k)
+
+    checked = set()
+    for bucket in cells.values():
+        for a in range(len(bucket)):
+            for b in range(a + 1, len(bucket)):
+                ka, kb = bucket[a], bucket[b]
+                if segments[ka][0] == segments[kb][0] or (ka, kb) in checked:
+                    continue
+                checked.add((ka, kb))
+                addCrossing(segments[ka], segments[kb], tolerance, cuts)
+    return cuts
+
+#Add the chainages where two segments of different lines meet
+def addCrossing(segA, segB, tolerance, cuts):
+    i, chainA, ax0, ay0, ax1, ay1 = segA
+    j, chainB, bx0, by0, bx1, by1 = segB
+    rx, ry = ax1 - ax0, ay1 - ay0
+    sx, sy = bx1 - bx0, by1 - by0
+    lenA, lenB = hypot(rx, ry), hypot(sx, sy)
+    if lenA == 0 or lenB == 0:
+        return
+    denom = rx*sy - ry*sx
+    if abs(denom) > 1e-12*lenA*lenB:
+        t = ((bx0 - ax0)*sy - (by0 - ay0)*sx)/denom
+        u = ((bx0 - ax0)*ry - (by0 - ay0)*rx)/denom
+        if -tolerance/lenA <= t <= 1 + tolerance/lenA and -tolerance/lenB <= u <= 1 + tolerance/lenB:
+            cuts[i].append(chainA + min(max(t, 0.0), 1.0)*lenA)
+            cuts[j].append(chainB + min(max(u, 0.0), 1.0)*lenB)
+            return
+    #Segment ends lying on the other segment, for parallel segments and gaps within the tolerance
+    for px, py, other, ox, oy, dx, dy, length, chain in [(ax0, ay0, j, bx0, by0, sx, sy, lenB, chainB), (ax1, ay1, j, bx0, by0, sx, sy, lenB, chainB),
+                                                         (bx0, by0, i, ax0, ay0, rx, ry, lenA, chainA), (bx1, by1, i, ax0, ay0, rx, ry, lenA, chainA)]:
+        along = min(max(((px - ox)*dx + (py - oy)*dy)/length, 0.0), length)
+        if hypot(ox + dx*along/length - px, oy + dy*along/length - py) <= tolerance:
+            cuts[other].append(chain + along)
+
+#Split a line at chainages. Cuts within the tolerance of each other or of the line ends are dropped.
+def cutLine(points, chainages, tolerance):
+    length = lineLength(points)
+    cuts = []
+    for chain in sorted(chainages):
+        if tolerance < chain < length - tolerance and (len(cuts) == 0 or chain - cuts[-1] > tolerance):
+            cuts.append(chain)
+    if len(cuts) == 0:
+        return [list(points)]
+    pieces, current = [], [points[0]]
+    chain, k = 0.0, 0
+    for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+        seg = hypot(x1 - x0, y1 - y0)
+        while k < len(cuts) and cuts[k] <= chain + seg:
+            t = (cuts[k] - chain)/seg
+            cut = (x0 + t*(x1 - x0), y0 + t*(y1 - y0))
+            current.append(cut)
+            pieces.append(current)
+            current = [cut]
+            k += 1
+        if (x1, y1) != current[-1]:
+            current.append((x1, y1))
+        chain += seg
+    pieces.append(current)
+    return [piece for piece in pieces if len(piece) >= 2]
+
+#FROM_NODE and TO_NODE of each line and NextDownID, the line leaving its TO_NODE. Where several
+#lines leave a node (a flow split) the lowest HydroID is taken; -1 ends the network.
+def assignNodes(hydroIDs, lineEnds, tolerance):
+    snapper = NodeSnapper(tolerance)
+    fromNodes = [snapper.node(*ends[0]) for ends in lineEnds]
+    toNodes = [snapper.node(*ends[1]) for ends in lineEnds]
+    leaving = {}
+    for hydroID, fromNode in zip(hydroIDs, fromNodes):
+        if fromNode not in leaving or hydroID < leaving[fromNode]:
+            leaving[fromNode] = hydroID
+    nextDownIDs = []
+    for hydroID, toNode in zip(hydroIDs, toNodes):
+        nextDown = leaving.get(toNode, -1)
+        nextDownIDs.append(-1 if nextDown == hydroID else nextDown)
+    return fromNodes, toNodes, nextDownIDs
+
+#Stream topology of lines given as lists of (x, y) in flow direction. Returns TopologyLines with HydroIDs from firstID.
+def buildStreamTopology(lines, tolerance=SNAP_TOLERANCE, firstID=1):
+    kept = [i for i, line in enumerate(lines) if len(line) >= 2 and lineLength(line) > tolerance]
+    merged, joined = mergeAtPseudoNodes([lines[i] for i in kept], tolerance)
+    pieces, sources = [], []
+    for points, cuts, joins in zip(merged, junctionChainages(merged, tolerance), joined):
+        #The unsplit lines are cut again at every original line end, as Intersect found them before UnsplitLine
+        cut = cutLine(points, cuts + [chain for chain, source in joins[1:]], tolerance)
+        start = 0.0
+        for piece in cut:
+            pieces.append(piece)
+            sources.append(kept[[source for chain, source in joins if chain < start + tolerance][-1]])
+            start += lineLength(piece)
+
+    #Identical pieces from overlapping source lines are kept once (DeleteIdentical)
+    unique, uniqueSources, seen = [], [], set()
+    for piece, source in zip(pieces, sources):
+        key = tuple([snapKey(x, y, tolerance) for x, y in piece])
+        if key not in seen:
+            seen.add(key)
+            unique.append(piece)
+            uniqueSources.append(source)
+    hydroIDs = list(range(firstID, firstID + len(unique)))
+    fromNodes, toNodes, nextDownIDs = assignNodes(hydroIDs, [(piece[0], piece[-1]) for piece in unique], tolerance)
+    return [TopologyLine(*row) for row in zip(hydroIDs, nextDownIDs, fromNodes, toNodes, unique, uniqueSources)]
+
+#Lines of a feature class as lists of (x, y), one per part
+def readLines(fc):
+    return readLineRows(fc, [])[0]
+
+#Lines of a feature class, one per part, and the values of fields for each line
+def readLineRows(fc, fields):
+    import arcpy
+    lines, values = [], []
+    with arcpy.da.SearchCursor(fc, ["SHAPE@"] + fields) as rows:
+        for row in rows:
+            if row[0] == None:
+                continue
+            for part in row[0]:
+                lines.append([(point.X, point.Y) for point in part if point])
+                values.append(row[1:])
+    return lines, values
+
+#Attribute fields of a feature class that can be copied to its split lines, leaving out the ObjectID, shape,
+#shape length and topology fields
+def sourceFields(fc):
+    import arcpy
+    return [field.name for field in arcpy.ListFields(fc) if field.editable and not field.required and field.type not in ("OID", "Geometry")
+            and field.name not in TOPOLOGY_FIELDS]
+
+#Write a topology to a new line feature class with the ArcHydro fields. With a template feature class, its
+#fields are added too and each line gets values[line.source] of the line it was cut from (readLineRows).
+def writeTopology(topology, outFC, spatialReference, template=None, fields=[], values=None):
+    import arcpy
+    if arcpy.Exists(outFC):
+        arcpy.Delete_management(outFC)
+    arcpy.CreateFeatureclass_management(os.path.dirname(outFC), os.path.basename(outFC), "POLYLINE", template or "", "", "", spatialReference)
+    existing = [field.name for field in arcpy.ListFields(outFC)]
+    for field in TOPOLOGY_FIELDS:
+        if field not in existing:
+            arcpy.AddField_management(outFC, field, "LONG")
+    with arcpy.da.InsertCursor(outFC, ["SHAPE@"] + TOPOLOGY_FIELDS + list(fields)) as iCursor:
+        for line in topology:
+            shape = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in line.points]), spatialReference)
+            attributes = list(values[line.source]) if len(fields) > 0 else []
+            iCursor.insertRow([shape, line.hydroID, line.nextDownID, line.fromNode, line.toNode] + attributes)
+    del iCursor
+
+#Recompute FROM_NODE, TO_NODE and NextDownID of an edited stream feature class in place, keeping its lines and HydroIDs
+def updateTopology(streamsFC, tolerance=SNAP_TOLERANCE):
+    import arcpy
+    hydroIDs, lineEnds = [], []
+    with arcpy.da.SearchCursor(streamsFC, ["HydroID", "SHAPE@"]) as rows:
+        for row in rows:
+            hydroIDs.append(row[0])
+            lineEnds.append(((row[1].firstPoint.X, row[1].firstPoint.Y), (row[1].lastPoint.X, row[1].lastPoint.Y)))
+    fromNodes, toNodes, nextDownIDs = assignNodes(hydroIDs, lineEnds, tolerance)
+    with arcpy.da.UpdateCursor(streamsFC, TOPOLOGY_FIELDS) as rows:
+        for row, fromNode, toNode, nextDown in zip(rows, fromNodes, toNodes, nextDownIDs):
+            rows.updateRow([row[0], nextDown, fromNode, toNode])
+    return len(hydroIDs)
+
+#List the line feature classes in a hydrology GDB
+def lineFeatureClasses(hydroGDB):
+    import arcpy
+    arcpy.env.workspace = hydroGDB
+    fcs = []
+    for fds in arcpy.ListDatasets('','feature') + ['']:
+        for fc in arcpy.ListFeatureClasses('','',fds):
+            if arcpy.Describe(fc).shapeType == "Polyline":
+                fcs.append(os.path.join(hydroGDB, fds, fc))
+    return fcs
+
+#Regional stream store. Each hydrology GDB is appended once per run, however many dams need it.
+class StreamStore(object):
+    def __init__(self, storeGDB, name, spatialReference):
+        import arcpy
+        self.fc = os.path.join(storeGDB, name)
+        if arcpy.Exists(self.fc):
+            arcpy.Delete_management(self.fc)     #rebuilt at the start of every run
+        self.spatialReference = spatialReference
+        self.loaded = set()
+        self.oids = []
+        self.boxes = []
+        self.tree = None        #built on the first query after lines are added
+
+    #Append the line features of a hydrology GDB and add their extents to the index
+    def addHydroGDB(self, hydroGDB):
+        import arcpy
+        if hydroGDB in self.loaded or not arcpy.Exists(hydroGDB):
+            return
+        self.loaded.add(hydroGDB)
+        workspace = arcpy.env.workspace
+        fcs = lineFeatureClasses(hydroGDB)
+        arcpy.env.workspace = workspace
+        if len(fcs)==0:
+            return
+        if not arcpy.Exists(self.fc):
+            arcpy.CreateFeatureclass_management(os.path.dirname(self.fc), os.path.basename(self.fc), "Polyline", fcs[0], "", "SAME_AS_TEMPLATE", self.spatialReference)
+        lastOID = max(self.oids) if self.oids else 0
+        for fc in fcs:
+            arcpy.Append_management(fc, self.fc, "NO_TEST")
+
+        oidField = arcpy.Describe(self.fc).OIDFieldName
+        with arcpy.da.SearchCursor(self.fc, ["OID@", "SHAPE@"], "%s > %d" %(oidField, lastOID)) as rows:
+            for row in rows:
+                if row[1] != None:
+                    extent = row[1].extent
+                    self.oids.append(row[0])
+                    self.boxes.append((extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+        self.tree = None
+
+    #ObjectIDs of the lines whose extent intersects box (xmin, ymin, xmax, ymax)
+    def query(self, box):
+        if self.tree == None:
+            self.tree = STRtree(self.boxes)
+        return [self.oids[i] for i in self.tree.query(box)]
+
+    #Clip the store to a polygon feature class, reading only the lines that intersect its extent.
+    #The lines are selected OID_CHUNK ObjectIDs at a time to keep each where clause short.
+    def clipTo(self, clipFC, outFC):
+        import arcpy
+        extent = arcpy.Describe(clipFC).extent
+        oids = self.query((extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+        oidField = arcpy.AddFieldDelimiters(self.fc, arcpy.Describe(self.fc).OIDFieldName)
+        if len(oids) == 0:
+            arcpy.MakeFeatureLayer_management(self.fc, "storeLyr", "%s = -1" %(oidField))      #an empty selection would clip every line
+        else:
+            arcpy.MakeFeatureLayer_management(self.fc, "storeLyr")
+            for i in range(0, len(oids), OID_CHUNK):
+                where = "%s IN (%s)" %(oidField, ",".join([str(oid) for oid in oids[i:i + OID_CHUNK]]))
+                arcpy.SelectLayerByAttribute_management("storeLyr", "NEW_SELECTION" if i == 0 else "ADD_TO_SELECTION", where)
+        arcpy.Clip_analysis("storeLyr", clipFC, outFC)
+        arcpy.Delete_management("storeLyr")
@@ -0,0 +1,116 @@
+# ------------------------------------------------------------------------------
+# Name: Synthetic County
+# Desc: Generates a synthetic county for benchmarks: a dendritic stream network, a DEM with
+#     valleys cut along the streams and a set of dams spread over the 2, 5 and 10 mile classes.
+#     Streams are held the way the ArcHydro tables hold them (HydroID, NextDownID, FROM_NODE, TO_NODE
+#     and vertices in downstream order), so the pure NumPy parts of the steps can run on them without arcpy.
+# ------------------------------------------------------------------------------
+from __future__ import division
+import math, random
+from collections import namedtuple
+import numpy
+from FloodEngine import nearestSource
+
+StreamLine = namedtuple("StreamLine", ["hydroID", "nextDownID", "fromNode", "toNode", "xs", "ys"])
+Dam = namedtuple("Dam", ["damID", "height", "area", "x", "y", "hydroID"])
+
+#Surface area ranges (acres) that give the 2, 5 and 10 mile classes in downstreamMiles
+AREA_CLASSES = ((1.0, 24.0), (25.0, 99.0), (100.0, 600.0))
+
+class SyntheticCounty(object):
+    def __init__(self, dem, xmin, ymax, cellSize, lines, dams):
+        self.dem = dem
+        self.xmin = xmin
+        self.ymax = ymax
+        self.cellSize = cellSize
+        self.lines = lines
+        self.dams = dams
+        self.byID = dict((line.hydroID, line) for line in lines)
+
+    #Row/column window covering a bounding box, clamped to the DEM
+    def window(self, xmin, ymin, xmax, ymax):
+        nrows, ncols = self.dem.shape
+        c0 = max(0, int(math.floor((xmin - self.xmin)/self.cellSize)))
+        c1 = min(ncols, int(math.ceil((xmax - self.xmin)/self.cellSize)))
+        r0 = max(0, int(math.floor((self.ymax - ymax)/self.cellSize)))
+        r1 = min(nrows, int(math.ceil((self.ymax - ymin)/self.cellSize)))
+        return r0, r1, c0, c1
+
+#Dendritic network grown upstream from an outlet at the bottom of the county.
+#Every reach ends in a junction with two tributaries until depth levels are used or a reach leaves the county.
+def dendriticStreams(width, height, depth=6, reachLength=None, vertexSpacing=30.0, seed=0):
+    rng = random.Random(seed)
+    if reachLength == None:
+        reachLength = 0.9*height/(depth + 1)
+    lines = []
+    nodeCount = [1]
+    stack = [(-1, 1, width/2.0, vertexSpacing, math.pi/2, 0)]     #(downstream HydroID, junction node, x, y, heading, level)
+    while stack:
+        nextDownID, toNode, x, y, heading, level = stack.pop()
+        xs, ys = [x], [y]
+        length = reachLength*rng.uniform(0.6, 1.2)
+        inside = True
+        travelled = 0.0
+        while travelled < length:
+            heading += rng.gauss(0.0, 0.12)
+            x += vertexSpacing*math.cos(heading)
+            y += vertexSpacing*math.sin(heading)
+            if x < 0 or y < 0 or x > width or y > height:
+                inside = False
+                break
+            xs.append(x)
+            ys.append(y)
+            travelled += vertexSpacing
+        if len(xs) < 2:
+            continue
+        nodeCount[0] += 1
+        fromNode = nodeCount[0]
+        hydroID = len(lines) + 1
+        #Vertices were grown upstream, lines run downstream
+        lines.append(StreamLine(hydroID, nextDownID, fromNode, toNode, numpy.array(xs[::-1]), numpy.array(ys[::-1])))
+        if inside and level < depth:
+            for side in (-1, 1):
+                stack.append((hydroID, fromNode, xs[-1], ys[-1], heading + side*rng.uniform(0.35, 0.7), level + 1))
+    return lines
+
+#Valley DEM: a plane rising away from the outlet, side slopes away from the nearest stream cell and a little noise.
+def valleyDEM(lines, nrows, ncols, cellSize, downValley=0.002, sideSlope=0.05, noise=0.3, seed=0):
+    streamMask = numpy.zeros((nrows, ncols), bool)
+    ymax = nrows*cellSize
+    for line in lines:
+        length = numpy.hypot(numpy.diff(line.xs), numpy.diff(line.ys)).sum()
+        count = max(int(length/(cellSize/2.0)), 2)
+        steps = numpy.linspace(0, len(line.xs) - 1, count)
+        xs = numpy.interp(steps, numpy.arange(len(line.xs)), line.xs)
+        ys = numpy.interp(steps, numpy.arange(len(line.ys)), line.ys)
+        rows = numpy.clip(((ymax - ys)/cellSize).astype(int), 0, nrows - 1)
+        cols = numpy.clip((xs/cellSize).astype(int), 0, ncols - 1)
+        streamMask[rows, cols] = True
+    srcRows, srcCols = nearestSource(streamMask)
+    rowIdx = numpy.arange(nrows)[:, None]
+    colIdx = numpy.arange(ncols)[None, :]
+    distance = numpy.hypot(rowIdx - srcRows, colIdx - srcCols)*cellSize
+    del srcRows, srcCols
+    northing = (nrows - 0.5 - rowIdx)*cellSize
+    rng = numpy.random.RandomState(seed)
+    dem = 100.0 + downValley*northing + sideSlope*distance + rng.uniform(-noise, noise, (nrows, ncols))
+    return dem.astype(numpy.float32)
+
+#Dams at the upstream end of distinct reaches, cycling through the surface area classes.
+def placeDams(lines, count, seed=0):
+    rng = random.Random(seed)
+    picks = rng.sample(lines, min(count, len(lines)))
+    dams = []
+    for i, line in enumerate(picks):
+        low, high = AREA_CLASSES[i % len(AREA_CLASSES)]
+        dams.append(Dam("SYN%04d" %(i + 1), round(rng.uniform(10.0, 80.0), 1), round(rng.uniform(low, high), 1),
+                        line.xs[0], line.ys[0], line.hydroID))
+    return dams
+
+#County of nrows x ncols cells. The network depth sets the number of reaches (up to 2^(depth+1) - 1).
+def buildCounty(nrows=1500, ncols=1500, cellSize=10.0, depth=6, damCount=30, seed=0):
+    width, height = ncols*cellSize, nrows*cellSize
+    lines = dendriticStreams(width, height, depth, seed=seed)
+    dem = valleyDEM(lines, nrows, ncols, cellSize, seed=seed)
+    dams = placeDams(lines, damCount, seed)
+    return SyntheticCounty(dem, 0.0, height, cellSize, lines, dams)
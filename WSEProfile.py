@@ -0,0 +1,120 @@
+# ------------------------------------------------------------------------------
+# Name: WSE Profile
+# Desc: Vectorized helpers for placing wave height points along a flow path.
+#     Chainage, interpolated XY and wave height are computed as NumPy arrays from the line vertices,
+#     so the points can be written with a single InsertCursor pass.
+#     Scenarios vary the wave model (initial fraction of dam height, attenuation per mile, height override);
+#     the profiles of all scenarios are computed together as one array with a row per scenario.
+#     Points are placed every spacing meters, or adaptively where the ground profile bends (adaptiveStations).
+# ------------------------------------------------------------------------------
+from __future__ import division
+from collections import namedtuple
+import numpy
+
+METERS_PER_MILE = 1609.344
+
+#fraction of the dam height at the dam, attenuation as a fraction of the dam height per mile, height None uses Dam_height
+Scenario = namedtuple("Scenario", ["name", "fraction", "attenuation", "height"])
+BASE_SCENARIO = Scenario("Base", 0.5, 1/40.0, None)
+
+#Vertex coordinates of a polyline geometry. partStarts holds the index of the first vertex of each part.
+def lineVertices(shape):
+    xs, ys, partStarts = [], [], []
+    for part in shape:
+        partStarts.append(len(xs))
+        for point in part:
+            if point is not None:
+                xs.append(point.X)
+                ys.append(point.Y)
+    return numpy.array(xs, float), numpy.array(ys, float), partStarts
+
+#Cumulative distance at each vertex. The gap between parts is not counted, same as positionAlongLine.
+def chainage(xs, ys, partStarts=None):
+    steps = numpy.hypot(numpy.diff(xs), numpy.diff(ys))
+    if partStarts:
+        starts = numpy.array([i for i in partStarts if i > 0], int)
+        steps[starts - 1] = 0.0
+    return numpy.concatenate(([0.0], numpy.cumsum(steps)))
+
+#Distances of points every x meters along a line, matching xrange(0, length + spacing, spacing) less the last point.
+def stationsAlong(length, spacing):
+    return numpy.arange(0, int(length) + spacing, spacing, dtype=float)[:-1]
+
+#Stations kept from a profile sampled at increasing stations, Douglas-Peucker style: a span is split at the station
+#farthest above or below the straight line between its ends while that departs by more than tolerance, and at its
+#middle while it is longer than maxSpacing. NaN profile values are skipped. The first and last stations are kept.
+def adaptiveStations(stations, profile, tolerance, maxSpacing):
+    stations = numpy.asarray(stations, float)
+    profile = numpy.asarray(profile, float)
+    valid = numpy.isfinite(profile)
+    stations, profile = stations[valid], profile[valid]
+    if len(stations) < 3:
+        return stations
+    keep = numpy.zeros(len(stations), bool)
+    keep[[0, -1]] = True
+    spans = [(0, len(stations) - 1)]
+    while spans:
+        i, j = spans.pop()
+        if j - i < 2:
+            continue
+        inner = stations[i + 1:j]
+        line = profile[i] + (profile[j] - profile[i])*(inner - stations[i])/(stations[j] - stations[i])
+        departure = numpy.abs(profile[i + 1:j] - line)
+        if departure.max() > tolerance:
+            k = i + 1 + int(departure.argmax())
+        elif stations[j] - stations[i] > maxSpacing:
+            k = i + 1 + min(int(numpy.searchsorted(inner, (stations[i] + stations[j])/2.0)), len(inner) - 1)
+        else:
+            continue
+        keep[k] = True
+        spans.extend([(i, k), (k, j)])
+    return stations[keep]
+
+#Interpolated XY at distances along the vertices.
+def pointsAlong(xs, ys, partStarts, stations):
+    vertexChainage = chainage(xs, ys, partStarts)
+    return numpy.interp(stations, vertexChainage, xs), numpy.interp(stations, vertexChainage, ys)
+
+#WaveHt = WaveHt at dam - WaveHt change per mile * Dist_DS in miles
+def waveHeight(damHeight, distMiles):
+    return (0.5*damHeight) - (damHeight/40.0)*numpy.asarray(distMiles, float)
+
+#Scenarios from text: cases separated by ";", each "fraction, attenuation[, height]" with an optional "name=" prefix.
+#e.g. "Base=0.5,0.025; High=0.6,0.02; 0.5,0.025,40"
+def parseScenarios(text):
+    scenarios = []
+    for case in [case.strip() for case in text.split(";") if case.strip() != '']:
+        name = "S%d" %(len(scenarios) + 1)
+        if "=" in case:
+            name, case = [part.strip() for part in case.split("=", 1)]
+        values = [value.strip() for value in case.split(",")]
+        if len(values) not in (2, 3):
+            raise ValueError("Scenario '%s' needs a fraction, an attenuation and an optional height" %(case))
+        height = float(values[2]) if len(values) == 3 and values[2] != '' else None
+        scenarios.append(Scenario(name, float(values[0]), float(values[1]), height))
+    return scenarios
+
+#Height used by each scenario
+def scenarioHeights(scenarios, damHeight):
+    return numpy.array([damHeight if scenario.height is None else scenario.height for scenario in scenarios], float)
+
+#Wave height of every scenario at every distance, one row per scenario
+def scenarioWaveHeights(scenarios, damHeight, distMiles):
+    heights = scenarioHeights(scenarios, damHeight)[:, None]
+    fraction = numpy.array([scenario.fraction for scenario in scenarios], float)[:, None]
+    attenuation = numpy.array([scenario.attenuation for scenario in scenarios], float)[:, None]
+    return fraction*heights - attenuation*heights*numpy.asarray(distMiles, float)[None, :]
+
+#Drop in WSE per mile for each scenario
+def scenarioDrops(scenarios, damHeight):
+    return numpy.array([scenario.attenuation for scenario in scenarios], float)*scenarioHeights(scenarios, damHeight)
+
+#numpy.interp applied to every row of values at once
+def interpRows(x, xp, values):
+    if len(xp) == 1:
+        return numpy.repeat(values[:, :1], len(x), axis=1)
+    x = numpy.clip(numpy.asarray(x, float), xp[0], xp[-1])
+    upper = numpy.clip(numpy.searchsorted(xp, x, "right"), 1, len(xp) - 1)
+    span = xp[upper] - xp[upper - 1]
+    weight = numpy.where(span > 0, (x - xp[upper - 1])/numpy.where(span > 0, span, 1), 0.0)
+    return values[:, upper - 1]*(1 - weight) + values[:, upper]*weight
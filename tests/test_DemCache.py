@@ -0,0 +1,37 @@
+#Windowed reads of a DEM cache written without arcpy
+import numpy
+from DemCache import DemCache, writeTile, writeIndex
+from FloodEngine import RasterGrid
+
+def makeCache(folder, dem, tileSize, xmin=100.0, ymax=500.0, cellSize=2.0):
+    tiles = []
+    for tileRow in range(-(-dem.shape[0]//tileSize)):
+        for tileCol in range(-(-dem.shape[1]//tileSize)):
+            writeTile(folder, tileRow, tileCol, dem[tileRow*tileSize:(tileRow + 1)*tileSize, tileCol*tileSize:(tileCol + 1)*tileSize], tiles)
+    writeIndex(folder, xmin, ymax, cellSize, dem.shape[0], dem.shape[1], tileSize, tiles, "", {})
+    return DemCache(folder)
+
+def test_read_window_across_tiles(tmpdir):
+    dem = numpy.random.RandomState(0).rand(50, 70).astype(numpy.float32)
+    dem[:20, :20] = numpy.nan
+    cache = makeCache(str(tmpdir), dem, 20)
+    assert (0, 0) not in cache.tiles
+    window, lowerLeft = cache.readWindow(110.0, 420.0, 150.0, 470.0)
+    numpy.testing.assert_array_equal(window, dem[15:40, 5:25])
+    assert lowerLeft == (110.0, 420.0)
+    assert cache.readWindow(1000.0, 1000.0, 1100.0, 1100.0)[0].size == 0
+
+def test_grid_reader_of_a_clipped_grid(tmpdir):
+    dem = numpy.random.RandomState(1).rand(50, 70).astype(numpy.float32)
+    cache = makeCache(str(tmpdir), dem, 16)
+    read = cache.gridReader(RasterGrid(110.0, 470.0, 2.0, 25, 20, None))
+    numpy.testing.assert_array_equal(read(0, 25, 0, 20), dem[15:40, 5:25])
+    numpy.testing.assert_array_equal(read(3, 9, 4, 18), dem[18:24, 9:23])
+    outside = read(-20, 5, -10, 3)
+    assert numpy.isnan(outside[:5]).all() and numpy.isnan(outside[:, :5]).all()
+    numpy.testing.assert_array_equal(outside[5:, 5:], dem[:20, :8])
+
+def test_grid_reader_needs_cache_cells(tmpdir):
+    cache = makeCache(str(tmpdir), numpy.zeros((10, 10), numpy.float32), 8)
+    assert cache.gridReader(RasterGrid(101.0, 500.0, 2.0, 4, 4, None)) is None
+    assert cache.gridReader(RasterGrid(100.0, 500.0, 1.0, 4, 4, None)) is None
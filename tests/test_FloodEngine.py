@@ -0,0 +1,142 @@
+#FloodEngine checks against brute force versions on small grids, without arcpy
+from collections import deque
+import numpy
+import pytest
+from FloodEngine import (nearestSource, jumpFlood, connectedTo, sweepConnected, floodFromStreamWSE, floodTiled,
+                         floodScenarios, arrayReader, cellReader, fitsBudget, tileLayout, FloodStats, RasterGrid)
+
+#Squared distance from every cell to its nearest source cell
+def bruteDistance(sourceMask):
+    rows, cols = numpy.nonzero(sourceMask)
+    gridR, gridC = numpy.indices(sourceMask.shape)
+    distance = (gridR[..., None] - rows)**2 + (gridC[..., None] - cols)**2
+    return distance.min(axis=2)
+
+#Cells of mask 8-connected to a seed cell, by breadth first search
+def bfsConnected(mask, seeds):
+    reached = numpy.zeros(mask.shape, bool)
+    queue = deque(zip(*numpy.nonzero(seeds & mask)))
+    for r, c in queue:
+        reached[r, c] = True
+    while queue:
+        r, c = queue.popleft()
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                rr, cc = r + dr, c + dc
+                if 0 <= rr < mask.shape[0] and 0 <= cc < mask.shape[1] and mask[rr, cc] and not reached[rr, cc]:
+                    reached[rr, cc] = True
+                    queue.append((rr, cc))
+    return reached
+
+def assertNearest(sourceMask, rows, cols):
+    gridR, gridC = numpy.indices(sourceMask.shape)
+    assert sourceMask[rows, cols].all()
+    numpy.testing.assert_array_equal((gridR - rows)**2 + (gridC - cols)**2, bruteDistance(sourceMask))
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("allocate", [jumpFlood, nearestSource])
+def test_allocation_matches_brute_force(allocate, seed):
+    rng = numpy.random.RandomState(seed)
+    sourceMask = rng.rand(37, 53) < [0.002, 0.01, 0.05][seed % 3]
+    sourceMask[rng.randint(37), rng.randint(53)] = True
+    rows, cols = allocate(sourceMask)
+    assertNearest(sourceMask, rows, cols)
+
+def test_allocation_of_a_line():
+    sourceMask = numpy.zeros((64, 64), bool)
+    sourceMask[numpy.arange(64), (numpy.arange(64)*0.7 + 5).astype(int)] = True
+    assertNearest(sourceMask, *jumpFlood(sourceMask))
+
+def test_allocation_without_sources():
+    rows, cols = nearestSource(numpy.zeros((4, 5), bool))
+    assert (rows == -1).all() and (cols == -1).all()
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("connect", [sweepConnected, connectedTo])
+def test_connectivity_matches_bfs(connect, seed):
+    rng = numpy.random.RandomState(seed)
+    mask = rng.rand(41, 47) < 0.55
+    seeds = (rng.rand(41, 47) < 0.01) & mask
+    numpy.testing.assert_array_equal(connect(mask, seeds), bfsConnected(mask, seeds))
+
+def test_connectivity_of_a_spiral():
+    mask = numpy.zeros((21, 21), bool)
+    mask[1, 1:20] = mask[1:20, 19] = mask[19, 1:20] = mask[5:20, 1] = mask[5, 1:16] = mask[5:16, 15] = True
+    seeds = numpy.zeros(mask.shape, bool)
+    seeds[15, 15] = True
+    reached = sweepConnected(mask, seeds)
+    numpy.testing.assert_array_equal(reached, mask)
+
+#V shaped valley falling down the rows with a stream down its middle column
+def valley(nrows=200, ncols=200, side=0.5, wseAbove=3.0, constant=None):
+    r, c = numpy.indices((nrows, ncols))
+    dem = (side*numpy.abs(c - ncols//2) + 0.01*(nrows - r)).astype(numpy.float32)
+    line = numpy.full(dem.shape, numpy.nan, numpy.float32)
+    line[:, ncols//2] = dem[:, ncols//2] + wseAbove if constant is None else constant
+    return dem, line
+
+def assertSameFlood(first, second):
+    for a, b in zip(first, second):
+        numpy.testing.assert_allclose(numpy.asarray(a, float), numpy.asarray(b, float), rtol=0, atol=1e-5, equal_nan=True)
+
+def test_flood_depth_and_extent():
+    dem, line = valley()
+    depth, wse, extent = floodFromStreamWSE(dem, line)
+    numpy.testing.assert_array_equal(extent[:, 100], 1)
+    numpy.testing.assert_allclose(depth[:, 100], 3.0, atol=1e-5)
+    assert numpy.nanmin(depth) > 0
+    assert numpy.isnan(depth[extent == 0]).all() and numpy.isnan(wse[extent == 0]).all()
+    assert extent[:, :90].sum() == 0 and extent[:, 111:].sum() == 0
+
+def test_tiled_flood_matches_untiled(tmpdir):
+    dem, line = valley()
+    budgetMB = 0.5
+    assert not fitsBudget(dem.shape, budgetMB)
+    tileSize, halo, factor = tileLayout(dem.shape, budgetMB)
+    assert tileSize < dem.shape[0]
+    assertSameFlood(floodTiled(arrayReader(dem), arrayReader(line), dem.shape, str(tmpdir), budgetMB), floodFromStreamWSE(dem, line))
+
+#A basin reached only through a channel that crosses tiles without stream cells, and a pit below the stream
+#WSE that is not connected to it. With a constant stream WSE the coarse allocation beyond the halo is exact.
+def test_tiled_flood_stitches_connection_across_tiles(tmpdir):
+    dem, line = valley(side=0.2, constant=5.0)
+    dem[30:33, 100:190] = 1.0
+    dem[30:60, 170:190] = 2.0
+    dem[150:170, 150:170] = 1.0
+    dem[145:175, 145:150] = 8.0
+    dem[145:175, 170:175] = 8.0
+    dem[145:150, 145:175] = 8.0
+    dem[170:175, 145:175] = 8.0
+    tiled = floodTiled(arrayReader(dem), arrayReader(line), dem.shape, str(tmpdir), 0.5)
+    untiled = floodFromStreamWSE(dem, line)
+    assertSameFlood(tiled, untiled)
+    assert untiled[2][45, 180] == 1 and untiled[2][160, 160] == 0
+
+def test_scenarios_match_separate_floods():
+    dem, line = valley()
+    rows, cols = numpy.nonzero(numpy.isfinite(line))
+    values = numpy.array([line[rows, cols] + shift for shift in (0.0, -1.5, 2.0)], numpy.float32)
+    for i, flood in enumerate(floodScenarios(dem, rows, cols, values)):
+        single = numpy.full(dem.shape, numpy.nan, numpy.float32)
+        single[rows, cols] = values[i]
+        assertSameFlood(flood, floodFromStreamWSE(dem, single))
+
+def test_tiled_scenarios_match_separate_tiled_floods(tmpdir):
+    dem, line = valley()
+    rows, cols = numpy.nonzero(numpy.isfinite(line))
+    values = numpy.array([line[rows, cols], line[rows, cols] - 1.0], numpy.float32)
+    floods = floodScenarios(dem, rows, cols, values, str(tmpdir.mkdir("scenarios")), 0.5)
+    for i, flood in enumerate(floods):
+        single = floodTiled(arrayReader(dem), cellReader(rows, cols, values[i]), dem.shape, str(tmpdir.mkdir("single%d" %(i))), 0.5)
+        assertSameFlood(flood, single)
+
+def test_stats_fed_by_tiles_match_whole_grid(tmpdir):
+    dem, line = valley()
+    grid = RasterGrid(0.0, 200.0, 1.0, 200, 200, None)
+    ys = 200 - numpy.arange(200) - 0.5
+    xs, miles = numpy.full(200, 100.5), numpy.arange(200)/160.0
+    tiledStats, wholeStats = FloodStats(grid, xs, ys, miles), FloodStats(grid, xs, ys, miles)
+    depth = floodTiled(arrayReader(dem), arrayReader(line), dem.shape, str(tmpdir), 0.5, tiledStats)[0]
+    wholeStats.add(numpy.array(depth))
+    assert tiledStats.summary() == wholeStats.summary()
+    assert tiledStats.summary()["FloodCells"] == int(numpy.isfinite(depth).sum())
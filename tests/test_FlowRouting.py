@@ -0,0 +1,54 @@
+#Depression filling and D8 flow directions
+import numpy
+from FlowRouting import fillDepressions, d8FlowDirection, D8_STEPS
+
+#Follow D8 codes from every cell; each walk must leave the grid without revisiting a cell
+def assertDrainsOut(codes):
+    nr, nc = codes.shape
+    for r in range(nr):
+        for c in range(nc):
+            seen = set()
+            while 0 <= r < nr and 0 <= c < nc:
+                assert (r, c) not in seen
+                seen.add((r, c))
+                code = codes[r, c]
+                if code == 0:
+                    assert r in (0, nr - 1) or c in (0, nc - 1)
+                    break
+                dr, dc = D8_STEPS[code]
+                r, c = r + dr, c + dc
+
+def test_uniform_slope_flows_down_the_rows():
+    dem = -numpy.indices((6, 7))[0].astype(float)
+    codes = d8FlowDirection(dem, 10.0)
+    assert (codes[:-1] == 4).all() and (codes[-1] == 0).all()
+
+def test_steepest_neighbour_wins_over_diagonal():
+    dem = numpy.array([[5.0, 5.0, 5.0], [5.0, 4.0, 3.2], [5.0, 2.9, 5.0]])
+    assert d8FlowDirection(dem)[1, 1] == 4
+    dem[2, 1] = 3.5
+    assert d8FlowDirection(dem)[1, 1] == 1
+
+def test_filled_pits_drain_to_the_edge():
+    rng = numpy.random.RandomState(1)
+    r, c = numpy.indices((30, 30))
+    dem = 0.1*r + rng.rand(30, 30)*3
+    dem[10:15, 10:15] -= 5
+    filled = fillDepressions(dem)
+    assert (filled >= dem).all()
+    codes = d8FlowDirection(filled)
+    inner = codes[1:-1, 1:-1]
+    assert (inner != 0).all()
+    assertDrainsOut(codes)
+
+def test_fill_leaves_drained_cells_alone_and_skips_nodata():
+    dem = numpy.array([[9.0, 9.0, 9.0, 9.0, 9.0],
+                       [9.0, 5.0, 6.0, 4.0, 9.0],
+                       [9.0, 6.0, 7.0, 3.0, 2.0],
+                       [9.0, 9.0, 9.0, 9.0, 9.0]])
+    filled = fillDepressions(dem, 0.0)
+    assert filled[1, 1] == 6.0 and filled[1, 2] == 6.0
+    numpy.testing.assert_array_equal(filled[:, 3:], dem[:, 3:])
+    dem[1, 1] = numpy.nan
+    filled = fillDepressions(dem, 0.0)
+    assert numpy.isnan(filled[1, 1]) and filled[1, 2] == 6.0
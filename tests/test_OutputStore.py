@@ -0,0 +1,6 @@
+#Where clauses of the output store keys
+from OutputStore import keyWhere
+
+def test_key_where_doubles_embedded_quotes():
+    assert keyWhere("O'Neal_Dam") == "FloodName = 'O''Neal_Dam'"
+    assert keyWhere("SC01234_High", "20260101_120000") == "FloodName = 'SC01234_High' AND RunID = '20260101_120000'"
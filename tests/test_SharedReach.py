@@ -0,0 +1,75 @@
+#Shared reaches of flow paths on one river and their cache, read from a DEM cache written without arcpy
+from math import hypot
+import numpy
+from SharedReach import sharedReaches, cacheReaches, writeIndex, damReaches, cacheStamp
+from DemCache import DemCache, writeTile, writeIndex as writeCacheIndex
+from FloodEngine import sampleNearest, sampleBilinear
+from WSEProfile import stationsAlong, pointsAlong
+
+RIVER = [(0.0, float(y)) for y in range(1000, -10, -10)]
+
+def test_reaches_are_cut_where_dams_join():
+    paths = {"A": [(60.0, 1060.0)] + RIVER, "B": RIVER[30:], "C": RIVER[60:80], "D": [(500.0, 0.0), (500.0, 50.0)]}
+    reaches, uses = sharedReaches(paths)
+    assert uses["D"] == []
+    assert len(reaches) == 3
+    dams = sorted(tuple(damIDs) for points, damIDs in reaches.values())
+    assert dams == [("A", "B"), ("A", "B"), ("A", "B", "C")]
+
+    #Every dam cuts a reach at the same vertices, and its chainage is measured along the dam's own path
+    for damID, damUses in uses.items():
+        for use in damUses:
+            points, damIDs = reaches[use.reachID]
+            assert damID in damIDs
+            assert abs((use.end - use.start) - 10.0*(len(points) - 1)) < 1e-6
+    byReach = dict((use.reachID, use) for use in uses["B"])
+    for use in uses["A"]:
+        assert abs(use.start - byReach[use.reachID].start - (hypot(60.0, 60.0) + 300.0)) < 1e-6
+    assert [use.start for use in uses["C"]] == [0.0]
+
+def test_paths_within_the_snap_tolerance_share_reaches():
+    shifted = [(x + 0.01, y - 0.01) for x, y in RIVER[50:]]
+    reaches, uses = sharedReaches({"A": RIVER, "B": shifted}, tolerance=0.1)
+    assert len(reaches) == 1 and len(uses["A"]) == 1 and len(uses["B"]) == 1
+
+#A 1200 x 200 m DEM cache of 2 m cells in 64 cell tiles around RIVER
+def riverCache(folder):
+    dem = numpy.random.RandomState(2).rand(600, 100).astype(numpy.float32) + 100.0
+    tiles = []
+    for tileRow in range(-(-600//64)):
+        for tileCol in range(-(-100//64)):
+            writeTile(folder, tileRow, tileCol, dem[tileRow*64:(tileRow + 1)*64, tileCol*64:(tileCol + 1)*64], tiles)
+    writeCacheIndex(folder, -100.0, 1100.0, 2.0, 600, 100, 64, tiles, "", {"dem": 1})
+    return DemCache(folder), dem
+
+def test_dam_ground_on_shared_reaches_comes_from_the_cache(tmpdir):
+    demCache, dem = riverCache(str(tmpdir.mkdir("dem")))
+    folder = str(tmpdir.join("reaches"))
+    paths = {"A": [(60.0, 1060.0)] + RIVER, "B": RIVER[30:]}
+    reaches, uses = sharedReaches(paths)
+    assert cacheReaches(reaches, folder, demCache) == set(reaches)
+    writeIndex(folder, uses, {"A": "a", "B": "b"}, cacheStamp(demCache))
+    assert damReaches(folder, "B", "changed", cacheStamp(demCache)) == None
+    assert damReaches(folder, "B", "b", "other cache") == None
+    reachesA = damReaches(folder, "A", "a", cacheStamp(demCache))
+    assert reachesA.uses == uses["A"]
+
+    xs, ys = numpy.array(paths["A"]).T
+    stations = numpy.linspace(0.0, 1080.0, 97)
+    ptX, ptY = pointsAlong(xs, ys, None, stations)
+    for method, sample in (("Nearest", sampleNearest), ("Bilinear", sampleBilinear)):
+        own = []
+        ground = reachesA.ground(stations, ptX, ptY, lambda x, y: own.append(len(x)) or sample(dem, -100.0, 1100.0, 2.0, x, y), method)
+        numpy.testing.assert_allclose(ground, sample(dem, -100.0, 1100.0, 2.0, ptX, ptY))
+        assert own == [int((stations < uses["A"][0].start).sum())]
+
+    #The cached profiles are shifted to the dam's chainage; only the stations before the shared reach are its own
+    profileStations, profile = reachesA.profile(1084.0, 2.0, lambda s: sampleNearest(dem, -100.0, 1100.0, 2.0, *pointsAlong(xs, ys, None, s)))
+    assert (numpy.diff(profileStations) > 0).all()
+    assert profileStations[0] == 0.0 and profileStations[-1] > 1080.0
+    numpy.testing.assert_allclose(profile, sampleNearest(dem, -100.0, 1100.0, 2.0, *pointsAlong(xs, ys, None, profileStations)))
+
+def test_reaches_off_the_cache_are_left_out(tmpdir):
+    demCache, dem = riverCache(str(tmpdir.mkdir("dem")))
+    reaches, uses = sharedReaches({"A": [(0.0, 2000.0), (0.0, 1500.0), (0.0, 1000.0)], "B": [(0.0, 1500.0), (0.0, 1000.0)]})
+    assert cacheReaches(reaches, str(tmpdir.join("reaches")), demCache) == set()
@@ -0,0 +1,74 @@
+#buildStreamTopology on hand-made lines and on the synthetic county network
+from StreamNetwork import buildStreamTopology, lineLength, StreamIndex
+from SyntheticCounty import buildCounty
+
+def byStart(topology):
+    return dict((line.points[0], line) for line in topology)
+
+def test_tributary_splits_the_main_stem():
+    main = [(0.0, 100.0), (0.0, 50.0), (0.0, 0.0)]
+    left = [(-40.0, 80.0), (0.0, 50.0)]
+    right = [(30.0, 90.0), (0.0, 50.0)]
+    topology = buildStreamTopology([main, left, right])
+    assert len(topology) == 4
+    lines = byStart(topology)
+    lower = lines[(0.0, 50.0)]
+    assert lower.nextDownID == -1 and lower.points[-1] == (0.0, 0.0)
+    for start in [(0.0, 100.0), (-40.0, 80.0), (30.0, 90.0)]:
+        assert lines[start].nextDownID == lower.hydroID
+        assert lines[start].toNode == lower.fromNode
+    assert len(set([line.fromNode for line in topology] + [line.toNode for line in topology])) == 5
+    assert sorted(line.hydroID for line in topology) == [1, 2, 3, 4]
+
+def test_crossing_lines_are_cut_where_they_cross():
+    topology = buildStreamTopology([[(0.0, 10.0), (20.0, 10.0)], [(10.0, 0.0), (10.0, 20.0)]])
+    assert len(topology) == 4
+    assert all((10.0, 10.0) in (line.points[0], line.points[-1]) for line in topology)
+
+#Lines meeting end to end are split at the original line end again, so a dam there starts a line
+def test_lines_are_kept_split_at_pseudo_nodes():
+    first = [(0.0, 0.0), (10.0, 0.0)]
+    second = [(10.0, 0.0), (20.0, 5.0)]
+    third = [(20.0, 5.0), (20.0, 30.0)]
+    topology = buildStreamTopology([second, first, third, [(5.0, 5.0), (5.0, 5.01)]], firstID=7)
+    assert len(topology) == 3
+    lines = byStart(topology)
+    assert [lines[line[0]].points for line in (first, second, third)] == [first, second, third]
+    assert [lines[line[0]].source for line in (first, second, third)] == [1, 0, 2]
+    assert lines[first[0]].nextDownID == lines[second[0]].hydroID and lines[second[0]].nextDownID == lines[third[0]].hydroID
+    index = StreamIndex()
+    for line in topology:
+        index.add(line.hydroID, line.nextDownID, line.fromNode, line.toNode, line.points[0])
+    assert index.lineStartingAt(10.0, 0.0)[0] == lines[second[0]].hydroID
+    assert index.trace(lines[first[0]].hydroID)[0] == [lines[line[0]].hydroID for line in (first, second, third)]
+
+def test_identical_lines_are_kept_once():
+    main = [(0.0, 100.0), (0.0, 0.0)]
+    topology = buildStreamTopology([main, [(50.0, 50.0), (0.0, 50.0)], list(main)])
+    assert len(topology) == 3
+    assert sorted(line.source for line in topology) == [0, 0, 1]
+
+def test_pieces_keep_their_source_line():
+    main = [(0.0, 100.0), (0.0, 0.0)]
+    tributary = [(50.0, 50.0), (0.0, 50.0)]
+    topology = buildStreamTopology([[(1.0, 1.0), (1.0, 1.05)], main, tributary])
+    assert sorted(line.source for line in topology) == [1, 1, 2]
+
+#Each synthetic reach ends where its downstream reach starts; crossings of the random reaches add more cuts
+def test_synthetic_network_junctions():
+    county = buildCounty(300, 300, 10.0, depth=4, damCount=1, seed=3)
+    lines = [list(zip(line.xs.tolist(), line.ys.tolist())) for line in county.lines]
+    topology = buildStreamTopology(lines)
+    assert len(topology) >= len(lines)
+    position = dict((line.hydroID, i) for i, line in enumerate(county.lines))
+    for i, line in enumerate(county.lines):
+        pieces = [piece for piece in topology if piece.source == i]
+        assert abs(sum(lineLength(piece.points) for piece in pieces) - lineLength(lines[i])) < 1e-6
+        last = [piece for piece in pieces if piece.points[-1] == lines[i][-1]]
+        assert len(last) == 1
+        if line.nextDownID == -1:
+            assert last[0].nextDownID == -1
+        else:
+            down = lines[position[line.nextDownID]]
+            first = [piece for piece in topology if piece.points[0] == down[0]]
+            assert last[0].nextDownID == min(piece.hydroID for piece in first)
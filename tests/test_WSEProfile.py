@@ -0,0 +1,52 @@
+#Adaptive stations and scenario parsing
+import numpy
+import pytest
+from WSEProfile import adaptiveStations, stationsAlong, parseScenarios, scenarioWaveHeights, waveHeight
+
+def maxDeparture(stations, profile, kept):
+    index = numpy.searchsorted(stations, kept)
+    return numpy.abs(numpy.interp(stations, kept, profile[index]) - profile).max()
+
+def test_flat_profile_keeps_ends_and_max_spacing():
+    stations = stationsAlong(5000, 10)
+    kept = adaptiveStations(stations, numpy.full(len(stations), 12.0), 0.5, 400.0)
+    assert kept[0] == stations[0] and kept[-1] == stations[-1]
+    assert numpy.diff(kept).max() <= 400.0
+    assert len(kept) < len(stations)//10
+
+@pytest.mark.parametrize("seed", range(4))
+def test_kept_stations_follow_profile_within_tolerance(seed):
+    rng = numpy.random.RandomState(seed)
+    stations = stationsAlong(3000, 5)
+    profile = numpy.cumsum(rng.normal(0, 0.3, len(stations))) + 20*numpy.sin(stations/400.0)
+    kept = adaptiveStations(stations, profile, 0.5, 200.0)
+    assert numpy.all(numpy.diff(kept) > 0)
+    assert set(kept.tolist()) <= set(stations.tolist())
+    assert maxDeparture(stations, profile, kept) <= 0.5
+    assert numpy.diff(kept).max() <= 200.0
+
+def test_nodata_in_profile_is_skipped():
+    stations = numpy.arange(0, 100.0, 10)
+    profile = numpy.arange(10, dtype=float)
+    profile[[0, 4]] = numpy.nan
+    kept = adaptiveStations(stations, profile, 0.1, 1000.0)
+    assert kept.tolist() == [10.0, 90.0]
+
+def test_parse_scenarios():
+    scenarios = parseScenarios(" Base=0.5,0.025; High = 0.6, 0.02 ;0.5,0.025,40; ")
+    assert [scenario.name for scenario in scenarios] == ["Base", "High", "S3"]
+    assert [scenario.height for scenario in scenarios] == [None, None, 40.0]
+    assert scenarios[1].fraction == 0.6 and scenarios[1].attenuation == 0.02
+    assert parseScenarios("") == []
+
+def test_parse_scenarios_rejects_bad_cases():
+    with pytest.raises(ValueError):
+        parseScenarios("Base=0.5")
+    with pytest.raises(ValueError):
+        parseScenarios("0.5,0.025,40,1")
+
+def test_base_scenario_matches_wave_height():
+    distMiles = numpy.linspace(0, 10, 21)
+    heights = scenarioWaveHeights(parseScenarios("0.5,0.025; 0.5,0.025,20"), 30.0, distMiles)
+    numpy.testing.assert_allclose(heights[0], waveHeight(30.0, distMiles))
+    numpy.testing.assert_allclose(heights[1], waveHeight(20.0, distMiles))